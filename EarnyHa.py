@@ -1,11 +1,36 @@
 import logging
 import sqlite3
 import os
-import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import asyncio
+import bisect
+from array import array
+import cProfile
+import csv
+import functools
+import glob
+import heapq
+import io
+import itertools
+import json
+import pstats
+import queue
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (
+    Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes,
+    MessageHandler, TypeHandler, filters
+)
 
 # Configure logging
 logging.basicConfig(
@@ -19,240 +44,3086 @@ BOT_TOKEN = "7615976931:AAEjz3Zk-LyJ13bDb2FQ7Y1kezToCZ9gaD8"
 ADMIN_ID = 123456789  # You can set your admin user ID here
 REFERRAL_BONUS = 10.0  # Bonus amount per referral in rupees
 MIN_WITHDRAWAL = 50.0  # Minimum withdrawal amount
+ADMIN_PAGE_SIZE = 10  # Users per page in /admin users
+HISTORY_SIZE = 5  # Recent withdrawals and referrals listed by /balance and /referrals
+TELEGRAM_MESSAGE_LIMIT = 4096  # Maximum message length in UTF-16 code units
+ADMIN_LISTING_MAX_MESSAGES = 5  # Longer admin listings are sent as a file instead
+PAYOUT_CHUNK_SIZE = 500  # Withdrawals read or processed per transaction in bulk payouts
+SQL_MAX_VARIABLES = 500  # Values bound per IN (...) list; older SQLite builds allow only 999
+STATS_RECONCILE_INTERVAL = 3600  # Seconds between bot_stats consistency checks
+REFERRAL_CREDIT_INTERVAL = 1.0  # Seconds between drains of the cross-shard referral bonus outbox
+REFERRAL_CREDIT_BATCH_SIZE = 500  # Outbox rows read per shard and credited per transaction
+LEDGER_REPAIR_CHUNK_SIZE = 500  # Balance snapshots rewritten per transaction by a ledger repair
+LEDGER_MAX_REPORTED = 10  # Mismatched balances listed by a ledger verification
 
-class DatabaseManager:
-    def __init__(self, db_path="earnyha_bot.db"):
+# Metrics and profiling
+METRICS_PORT = 9464  # Local port serving Prometheus metrics (0 disables)
+METRICS_LISTEN = "127.0.0.1"  # Keep metrics off the public interface
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # Histogram bounds in seconds
+PROFILE_DIR = "profiles"  # Where /admin profile writes its .prof files
+PROFILE_MAX_SECONDS = 300  # Longest profile /admin profile will run
+
+# Update delivery configuration
+UPDATE_MODE = "polling"  # "polling" or "webhook"
+WEBHOOK_LISTEN = "0.0.0.0"  # Address the local webhook server binds to
+WEBHOOK_PORT = 8443  # Port the local webhook server listens on
+WEBHOOK_PATH = "telegram"  # URL path updates are POSTed to
+WEBHOOK_URL = ""  # Public base URL Telegram should call, e.g. "https://bot.example.com"
+WEBHOOK_SECRET = ""  # Secret token Telegram must send; random per start if empty
+WEBHOOK_MAX_CONNECTIONS = 40  # Concurrent update deliveries Telegram may open (1-100)
+CONCURRENT_UPDATES = 64  # Updates handled at once (1 = sequential); each user's updates stay in order
+
+# Outbound message rate limits (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+SEND_GLOBAL_RATE = 30.0  # Messages per second across all chats
+SEND_CHAT_RATE = 1.0  # Sustained messages per second to one private chat
+SEND_CHAT_BURST = 5  # Messages a private chat may receive back-to-back
+SEND_GROUP_RATE = 20 / 60  # Messages per second to one group chat
+SEND_MAX_RETRIES = 3  # Retries after a RetryAfter (flood control) error
+ADMIN_DIGEST = True  # Batch withdrawal notifications into one admin message
+ADMIN_DIGEST_WINDOW = 60  # Seconds to collect withdrawals before sending a digest
+ADMIN_DIGEST_MAX_EVENTS = 50  # Send early once this many withdrawals are waiting
+
+# Database configuration
+DB_PATH = "earnyha_bot.db"
+DB_STORAGE = "file"  # "file" (one database), "sharded" (DB_SHARDS files by user_id) or "memory" (tests)
+DB_SHARDS = 4  # Database files used by sharded storage; changing it needs a fresh database
+DB_POOLED = True  # Reuse long-lived WAL connections instead of reconnecting per call
+DB_POOL_SIZE = 4  # Maximum number of pooled connections
+DB_BUSY_TIMEOUT = 5.0  # Seconds to wait on a locked database
+DB_SYNCHRONOUS = "NORMAL"  # Safe with WAL; use "FULL" to fsync every commit
+DB_CACHE_SIZE_KIB = 16384  # Page cache per connection
+DB_MMAP_SIZE = 64 * 1024 * 1024  # Memory-mapped I/O window in bytes
+DB_STATEMENT_CACHE = 256  # Prepared statements kept per connection
+DB_LOCK_WAIT_THRESHOLD = 0.001  # BEGIN IMMEDIATE slower than this counts as waiting for the write lock
+DB_WORKERS = DB_POOL_SIZE  # Threads serving awaitable database calls
+DB_MAX_PENDING = 1000  # Queued database calls before callers wait for a slot
+DB_GROUP_COMMIT = False  # Batch writes from many handlers into shared transactions
+GROUP_COMMIT_INTERVAL = 0.005  # Seconds a batch may wait for more writes
+GROUP_COMMIT_BATCH_SIZE = 200  # Writes per batch before it is flushed early
+BACKUP_DIR = "backups"  # Where online backups are written, one directory per backup
+BACKUP_INTERVAL = 6 * 3600  # Seconds between online backups (0 disables)
+BACKUP_RETENTION = 7  # Backups kept; older ones are deleted after each new backup
+BACKUP_PARTIAL_MAX_AGE = 24 * 3600  # Seconds before an unfinished backup directory counts as abandoned
+CACHE_SNAPSHOT_PATH = "earnyha_bot.warm.json"  # Hot user ids saved at shutdown and warmed at startup
+USER_CACHE_SIZE = 10000  # User records kept in memory (0 disables the cache)
+USER_CACHE_TTL = 300  # Seconds before a cached user record is re-read
+REFERRAL_INDEX = True  # Resolve referral codes from an in-memory index warmed at startup
+REFERRAL_INDEX_MAX_BYTES = 64 * 1024 * 1024  # Memory budget; codes beyond it are looked up in SQLite
+REFERRAL_INDEX_AUTHORITATIVE = True  # Index misses are unknown codes; set False if other processes add users
+REFERRAL_NEGATIVE_CACHE_SIZE = 10000  # Unknown codes remembered so repeats skip SQLite
+REFERRAL_NEGATIVE_CACHE_TTL = 600  # Seconds an unknown code stays remembered
+REFERRAL_GRAPH = True  # Keep the referral tree in memory for downline and fraud reports
+REFERRAL_GRAPH_TOP_SIZE = 100  # Leaders tracked for the top referrer and downline reports
+REFERRAL_GRAPH_MAX_DEPTH = 64  # Deepest referral chain walked by upline and SQL downline queries
+REFERRAL_GRAPH_MAX_WALK = 100000  # Downline members visited when counting per-level sizes
+REFERRAL_BURST_HISTORY = 24 * 3600  # Seconds of referrals kept for burst reports
+REFERRAL_BURST_WINDOW = 3600  # Default window for /admin graph bursts
+REFERRAL_BURST_THRESHOLD = 20  # Referrals within one window that flag a referrer
+
+USER_COLUMNS = (
+    'user_id', 'username', 'first_name', 'last_name', 'referral_code', 'referred_by',
+    'balance', 'total_earned', 'total_referrals', 'join_date', 'is_active', 'balance_paise'
+)
+USER_SELECT = ', '.join(USER_COLUMNS)
+
+# Columns of the pending-withdrawal CSV; admins fill in `decision`
+PAYOUT_CSV_COLUMNS = (
+    'id', 'user_id', 'username', 'first_name', 'amount',
+    'payment_method', 'payment_details', 'created_at', 'decision'
+)
+PAYOUT_DECISIONS = {'approve': 'approved', 'reject': 'rejected'}
+# A spreadsheet treats a cell starting with one of these as a formula
+SPREADSHEET_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def spreadsheet_safe(value):
+    """Quote a text cell so a spreadsheet shows it as text instead of evaluating it"""
+    if isinstance(value, str) and value.startswith(SPREADSHEET_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def to_paise(rupees):
+    """Convert a rupee amount to whole paise, the unit money is stored in"""
+    return int(round(rupees * 100))
+
+REFERRAL_BONUS_PAISE = to_paise(REFERRAL_BONUS)
+MIN_WITHDRAWAL_PAISE = to_paise(MIN_WITHDRAWAL)
+
+# Every change to a balance appends one signed ledger entry: opening_balance,
+# opening_earned, referral_bonus, withdrawal_hold or withdrawal_refund.
+# opening_earned and referral_bonus also count towards total_earned (see
+# HOT_QUERIES['ledger_totals']).
+
+# Global counters kept in the single bot_stats row; money in paise
+STATS_COLUMNS = (
+    'total_users', 'total_balance_paise', 'total_earned_paise', 'total_referrals',
+    'pending_withdrawals', 'pending_amount_paise'
+)
+STATS_FROM_BASE_TABLES = '''
+    SELECT 1 AS id, u.total_users, u.total_balance_paise, u.total_earned_paise, u.total_referrals,
+           w.pending_withdrawals, w.pending_amount_paise
+    FROM (
+        SELECT COUNT(*) AS total_users, COALESCE(SUM(balance_paise), 0) AS total_balance_paise,
+               COALESCE(SUM(earned_paise), 0) AS total_earned_paise,
+               COALESCE(SUM(total_referrals), 0) AS total_referrals
+        FROM users
+    ) u, (
+        SELECT COUNT(*) AS pending_withdrawals, COALESCE(SUM(amount_paise), 0) AS pending_amount_paise
+        FROM withdrawals WHERE status = 'pending'
+    ) w
+'''
+
+# Ordered schema migrations: (version, description, steps). A step is either
+# an SQL statement or a callable taking a cursor. Never edit an applied
+# migration; append a new one instead.
+MIGRATIONS = [
+    (1, "initial schema", (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            balance REAL DEFAULT 0.0,
+            total_earned REAL DEFAULT 0.0,
+            total_referrals INTEGER DEFAULT 0,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            bonus_amount REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users (user_id),
+            FOREIGN KEY (referred_id) REFERENCES users (user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            status TEXT DEFAULT 'pending',
+            payment_method TEXT,
+            payment_details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+    )),
+    (2, "indexes for referral and withdrawal lookups", (
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, created_at)',
+    )),
+    (3, "index for paging users by join date", (
+        'CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date, user_id)',
+    )),
+    (4, "incrementally maintained bot statistics", (
+        '''
+        CREATE TABLE IF NOT EXISTS bot_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            total_balance REAL NOT NULL DEFAULT 0.0,
+            total_earned REAL NOT NULL DEFAULT 0.0,
+            total_referrals INTEGER NOT NULL DEFAULT 0,
+            pending_withdrawals INTEGER NOT NULL DEFAULT 0,
+            pending_amount REAL NOT NULL DEFAULT 0.0
+        )
+        ''',
+        '''
+        INSERT OR REPLACE INTO bot_stats (
+            id, total_users, total_balance, total_earned, total_referrals, pending_withdrawals, pending_amount
+        )
+        SELECT 1, u.total_users, u.total_balance, u.total_earned, u.total_referrals,
+               w.pending_withdrawals, w.pending_amount
+        FROM (
+            SELECT COUNT(*) AS total_users, COALESCE(SUM(balance), 0) AS total_balance,
+                   COALESCE(SUM(total_earned), 0) AS total_earned,
+                   COALESCE(SUM(total_referrals), 0) AS total_referrals
+            FROM users
+        ) u, (
+            SELECT COUNT(*) AS pending_withdrawals, COALESCE(SUM(amount), 0) AS pending_amount
+            FROM withdrawals WHERE status = 'pending'
+        ) w
+        ''',
+    )),
+    (5, "index for paging through withdrawals by status", (
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_status_id ON withdrawals (status, id)',
+    )),
+    (6, "integer paise amounts and an append-only balance ledger", (
+        # The REAL rupee columns stay as snapshots for display, always
+        # written together with the paise columns they are derived from
+        'ALTER TABLE users ADD COLUMN balance_paise INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN earned_paise INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE referrals ADD COLUMN bonus_paise INTEGER',
+        'ALTER TABLE withdrawals ADD COLUMN amount_paise INTEGER',
+        '''
+        UPDATE users SET
+            balance_paise = CAST(ROUND(COALESCE(balance, 0) * 100) AS INTEGER),
+            earned_paise = CAST(ROUND(COALESCE(total_earned, 0) * 100) AS INTEGER)
+        ''',
+        'UPDATE users SET balance = balance_paise / 100.0, total_earned = earned_paise / 100.0',
+        'UPDATE referrals SET bonus_paise = CAST(ROUND(COALESCE(bonus_amount, 0) * 100) AS INTEGER)',
+        'UPDATE withdrawals SET amount_paise = CAST(ROUND(COALESCE(amount, 0) * 100) AS INTEGER)',
+        '''
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            entry TEXT NOT NULL,
+            amount_paise INTEGER NOT NULL,
+            ref_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Covers the per-user replay in verify_ledger
+        'CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, entry, amount_paise)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger
+        BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger
+        BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+        ''',
+        # Existing balances become opening entries
+        '''
+        INSERT INTO ledger (user_id, entry, amount_paise)
+        SELECT user_id, 'opening_earned', earned_paise FROM users WHERE earned_paise != 0
+        ''',
+        '''
+        INSERT INTO ledger (user_id, entry, amount_paise)
+        SELECT user_id, 'opening_balance', balance_paise - earned_paise FROM users
+        WHERE balance_paise != earned_paise
+        ''',
+        'DROP TABLE bot_stats',
+        '''
+        CREATE TABLE bot_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            total_balance_paise INTEGER NOT NULL DEFAULT 0,
+            total_earned_paise INTEGER NOT NULL DEFAULT 0,
+            total_referrals INTEGER NOT NULL DEFAULT 0,
+            pending_withdrawals INTEGER NOT NULL DEFAULT 0,
+            pending_amount_paise INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        f'''
+        INSERT INTO bot_stats (id, {', '.join(STATS_COLUMNS)})
+        {STATS_FROM_BASE_TABLES}
+        ''',
+    )),
+    (7, "covering index for walking referral downlines", (
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referrer_referred ON referrals (referrer_id, referred_id)',
+    )),
+    (8, "outbox for referral bonuses owed by another shard", (
+        # A signup whose referrer lives in another database file records the
+        # bonus here in its own transaction; it is cleared once credited
+        '''
+        CREATE TABLE IF NOT EXISTS referral_credits (
+            referred_id INTEGER PRIMARY KEY,
+            referrer_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    )),
+]
+
+# Hot queries and the index each one must use: name -> (sql, index)
+HOT_QUERIES = {
+    'user_by_referral_code': (
+        'SELECT user_id FROM users WHERE referral_code = ?',
+        'sqlite_autoindex_users_1'
+    ),
+    'referral_codes_sorted': (
+        'SELECT referral_code, user_id FROM users WHERE referral_code IS NOT NULL ORDER BY referral_code',
+        'sqlite_autoindex_users_1'
+    ),
+    'pending_withdrawals': (
+        '''
+        SELECT w.*, u.username, u.first_name 
+        FROM withdrawals w 
+        JOIN users u ON w.user_id = u.user_id 
+        WHERE w.status = 'pending' 
+        ORDER BY w.created_at DESC
+        ''',
+        'idx_withdrawals_status'
+    ),
+    'users_page_first': (
+        f'SELECT {USER_SELECT} FROM users ORDER BY join_date DESC, user_id DESC LIMIT ?',
+        'idx_users_join_date'
+    ),
+    'users_page_older': (
+        f'''
+        SELECT {USER_SELECT} FROM users
+        WHERE (join_date, user_id) < (?, ?)
+        ORDER BY join_date DESC, user_id DESC LIMIT ?
+        ''',
+        'idx_users_join_date'
+    ),
+    'users_page_newer': (
+        f'''
+        SELECT {USER_SELECT} FROM users
+        WHERE (join_date, user_id) > (?, ?)
+        ORDER BY join_date ASC, user_id ASC LIMIT ?
+        ''',
+        'idx_users_join_date'
+    ),
+    'pending_withdrawals_chunk': (
+        '''
+        SELECT w.id, w.user_id, u.username, u.first_name, w.amount,
+               w.payment_method, w.payment_details, w.created_at
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.user_id
+        WHERE w.status = 'pending' AND w.id > ?
+        ORDER BY w.id LIMIT ?
+        ''',
+        'idx_withdrawals_status_id'
+    ),
+    'referrals_by_referrer': (
+        'SELECT referred_id, bonus_amount, created_at FROM referrals WHERE referrer_id = ? ORDER BY id DESC LIMIT ?',
+        'idx_referrals_referrer'
+    ),
+    'referral_of_user': (
+        'SELECT referrer_id FROM referrals WHERE referred_id = ?',
+        'idx_referrals_referred'
+    ),
+    'withdrawals_of_user': (
+        'SELECT id, amount, status, created_at FROM withdrawals WHERE user_id = ? ORDER BY created_at DESC LIMIT ?',
+        'idx_withdrawals_user'
+    ),
+    'downline': (
+        '''
+        WITH RECURSIVE downline(user_id, depth) AS (
+            SELECT referred_id, 1 FROM referrals WHERE referrer_id = ?
+            UNION ALL
+            SELECT r.referred_id, downline.depth + 1
+            FROM downline JOIN referrals r ON r.referrer_id = downline.user_id
+            WHERE downline.depth < ?
+        )
+        SELECT COUNT(*), COALESCE(MAX(depth), 0) FROM downline
+        ''',
+        'idx_referrals_referrer_referred'
+    ),
+    'ledger_totals': (
+        '''
+        SELECT user_id, SUM(amount_paise),
+               SUM(CASE WHEN entry IN ('opening_earned', 'referral_bonus') THEN amount_paise ELSE 0 END), COUNT(*)
+        FROM ledger GROUP BY user_id ORDER BY user_id
+        ''',
+        'idx_ledger_user'
+    ),
+}
+
+class UserCache:
+    """Bounded LRU cache of user records with a time-to-live
+    
+    Writers call invalidate() after committing. Every invalidation bumps
+    `version`, and put() ignores records read before the latest
+    invalidation so a slow reader can never re-insert stale data.
+    """
+    
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id):
+        """Return a copy of the cached record, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+    
+    def put(self, user_id, record, version):
+        """Cache a record read while the cache was at `version`"""
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, dict(record))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, *user_ids):
+        """Drop records for users whose rows have changed"""
+        with self._lock:
+            self.version += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+    
+    def user_ids(self):
+        """Cached user ids, most recently used first"""
+        with self._lock:
+            return list(reversed(self._entries))
+    
+    def stats(self):
+        """Return hit/miss counters for the admin panel"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+# Referral codes are Crockford base32. The first char is always a letter that
+# is not a hex digit, so new codes never clash with the 8-char hex codes
+# handed out before; it carries 4 bits, every other char 5.
+REFERRAL_CODE_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+REFERRAL_CODE_LEADS = 'GHJKMNPQRSTVWXYZ'
+REFERRAL_CODE_SIZES = ((39, 8), (54, 11))  # (id bits, code length); Telegram ids fit in 52 bits
+REFERRAL_CODE_MULTIPLIER = 0x5DEECE66D  # Odd, so multiplying is a bijection modulo 2**bits
+_REFERRAL_CODE_DIGITS = {char: digit for digit, char in enumerate(REFERRAL_CODE_ALPHABET)}
+
+def make_referral_code(user_id):
+    """Derive the referral code for a user id
+    
+    The id goes through a fixed bijection (multiply, then xor-shift) so that
+    consecutive ids get unrelated-looking codes. Distinct ids therefore always
+    give distinct codes, in constant time and without touching the database.
+    Ids below 2**39 get 8 chars, larger ones 11.
+    """
+    for bits, length in REFERRAL_CODE_SIZES:
+        if 0 <= user_id < 1 << bits:
+            break
+    else:
+        raise ValueError(f"user id {user_id} out of range for a referral code")
+    
+    value = (user_id * REFERRAL_CODE_MULTIPLIER) & ((1 << bits) - 1)
+    value ^= value >> ((bits + 1) // 2)
+    
+    chars = []
+    for _ in range(length - 1):
+        chars.append(REFERRAL_CODE_ALPHABET[value & 31])
+        value >>= 5
+    chars.append(REFERRAL_CODE_LEADS[value])
+    return ''.join(reversed(chars))
+
+def referral_code_user_id(code):
+    """Inverse of make_referral_code; None for codes it did not make"""
+    for bits, length in REFERRAL_CODE_SIZES:
+        if len(code) == length:
+            break
+    else:
+        return None
+    
+    value = REFERRAL_CODE_LEADS.find(code[0])
+    if value < 0:
+        return None
+    for char in code[1:]:
+        digit = _REFERRAL_CODE_DIGITS.get(char)
+        if digit is None:
+            return None
+        value = value << 5 | digit
+    
+    # xor-shift by at least half the width is its own inverse
+    value ^= value >> ((bits + 1) // 2)
+    return (value * pow(REFERRAL_CODE_MULTIPLIER, -1, 1 << bits)) & ((1 << bits) - 1)
+
+REFERRAL_CODE_MAX_PACKED = 8  # Longest code that fits a 64-bit key
+
+def pack_referral_code(code):
+    """Pack an ASCII code of up to 8 chars into a 64-bit int, or None
+    
+    The key is the code's bytes, NUL-padded and read big-endian, so keys
+    sort exactly like the codes do in SQLite's BINARY collation.
+    """
+    if not code or len(code) > REFERRAL_CODE_MAX_PACKED or not code.isascii() or '\0' in code:
+        return None
+    return int.from_bytes(code.encode().ljust(REFERRAL_CODE_MAX_PACKED, b'\0'), 'big')
+
+class PackedSortedMap:
+    """Map of 64-bit int keys to ints in two sorted arrays plus a dict of recent additions
+    
+    Not thread-safe; owners call it under their own lock.
+    """
+    
+    # Approximate bytes per entry outside the arrays (dict slot, key and value objects)
+    DICT_ENTRY_BYTES = 120
+    MIN_MERGE = 1024
+    
+    def __init__(self, value_type='Q'):
+        self.keys = array('Q')
+        self.values = array(value_type)
+        self.recent = {}
+        self.merges = 0
+    
+    def __len__(self):
+        return len(self.keys) + len(self.recent)
+    
+    def memory_bytes(self):
+        return (
+            (self.keys.itemsize + self.values.itemsize) * len(self.keys)
+            + self.DICT_ENTRY_BYTES * len(self.recent)
+        )
+    
+    def load(self, keys, values):
+        """Replace the contents with arrays already sorted by key"""
+        self.keys, self.values = keys, values
+        self.recent.clear()
+    
+    def get(self, key):
+        value = self.recent.get(key)
+        if value is None:
+            index = bisect.bisect_left(self.keys, key)
+            if index < len(self.keys) and self.keys[index] == key:
+                value = self.values[index]
+        return value
+    
+    def add(self, key, value):
+        self.recent[key] = value
+        # Merging once the dict reaches 1/8 of the arrays keeps inserts amortized O(1)
+        if len(self.recent) >= max(self.MIN_MERGE, len(self.keys) // 8):
+            self.merge()
+    
+    def merge(self):
+        """Fold the recent dict into the sorted arrays"""
+        keys, values = array(self.keys.typecode), array(self.values.typecode)
+        index = 0
+        old_keys, old_values = self.keys, self.values
+        for key, value in sorted(self.recent.items()):
+            end = bisect.bisect_left(old_keys, key, index)
+            keys.extend(old_keys[index:end])
+            values.extend(old_values[index:end])
+            keys.append(key)
+            values.append(value)
+            # A re-added key replaces its old entry
+            index = end + 1 if end < len(old_keys) and old_keys[end] == key else end
+        keys.extend(old_keys[index:])
+        values.extend(old_values[index:])
+        self.keys, self.values = keys, values
+        self.recent.clear()
+        self.merges += 1
+
+class ReferralCodeIndex:
+    """In-memory referral code -> user_id map with a negative cache
+    
+    get() returns the user_id, MISSING for a code known not to exist, or
+    None when SQLite has to be asked (not authoritative, or over budget).
+    """
+    
+    MISSING = -1
+    DICT_ENTRY_BYTES = PackedSortedMap.DICT_ENTRY_BYTES
+    
+    def __init__(self, max_bytes=REFERRAL_INDEX_MAX_BYTES, authoritative=REFERRAL_INDEX_AUTHORITATIVE,
+                 negative_size=REFERRAL_NEGATIVE_CACHE_SIZE, negative_ttl=REFERRAL_NEGATIVE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.authoritative = authoritative
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.fallbacks = 0
+        self._codes = PackedSortedMap()
+        self._unpacked = {}
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._codes) + len(self._unpacked)
+    
+    @property
+    def merges(self):
+        return self._codes.merges
+    
+    def memory_bytes(self):
+        """Estimated memory held by the index"""
+        return self._codes.memory_bytes() + self.DICT_ENTRY_BYTES * (len(self._unpacked) + len(self._negative))
+    
+    def warm(self, rows):
+        """Load (code, user_id) rows sorted by code, replacing the contents
+        
+        Stops loading at the memory budget; the index is then incomplete
+        and unknown codes fall back to SQLite.
+        """
+        keys, user_ids, unpacked = array('Q'), array('Q'), {}
+        budget = self.max_bytes
+        complete = True
+        for code, user_id in rows:
+            key = pack_referral_code(code)
+            if key is None:
+                unpacked[code] = user_id
+                budget -= self.DICT_ENTRY_BYTES
+            else:
+                keys.append(key)
+                user_ids.append(user_id)
+                budget -= keys.itemsize + user_ids.itemsize
+            if budget < 0:
+                complete = False
+                break
+        
+        with self._lock:
+            self._codes.load(keys, user_ids)
+            self._unpacked = unpacked
+            self._negative.clear()
+            self.complete = complete
+        return len(keys) + len(unpacked)
+    
+    def get(self, code):
+        key = pack_referral_code(code)
+        with self._lock:
+            user_id = self._unpacked.get(code) if key is None else self._codes.get(key)
+            if user_id is not None:
+                self.hits += 1
+                return user_id
+            
+            expires = self._negative.get(code)
+            if expires is not None:
+                if expires >= time.monotonic():
+                    self.negative_hits += 1
+                    return self.MISSING
+                del self._negative[code]
+            
+            if self.complete and self.authoritative:
+                self.misses += 1
+                self._remember_missing(code)
+                return self.MISSING
+            self.fallbacks += 1
+            return None
+    
+    def add(self, code, user_id):
+        """Record a committed code; returns False if the budget is exhausted"""
+        key = pack_referral_code(code)
+        with self._lock:
+            self._negative.pop(code, None)
+            if self.memory_bytes() + self.DICT_ENTRY_BYTES > self.max_bytes:
+                self.complete = False
+                return False
+            
+            if key is None:
+                self._unpacked[code] = user_id
+            else:
+                self._codes.add(key, user_id)
+            return True
+    
+    def add_missing(self, code):
+        """Remember that SQLite has no such code"""
+        with self._lock:
+            self._remember_missing(code)
+    
+    def _remember_missing(self, code):
+        self._negative[code] = time.monotonic() + self.negative_ttl
+        self._negative.move_to_end(code)
+        while len(self._negative) > self.negative_size:
+            self._negative.popitem(last=False)
+    
+    def stats(self):
+        """Return size and hit counters for the admin panel"""
+        with self._lock:
+            return {
+                'codes': len(self),
+                'memory_bytes': self.memory_bytes(),
+                'max_bytes': self.max_bytes,
+                'complete': self.complete,
+                'hits': self.hits,
+                'misses': self.misses,
+                'negative_hits': self.negative_hits,
+                'negative_size': len(self._negative),
+                'fallbacks': self.fallbacks,
+                'merges': self.merges
+            }
+
+def parse_sqlite_timestamp(text):
+    """Convert a CURRENT_TIMESTAMP value (UTC text) to a Unix timestamp"""
+    return datetime.fromisoformat(text).replace(tzinfo=timezone.utc).timestamp()
+
+class ReferralGraph:
+    """In-memory referral forest for downline, chain and burst reports
+    
+    Per-user fields are flat arrays indexed by node number; all access
+    holds `_lock`.
+    """
+    
+    NONE = -1
+    DICT_ENTRY_BYTES = PackedSortedMap.DICT_ENTRY_BYTES
+    
+    def __init__(self, top_size=REFERRAL_GRAPH_TOP_SIZE, burst_history=REFERRAL_BURST_HISTORY):
+        self.top_size = top_size
+        self.burst_history = burst_history
+        self._lock = threading.Lock()
+        self._clear()
+    
+    def _clear(self):
+        self.referrals = 0
+        self.ignored = 0
+        self.max_depth = 0
+        self._nodes = PackedSortedMap('i')
+        self._user_ids = array('Q')
+        self._parent = array('i')
+        self._first_child = array('i')
+        self._next_sibling = array('i')
+        self._direct = array('I')
+        self._downline = array('I')
+        self._depth = array('I')
+        self._boards = {'direct': {}, 'downline': {}}
+        self._floors = {'direct': 0, 'downline': 0}
+        self._events = deque()
+    
+    def __len__(self):
+        return len(self._user_ids)
+    
+    def memory_bytes(self):
+        """Estimated memory held by the graph"""
+        arrays = (
+            self._user_ids, self._parent, self._first_child,
+            self._next_sibling, self._direct, self._downline, self._depth
+        )
+        return (
+            sum(values.itemsize * len(values) for values in arrays)
+            + self._nodes.memory_bytes() + self.DICT_ENTRY_BYTES * len(self._events)
+        )
+    
+    def _node(self, user_id):
+        """Return the node for a user, adding it if needed (caller holds the lock)"""
+        node = self._nodes.get(user_id)
+        if node is not None:
+            return node
+        
+        node = len(self._user_ids)
+        self._user_ids.append(user_id)
+        for values in (self._parent, self._first_child, self._next_sibling):
+            values.append(self.NONE)
+        for values in (self._direct, self._downline, self._depth):
+            values.append(0)
+        self._nodes.add(user_id, node)
+        return node
+    
+    def _link(self, parent, child):
+        """Attach child under parent; False for repeats and cycles"""
+        if self._parent[child] != self.NONE or self._in_upline(self._parent, parent, child):
+            return False
+        
+        self._parent[child] = parent
+        self._next_sibling[child] = self._first_child[parent]
+        self._first_child[parent] = child
+        self._direct[parent] += 1
+        return True
+    
+    def _walk(self, node):
+        """Yield node and its downline, parents before their referrals"""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            child = self._first_child[node]
+            while child != self.NONE:
+                stack.append(child)
+                child = self._next_sibling[child]
+    
+    def _offer(self, board_name, node, value):
+        """Keep node on a leaderboard if value makes the cut (caller holds the lock)"""
+        board = self._boards[board_name]
+        if node in board or len(board) < self.top_size:
+            board[node] = value
+            return
+        if value <= self._floors[board_name]:
+            return
+        lowest = min(board, key=board.get)
+        if value > board[lowest]:
+            del board[lowest]
+            board[node] = value
+        self._floors[board_name] = min(board.values())
+    
+    def _record(self, timestamp, referrer_id):
+        self._events.append((timestamp, referrer_id))
+        while self._events[0][0] < timestamp - self.burst_history:
+            self._events.popleft()
+    
+    def warm(self, rows, now=None):
+        """Build the graph from (referrer_id, referred_id, created_at) rows in referral order
+        
+        Replaces the contents; returns the number of referrals linked.
+        """
+        now = time.time() if now is None else now
+        cutoff = datetime.fromtimestamp(now - self.burst_history, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        nodes, user_ids, parents, direct = {}, array('Q'), array('i'), array('I')
+        events = deque()
+        referrals = ignored = 0
+        # Referrers normally join the graph before their referrals do
+        ordered = True
+        
+        for referrer_id, referred_id, created_at in rows:
+            parent = nodes.get(referrer_id)
+            if parent is None:
+                parent = nodes[referrer_id] = len(user_ids)
+                user_ids.append(referrer_id)
+                parents.append(self.NONE)
+                direct.append(0)
+            child = nodes.get(referred_id)
+            if child is None:
+                child = nodes[referred_id] = len(user_ids)
+                user_ids.append(referred_id)
+                parents.append(self.NONE)
+                direct.append(0)
+            else:
+                # Only a user who already has referrals can be in the upline
+                if child == parent or parents[child] != self.NONE or (
+                        direct[child] and self._in_upline(parents, parent, child)):
+                    ignored += 1
+                    continue
+                ordered = ordered and child > parent
+            
+            parents[child] = parent
+            direct[parent] += 1
+            referrals += 1
+            if created_at and created_at >= cutoff:
+                events.append((parse_sqlite_timestamp(created_at), referrer_id))
+        
+        count = len(user_ids)
+        first_child = array('i', [self.NONE]) * count
+        next_sibling = array('i', [self.NONE]) * count
+        downline = array('I', [0]) * count
+        depth = array('I', [0]) * count
+        order = range(count) if ordered else array('i')
+        for node in range(count):
+            parent = parents[node]
+            if parent != self.NONE:
+                next_sibling[node] = first_child[parent]
+                first_child[parent] = node
+        
+        if not ordered:
+            # Walk every tree so parents still come before their referrals
+            for root in range(count):
+                if parents[root] == self.NONE:
+                    stack = [root]
+                    while stack:
+                        node = stack.pop()
+                        order.append(node)
+                        child = first_child[node]
+                        while child != self.NONE:
+                            stack.append(child)
+                            child = next_sibling[child]
+        
+        # Depths top-down, then downline sizes bottom-up
+        for node in order:
+            parent = parents[node]
+            if parent != self.NONE:
+                depth[node] = depth[parent] + 1
+        for node in reversed(order):
+            parent = parents[node]
+            if parent != self.NONE:
+                downline[parent] += downline[node] + 1
+        
+        boards = {}
+        for board_name, values in (('direct', direct), ('downline', downline)):
+            leaders = heapq.nlargest(self.top_size, range(count), key=values.__getitem__)
+            boards[board_name] = {node: values[node] for node in leaders if values[node]}
+        keys = array('Q', sorted(nodes))
+        key_nodes = array('i', map(nodes.__getitem__, keys))
+        
+        with self._lock:
+            self._clear()
+            self._nodes.load(keys, key_nodes)
+            self._user_ids, self._parent, self._direct = user_ids, parents, direct
+            self._first_child, self._next_sibling = first_child, next_sibling
+            self._downline, self._depth = downline, depth
+            self._boards = boards
+            self._floors = {board_name: min(board.values(), default=0) for board_name, board in boards.items()}
+            self._events = events
+            self.referrals, self.ignored = referrals, ignored
+            self.max_depth = max(depth, default=0)
+        return referrals
+    
+    def _in_upline(self, parents, node, user):
+        """Whether user is node or one of its referrers"""
+        while node != self.NONE:
+            if node == user:
+                return True
+            node = parents[node]
+        return False
+    
+    def add(self, referrer_id, referred_id, timestamp=None):
+        """Record a committed referral; returns False if it was already known or would form a cycle"""
+        with self._lock:
+            parent = self._node(referrer_id)
+            child = self._node(referred_id)
+            if not self._link(parent, child):
+                self.ignored += 1
+                return False
+            self.referrals += 1
+            self._offer('direct', parent, self._direct[parent])
+            
+            # A user with earlier referrals moves their whole downline down
+            for node in self._walk(child):
+                self._depth[node] = self._depth[self._parent[node]] + 1
+                self.max_depth = max(self.max_depth, self._depth[node])
+            
+            added = self._downline[child] + 1
+            node = parent
+            while node != self.NONE:
+                self._downline[node] += added
+                self._offer('downline', node, self._downline[node])
+                node = self._parent[node]
+            
+            self._record(time.time() if timestamp is None else timestamp, referrer_id)
+            return True
+    
+    def top(self, board_name, limit=10):
+        """Return the leaders by 'direct' referrals or 'downline' size as (user_id, direct, downline)"""
+        with self._lock:
+            board = self._boards[board_name]
+            leaders = sorted(board, key=lambda node: (-board[node], self._user_ids[node]))[:limit]
+            return [(self._user_ids[node], self._direct[node], self._downline[node]) for node in leaders]
+    
+    def profile(self, user_id, max_depth=REFERRAL_GRAPH_MAX_DEPTH, max_walk=REFERRAL_GRAPH_MAX_WALK):
+        """Return a user's place in the graph, or None if they never referred or were referred
+        
+        `levels` counts the downline per level, walking at most `max_walk`
+        members; `cluster` is the size of the whole tree the user is in.
+        """
+        with self._lock:
+            node = self._nodes.get(user_id)
+            if node is None:
+                return None
+            
+            upline = []
+            root = self._parent[node]
+            while root != self.NONE and len(upline) < max_depth:
+                upline.append(self._user_ids[root])
+                root = self._parent[root]
+            root = node
+            while self._parent[root] != self.NONE:
+                root = self._parent[root]
+            
+            levels = []
+            frontier = [node]
+            walked = 0
+            while frontier and walked < max_walk:
+                below = []
+                for member in frontier:
+                    child = self._first_child[member]
+                    while child != self.NONE:
+                        below.append(child)
+                        child = self._next_sibling[child]
+                if not below:
+                    break
+                levels.append(len(below))
+                walked += len(below)
+                frontier = below
+            
+            return {
+                'user_id': user_id,
+                'upline': upline,
+                'depth': self._depth[node],
+                'direct': self._direct[node],
+                'downline': self._downline[node],
+                'levels': levels,
+                'levels_complete': walked == self._downline[node],
+                'cluster_root': self._user_ids[root],
+                'cluster': self._downline[root] + 1
+            }
+    
+    def bursts(self, window=REFERRAL_BURST_WINDOW, threshold=REFERRAL_BURST_THRESHOLD, limit=10):
+        """Find referrers with at least `threshold` referrals inside any `window` seconds
+        
+        Slides the window over the kept history once. Returns the busiest
+        referrers as (user_id, referrals, window end timestamp), busiest first.
+        """
+        with self._lock:
+            events = list(self._events)
+        
+        counts = {}
+        busiest = {}
+        start = 0
+        for timestamp, referrer_id in events:
+            counts[referrer_id] = counts.get(referrer_id, 0) + 1
+            while events[start][0] <= timestamp - window:
+                counts[events[start][1]] -= 1
+                start += 1
+            count = counts[referrer_id]
+            if count >= threshold and count > busiest.get(referrer_id, (0,))[0]:
+                busiest[referrer_id] = (count, timestamp)
+        
+        ranked = sorted(busiest.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        return [(user_id, count, ended) for user_id, (count, ended) in ranked]
+    
+    def stats(self):
+        """Return size counters for the admin panel"""
+        with self._lock:
+            return {
+                'users': len(self),
+                'referrals': self.referrals,
+                'ignored': self.ignored,
+                'max_depth': self.max_depth,
+                'recent_referrals': len(self._events),
+                'memory_bytes': self.memory_bytes()
+            }
+
+def open_connection(db_path):
+    """Open a long-lived connection with the tuned pragmas applied"""
+    conn = sqlite3.connect(
+        db_path,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE
+    )
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+class LatencyHistogram:
+    """Latency counts in fixed buckets, cheap enough to update on every call
+    
+    Not locked; callers observing from several threads hold their own lock.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+    
+    def stats(self):
+        return {
+            'count': self.count,
+            'average': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'max': self.max,
+            'buckets': dict(zip(self.buckets + (float('inf'),), self.counts))
+        }
+
+class Metrics:
+    """Process-wide counters and latency histograms, rendered for Prometheus
+    
+    Safe to update from the event loop and the DB threads alike. Values
+    owned by other objects (lock waits, cache hits, ...) are pulled in at
+    scrape time by collectors registered with add_collector().
+    """
+    
+    def __init__(self, namespace="earnyha"):
+        self.namespace = namespace
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+    
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.observe(seconds)
+    
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the with-block in histogram `name`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def add_collector(self, collector):
+        """Register collector() -> iterable of (name, kind, help, [(labels, value)])
+        
+        A value may be a number or a LatencyHistogram.
+        """
+        self._collectors.append(collector)
+    
+    def _families(self):
+        families = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                families.setdefault(name, []).append((dict(labels), value))
+            for (name, labels), histogram in self._histograms.items():
+                families.setdefault(name, []).append((dict(labels), histogram))
+        described = {name: self._help.get(name, (None, '')) for name in families}
+        for collector in self._collectors:
+            try:
+                for name, kind, help_text, samples in collector():
+                    families.setdefault(name, []).extend(samples)
+                    described[name] = (kind, help_text)
+            except Exception as e:
+                logger.error(f"Metrics collector {collector.__name__} failed: {e}")
+        return families, described
+    
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        families, described = self._families()
+        lines = []
+        for name in sorted(families):
+            full_name = f"{self.namespace}_{name}"
+            kind, help_text = described[name]
+            samples = families[name]
+            if kind is None:
+                kind = 'histogram' if isinstance(samples[0][1], LatencyHistogram) else 'counter'
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in samples:
+                if isinstance(value, LatencyHistogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{full_name}_bucket{format_labels(labels, le=le)} {cumulative}")
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {value.total}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{full_name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels, **extra):
+    """Render a Prometheus label set, e.g. {handler="start"}"""
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+metrics = Metrics()
+metrics.describe('updates_total', 'counter', "Updates received, by update type")
+metrics.describe('handler_seconds', 'histogram', "Time spent in each handler")
+metrics.describe('handler_errors_total', 'counter', "Handler calls that raised, by handler")
+metrics.describe('errors_total', 'counter', "Errors passed to the error handler, by exception type")
+metrics.describe('db_call_seconds', 'histogram', "Time spent in each DatabaseManager method on a DB thread")
+
+class LockWaits:
+    """Counts write transactions that had to wait for SQLite's write lock
+    
+    An uncontended BEGIN IMMEDIATE takes microseconds; one that blocks in
+    the busy handler sleeps for at least a millisecond, so its duration
+    tells us whether another writer held the lock.
+    """
+    
+    def __init__(self, threshold=DB_LOCK_WAIT_THRESHOLD):
+        self.threshold = threshold
+        self.begins = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+    
+    def begin_immediate(self, conn):
+        """Start a write transaction on conn, recording any lock wait"""
+        started = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            # Gave up after the busy timeout ("database is locked")
+            if 'locked' in str(e) or 'busy' in str(e):
+                with self._lock:
+                    self.timeouts += 1
+            raise
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.begins += 1
+            if waited >= self.threshold:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait = max(self.max_wait, waited)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'begins': self.begins,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'max_wait': self.max_wait,
+                'timeouts': self.timeouts
+            }
+    
+    def reset(self):
+        with self._lock:
+            self.begins = self.waits = self.timeouts = 0
+            self.wait_seconds = self.max_wait = 0.0
+
+lock_waits = LockWaits()
+
+class ConnectionPool:
+    """Fixed-size pool of long-lived SQLite connections in WAL mode"""
+    
+    def __init__(self, db_path, size=DB_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = open_connection(self.db_path)
+                self._all.append(conn)
+                return conn
+        
+        return self._idle.get()
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; nested calls on the same thread share it"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            # Never hand an open transaction to the next borrower
+            if conn.in_transaction:
+                conn.rollback()
+            self._local.conn = None
+            self._idle.put(conn)
+    
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+        self._idle = queue.LifoQueue()
+
+class GroupCommitWriter:
+    """Background writer that commits queued write operations in batches
+    
+    Each op runs in its own savepoint; futures resolve only after the
+    batch has committed.
+    """
+    
+    def __init__(self, db_path, flush_interval=GROUP_COMMIT_INTERVAL, batch_size=GROUP_COMMIT_BATCH_SIZE):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.batches = 0
+        self.operations = 0
+        self.failed_batches = 0
+        self.largest_batch = 0
+        self.commit_seconds = 0.0
+        self._last_batch = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-group-commit", daemon=True)
+        self._thread.start()
+    
+    def submit(self, op, *args):
+        """Queue op(cursor, *args) for the next batch"""
+        future = Future()
+        self._queue.put((future, op, args))
+        return future
+    
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + (self.flush_interval if self._last_batch > 1 else 0)
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Flush what we have, then let _run see the stop marker
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+    
+    def _run(self):
+        conn = open_connection(self.db_path)
+        try:
+            while True:
+                first = self._queue.get()
+                if first is None:
+                    return
+                batch = self._collect(first)
+                self._last_batch = len(batch)
+                self._flush(conn, batch)
+        finally:
+            conn.close()
+    
+    def _flush(self, conn, batch):
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            lock_waits.begin_immediate(conn)
+            cursor = conn.cursor()
+            for future, op, args in batch:
+                cursor.execute('SAVEPOINT write_op')
+                try:
+                    outcomes.append((future, op(cursor, *args), None))
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_op')
+                    outcomes.append((future, None, e))
+                cursor.execute('RELEASE write_op')
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            self.failed_batches += 1
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            for future, op, args in batch:
+                future.set_exception(e)
+            return
+        
+        self.batches += 1
+        self.operations += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.commit_seconds += time.perf_counter() - started
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    def stats(self):
+        """Return batching metrics for the admin panel"""
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'operations': self.operations,
+            'failed_batches': self.failed_batches,
+            'largest_batch': self.largest_batch,
+            'average_batch': self.operations / self.batches if self.batches else 0.0,
+            'average_commit_ms': self.commit_seconds * 1000 / self.batches if self.batches else 0.0,
+            'flush_interval_ms': self.flush_interval * 1000,
+            'batch_size': self.batch_size
+        }
+    
+    def close(self):
+        """Flush queued writes and stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+class Storage:
+    """Where DatabaseManager keeps its tables: one or more SQLite shards
+    
+    A user lives on shard user_id % shard_count, together with the
+    referrals credited to them, their withdrawals and their ledger entries,
+    so every write for one user touches one shard. Subclasses provide
+    `mode`, `paths`, `shards`, `shard_count`, `writers` and connection(shard).
+    """
+    
+    writers = ()
+    
+    def shard_of(self, user_id):
+        return user_id % self.shard_count
+    
+    def foreign_files(self):
+        """Existing database files of the other file layout at the same path"""
+        return []
+    
+    def private_connection(self, shard=0):
+        """A connection for long jobs such as backups, kept out of the pool"""
+        return self.connection(shard)
+    
+    @contextmanager
+    def transaction(self, shard=0):
+        """Run a write transaction that takes the write lock up front
+        
+        BEGIN IMMEDIATE makes concurrent writers queue on the busy timeout
+        instead of failing with "database is locked" on lock upgrade.
+        """
+        with self.connection(shard) as conn:
+            lock_waits.begin_immediate(conn)
+            try:
+                yield conn.cursor()
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    
+    def write(self, shard, op, *args):
+        """Run op(cursor, *args) in a write transaction on a shard and return its result
+        
+        With group commit the op joins the shard writer's next batch and
+        this call blocks until that batch has committed.
+        """
+        if self.writers:
+            return self.writers[shard].submit(op, *args).result()
+        
+        with self.transaction(shard) as cursor:
+            return op(cursor, *args)
+
+class FileStorage(Storage):
+    """SQLite files, one per shard
+    
+    Each shard has its own connection pool and, with group commit, its own
+    writer thread.
+    """
+    
+    def __init__(self, paths, pooled=False, pool_size=DB_POOL_SIZE, group_commit=False,
+                 flush_interval=GROUP_COMMIT_INTERVAL, batch_size=GROUP_COMMIT_BATCH_SIZE):
+        self.paths = list(paths)
+        self.shard_count = len(self.paths)
+        self.shards = range(self.shard_count)
+        self.pools = [ConnectionPool(path, pool_size) for path in self.paths] if pooled else None
+        self.writers = [
+            GroupCommitWriter(path, flush_interval, batch_size) for path in self.paths
+        ] if group_commit else []
+    
+    @contextmanager
+    def connection(self, shard=0):
+        """Yield a connection from the shard's pool, or a fresh one in per-call mode"""
+        if self.pools:
+            with self.pools[shard].connection() as conn:
+                yield conn
+            return
+        
+        conn = sqlite3.connect(self.paths[shard])
+        try:
+            yield conn
+        finally:
+            conn.close()
+    
+    @contextmanager
+    def private_connection(self, shard=0):
+        conn = open_connection(self.paths[shard])
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def close(self):
+        """Flush pending writes and release pooled connections"""
+        for writer in self.writers:
+            writer.close()
+        for pool in self.pools or ():
+            pool.close()
+
+class SingleFileStorage(FileStorage):
+    """Everything in one SQLite file"""
+    
+    mode = 'file'
+    
+    def __init__(self, db_path=DB_PATH, **options):
+        super().__init__([db_path], **options)
+    
+    def foreign_files(self):
+        base, extension = os.path.splitext(self.paths[0])
+        return sorted(glob.glob(f"{glob.escape(base)}.shard[0-9]*{glob.escape(extension)}"))
+
+def shard_paths(db_path, shards):
+    """File names for each shard, e.g. earnyha_bot.db -> earnyha_bot.shard0.db"""
+    base, extension = os.path.splitext(db_path)
+    return [f"{base}.shard{shard}{extension}" for shard in range(shards)]
+
+class ShardedStorage(FileStorage):
+    """Users partitioned by user_id across `shards` SQLite files
+    
+    Shards take their write locks independently, so writes for users on
+    different shards commit in parallel.
+    """
+    
+    mode = 'sharded'
+    
+    def __init__(self, db_path=DB_PATH, shards=DB_SHARDS, **options):
+        super().__init__(shard_paths(db_path, shards), **options)
         self.db_path = db_path
+    
+    def foreign_files(self):
+        return [self.db_path] if os.path.exists(self.db_path) else []
+
+class MemoryStorage(Storage):
+    """In-memory SQLite databases for tests and benchmarks
+    
+    Each shard is a single private connection shared by all threads and
+    serialized by a lock, so nothing touches the disk. Group commit is not
+    supported.
+    """
+    
+    mode = 'memory'
+    
+    def __init__(self, shards=1):
+        self.paths = []
+        self.shard_count = shards
+        self.shards = range(shards)
+        self._connections = [sqlite3.connect(':memory:', check_same_thread=False) for _ in self.shards]
+        self._locks = [threading.RLock() for _ in self.shards]
+        self._depths = [0] * shards
+    
+    @contextmanager
+    def connection(self, shard=0):
+        """Yield the shard's connection; other threads wait until the outermost block ends"""
+        with self._locks[shard]:
+            conn = self._connections[shard]
+            self._depths[shard] += 1
+            try:
+                yield conn
+            finally:
+                self._depths[shard] -= 1
+                # Never hand an open transaction to the next thread
+                if not self._depths[shard] and conn.in_transaction:
+                    conn.rollback()
+    
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+
+def open_storage(kind=DB_STORAGE, db_path=DB_PATH, **options):
+    """Create the storage engine named by DB_STORAGE: 'file', 'sharded' or 'memory'"""
+    if kind == 'file':
+        return SingleFileStorage(db_path, **options)
+    if kind == 'sharded':
+        return ShardedStorage(db_path, DB_SHARDS, **options)
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Unknown DB_STORAGE {kind!r}; use 'file', 'sharded' or 'memory'")
+
+BACKUP_PREFIX = "earnyha-"
+
+def list_backups(directory=BACKUP_DIR):
+    """Return (path, manifest) for every complete backup, newest first"""
+    if not os.path.isdir(directory):
+        return []
+    
+    backups = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        path = os.path.join(directory, name)
+        manifest_path = os.path.join(path, 'manifest.json')
+        if name.startswith(BACKUP_PREFIX) and os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                backups.append((path, json.load(f)))
+    return backups
+
+def find_backup(name, directory=BACKUP_DIR):
+    """Resolve 'latest', a backup name or a path to a backup directory"""
+    if name == 'latest':
+        backups = list_backups(directory)
+        if not backups:
+            raise FileNotFoundError(f"No backups in {directory}")
+        return backups[0][0]
+    for path in (name, os.path.join(directory, name)):
+        if os.path.isfile(os.path.join(path, 'manifest.json')):
+            return path
+    raise FileNotFoundError(f"No backup named {name!r}")
+
+def prune_backups(directory=BACKUP_DIR, retention=BACKUP_RETENTION, partial_max_age=BACKUP_PARTIAL_MAX_AGE):
+    """Delete all but the newest `retention` backups, and abandoned unfinished ones
+    
+    An unfinished (.partial) directory is only deleted once nothing in it
+    has changed for `partial_max_age` seconds: a younger one may still be
+    written by another process, e.g. `python EarnyHa.py backup`.
+    Returns the number of backups deleted.
+    """
+    if retention < 1:
+        raise ValueError(f"backup retention must be at least 1, not {retention}")
+    keep = {path for path, _ in list_backups(directory)[:retention]}
+    pruned = 0
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.startswith(BACKUP_PREFIX) or not os.path.isdir(path) or path in keep:
+            continue
+        if name.endswith('.partial'):
+            changed = max([os.path.getmtime(path)] + [entry.stat().st_mtime for entry in os.scandir(path)])
+            if now - changed < partial_max_age:
+                continue
+        shutil.rmtree(path)
+        pruned += 1
+    return pruned
+
+class BackupInProgress(Exception):
+    """Raised when a backup is requested while this process is still taking one"""
+
+class StorageLayoutMismatch(Exception):
+    """Raised when the database files were created for another DB_STORAGE or DB_SHARDS"""
+
+class InsufficientBalance(Exception):
+    """Raised when a withdrawal exceeds the balance at the time of the debit"""
+    
+    def __init__(self, balance):
+        super().__init__(f"balance is {balance:.2f}")
+        self.balance = balance
+
+class DatabaseManager:
+    # Methods that write; with group commit they mostly wait on a batch
+    WRITE_METHODS = frozenset({
+        'add_user', 'add_referral_bonus', 'create_withdrawal_request', 'process_withdrawals',
+        'settle_referral_credits', 'reconcile_stats', 'verify_ledger'
+    })
+    # Write methods backed by a _<name>_plan generator, see _run_plan()
+    WRITE_PLANS = frozenset({'add_user', 'add_referral_bonus', 'create_withdrawal_request'})
+    
+    def __init__(self, db_path=DB_PATH, pooled=False, pool_size=DB_POOL_SIZE, user_cache=None,
+                 group_commit=False, flush_interval=GROUP_COMMIT_INTERVAL, batch_size=GROUP_COMMIT_BATCH_SIZE,
+                 referral_index=None, referral_graph=None, storage=None):
+        if storage is None:
+            storage = SingleFileStorage(
+                db_path, pooled=pooled, pool_size=pool_size, group_commit=group_commit,
+                flush_interval=flush_interval, batch_size=batch_size
+            )
+        self.storage = storage
+        self.user_cache = user_cache
+        self.last_backup = None
+        self._backup_lock = threading.Lock()
+        self.referral_index = referral_index
+        self.referral_graph = referral_graph
         self.init_database()
+        if storage.shard_count > 1:
+            self.settle_referral_credits()
+        if referral_index is not None:
+            self.warm_referral_index()
+        if referral_graph is not None:
+            self.warm_referral_graph()
+    
+    def _connection(self, shard=0):
+        return self.storage.connection(shard)
+    
+    def _write(self, shard, op, *args):
+        return self.storage.write(shard, op, *args)
+    
+    def _shard(self, user_id):
+        return self.storage.shard_of(user_id)
+    
+    def _chunked_in_query(self, shard, sql, values):
+        """Yield the rows of `sql` with its `{}` filled by placeholders for `values`
+        
+        Values are bound at most SQL_MAX_VARIABLES per query.
+        """
+        with self._connection(shard) as conn:
+            for start in range(0, len(values), SQL_MAX_VARIABLES):
+                chunk = values[start:start + SQL_MAX_VARIABLES]
+                yield from conn.execute(sql.format(", ".join("?" * len(chunk))), chunk)
+    
+    def _run_plan(self, plan):
+        """Run a write plan and return its result
+        
+        A plan is a generator that yields (shard, op, args) for each write
+        and gets op's result back, or its exception raised at the yield;
+        between writes it only touches in-memory state. That lets
+        AsyncDatabaseManager drive the same plan on the event loop.
+        """
+        try:
+            shard, op, args = next(plan)
+            while True:
+                try:
+                    result = self._write(shard, op, *args)
+                except Exception as e:
+                    shard, op, args = plan.throw(e)
+                else:
+                    shard, op, args = plan.send(result)
+        except StopIteration as done:
+            return done.value
+    
+    @contextmanager
+    def _across_shards(self, sql, params=(), key=None, reverse=False):
+        """Yield the rows of a query run on every shard
+        
+        With `key`, each shard's rows must already be sorted by it and are
+        merged into one sorted stream; otherwise shards follow each other.
+        """
+        with ExitStack() as stack:
+            cursors = [
+                stack.enter_context(self._connection(shard)).execute(sql, params) for shard in self.storage.shards
+            ]
+            if len(cursors) == 1:
+                yield cursors[0]
+            elif key is not None:
+                yield heapq.merge(*cursors, key=key, reverse=reverse)
+            else:
+                yield itertools.chain(*cursors)
+    
+    def _invalidate(self, *user_ids):
+        """Drop cached records for users changed by a committed write"""
+        if self.user_cache:
+            self.user_cache.invalidate(*user_ids)
+    
+    def close(self):
+        """Flush pending writes and release pooled connections"""
+        self.storage.close()
     
     def init_database(self):
-        """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Bring every shard's schema up to the latest migration"""
+        for shard in self.storage.shards:
+            with self._connection(shard) as conn:
+                self._migrate(conn)
+        self._check_layout()
+    
+    def _check_layout(self):
+        """Record the storage layout in new shards; refuse files made for another one
         
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                referral_code TEXT UNIQUE,
-                referred_by INTEGER,
-                balance REAL DEFAULT 0.0,
-                total_earned REAL DEFAULT 0.0,
-                total_referrals INTEGER DEFAULT 0,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT 1
+        Users are placed by user_id % shard_count, so opening shards with a
+        different count or mode would hide existing users and let them sign
+        up again.
+        """
+        storage = self.storage
+        recorded = []
+        for shard in storage.shards:
+            with self._connection(shard) as conn:
+                recorded.append(conn.execute('SELECT mode, shard, shard_count FROM storage_layout').fetchone())
+        
+        for shard, layout in enumerate(recorded):
+            if layout is not None and tuple(layout) != (storage.mode, shard, storage.shard_count):
+                raise StorageLayoutMismatch(
+                    f"shard {shard} was created as shard {layout[1]} of {layout[2]} in {layout[0]!r} storage, "
+                    f"not of {storage.shard_count} in {storage.mode!r}; set DB_STORAGE and DB_SHARDS to match"
+                )
+        
+        if None in recorded:
+            foreign = storage.foreign_files()
+            if foreign:
+                raise StorageLayoutMismatch(
+                    f"new {storage.mode!r} database files next to existing ones of another layout: "
+                    f"{', '.join(foreign)}; set DB_STORAGE to match or move them away"
+                )
+            for shard, layout in enumerate(recorded):
+                if layout is None:
+                    self._write(shard, lambda cursor, shard=shard: cursor.execute(
+                        'INSERT OR IGNORE INTO storage_layout (id, mode, shard, shard_count) VALUES (1, ?, ?, ?)',
+                        (storage.mode, shard, storage.shard_count)
+                    ))
+    
+    def _migrate(self, conn):
+        """Apply any pending migrations to one database file"""
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        # Referrals table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS referrals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER,
-                referred_id INTEGER,
-                bonus_amount REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (referrer_id) REFERENCES users (user_id),
-                FOREIGN KEY (referred_id) REFERENCES users (user_id)
+        # Which storage this file is part of, see _check_layout()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS storage_layout (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                mode TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                shard_count INTEGER NOT NULL
             )
         ''')
+        conn.commit()
         
-        # Withdrawals table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS withdrawals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount REAL,
-                status TEXT DEFAULT 'pending',
-                payment_method TEXT,
-                payment_details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                processed_at TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+        # Applied by version, whatever order the list is in
+        for version, description, steps in sorted(MIGRATIONS, key=lambda migration: migration[0]):
+            lock_waits.begin_immediate(conn)
+            try:
+                # Another process may have applied it while we waited for the lock
+                applied = conn.execute(
+                    'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+                ).fetchone()
+                if applied:
+                    conn.rollback()
+                    continue
+                
+                cursor = conn.cursor()
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            logger.info(f"Applied schema migration {version}: {description}")
+    
+    def get_schema_version(self):
+        """Return the latest migration version applied to every shard"""
+        versions = []
+        for shard in self.storage.shards:
+            with self._connection(shard) as conn:
+                versions.append(conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0])
+        return min(versions)
+    
+    def explain_query_plan(self, sql, params=()):
+        """Return the EXPLAIN QUERY PLAN detail lines for a query on the first shard"""
+        with self._connection() as conn:
+            return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+    
+    def backup(self, directory=BACKUP_DIR, retention=BACKUP_RETENTION):
+        """Write a consistent copy of every shard to a new backup directory while the bot runs
+        
+        Each shard is copied in one backup API call, which holds off WAL
+        checkpoints until it ends. Raises BackupInProgress while another
+        backup is running. Returns a summary dict.
+        """
+        if retention < 1:
+            raise ValueError(f"backup retention must be at least 1, not {retention}")
+        if not self._backup_lock.acquire(blocking=False):
+            raise BackupInProgress("a backup is already running")
+        try:
+            return self._take_backup(directory, retention)
+        finally:
+            self._backup_lock.release()
+    
+    def _take_backup(self, directory, retention):
+        started = time.perf_counter()
+        created = datetime.now(timezone.utc)
+        name = f"{BACKUP_PREFIX}{created:%Y%m%d-%H%M%S-%f}"
+        path = os.path.join(directory, name)
+        partial = f"{path}.partial"
+        os.makedirs(partial)
+        
+        files, versions, size = [], [], 0
+        for shard in self.storage.shards:
+            filename = os.path.basename(self.storage.paths[shard]) if self.storage.paths else f"shard{shard}.db"
+            target = sqlite3.connect(os.path.join(partial, filename))
+            try:
+                with self.storage.private_connection(shard) as source:
+                    source.backup(target)
+                check = target.execute('PRAGMA quick_check').fetchone()[0]
+                # Read from the copy, not the pool, which busy writers may hold for a while
+                versions.append(target.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0])
+            finally:
+                target.close()
+            if check != 'ok':
+                raise sqlite3.DatabaseError(f"backup of shard {shard} failed quick_check: {check}")
+            files.append(filename)
+            size += os.path.getsize(os.path.join(partial, filename))
+        
+        manifest = {
+            'created': created.isoformat(),
+            'schema_version': min(versions),
+            'shards': self.storage.shard_count,
+            'files': files,
+            'hot_users': self.user_cache.user_ids() if self.user_cache else []
+        }
+        with open(os.path.join(partial, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        os.replace(partial, path)
+        
+        result = {
+            'name': name, 'path': path, 'bytes': size,
+            'pruned': prune_backups(directory, retention), 'seconds': time.perf_counter() - started
+        }
+        self.last_backup = {'created': created.timestamp(), **result}
+        logger.info(
+            f"Backed up {len(files)} database file(s) to {path} ({size / 1024 / 1024:.1f} MiB) in "
+            f"{result['seconds']:.1f}s; pruned {result['pruned']}"
+        )
+        return result
+    
+    def restore(self, path):
+        """Replace every shard with a backup made by backup(), then warm the caches
+        
+        Run this before handling updates: it overwrites the live databases
+        through SQLite's backup API, so open pooled connections see the
+        restored data. Returns a summary dict.
+        """
+        started = time.perf_counter()
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['shards'] != self.storage.shard_count:
+            raise ValueError(
+                f"backup has {manifest['shards']} shard(s) but the storage has {self.storage.shard_count}"
             )
-        ''')
         
-        conn.commit()
-        conn.close()
+        for shard, filename in enumerate(manifest['files']):
+            source = sqlite3.connect(os.path.join(path, filename))
+            try:
+                with self.storage.private_connection(shard) as target:
+                    source.backup(target)
+            finally:
+                source.close()
+        
+        # The backup may predate later migrations or hold unsettled credits
+        self.init_database()
+        if self.storage.shard_count > 1:
+            self.settle_referral_credits()
+        if self.user_cache:
+            self.user_cache.clear()
+        if self.referral_index is not None:
+            self.warm_referral_index()
+        if self.referral_graph is not None:
+            self.warm_referral_graph()
+        warmed = self.warm_user_cache(manifest['hot_users'])
+        
+        logger.info(f"Restored {path} (taken {manifest['created']}) in {time.perf_counter() - started:.1f}s")
+        return {'created': manifest['created'], 'users_warmed': warmed, 'seconds': time.perf_counter() - started}
     
-    def add_user(self, user_id, username, first_name, last_name, referred_by=None):
-        """Add a new user to the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def warm_user_cache(self, user_ids):
+        """Load the given users into the user cache, hottest first
         
-        referral_code = str(uuid.uuid4())[:8].upper()
+        Returns the number of records cached.
+        """
+        if not self.user_cache:
+            return 0
+        
+        user_ids = list(user_ids)[:self.user_cache.max_size]
+        version = self.user_cache.version
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(self._shard(user_id), []).append(user_id)
+        
+        users = {}
+        for shard, ids in by_shard.items():
+            for row in self._chunked_in_query(shard, f'SELECT {USER_SELECT} FROM users WHERE user_id IN ({{}})', ids):
+                users[row[0]] = dict(zip(USER_COLUMNS, row))
+        
+        # Coldest first, so the hottest end up most recently used
+        for user_id in reversed(user_ids):
+            if user_id in users:
+                self.user_cache.put(user_id, users[user_id], version)
+        return len(users)
+    
+    def save_cache_snapshot(self, path=CACHE_SNAPSHOT_PATH):
+        """Record which users are hot in the cache, for warm_cache_snapshot() after a restart"""
+        if not self.user_cache:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.user_cache.user_ids(), f)
+    
+    def warm_cache_snapshot(self, path=CACHE_SNAPSHOT_PATH):
+        """Warm the user cache from save_cache_snapshot(); returns the users cached"""
+        if not self.user_cache or not os.path.isfile(path):
+            return 0
+        started = time.perf_counter()
+        with open(path) as f:
+            warmed = self.warm_user_cache(json.load(f))
+        logger.info(f"User cache warmed with {warmed} users in {time.perf_counter() - started:.2f}s")
+        return warmed
+
+    def add_user(self, user_id, username, first_name, last_name, referred_by=None):
+        """Add a new user and credit their referrer in a single transaction
         
+        A referrer on another shard is credited shortly afterwards by
+        settle_referral_credits(), so a signup is always one transaction.
+        Returns the new user record, or None if the user already exists.
+        """
+        return self._run_plan(self._add_user_plan(user_id, username, first_name, last_name, referred_by))
+    
+    def _add_user_plan(self, user_id, username, first_name, last_name, referred_by=None):
+        shard = self._shard(user_id)
+        local_referrer = not referred_by or self._shard(referred_by) == shard
         try:
-            cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name, referral_code, referred_by)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name, referral_code, referred_by))
+            user = yield shard, self._insert_user, (
+                user_id, username, first_name, last_name, referred_by, local_referrer
+            )
+        except sqlite3.IntegrityError:
+            return None
+        
+        # Added after commit; the code is only handed out in the reply to this signup
+        if self.referral_index is not None:
+            self.referral_index.add(user['referral_code'], user_id)
+        self._invalidate(user_id, referred_by)
+        if referred_by and self.referral_graph is not None:
+            self.referral_graph.add(referred_by, user_id)
+        return user
+    
+    def _insert_user(self, cursor, user_id, username, first_name, last_name, referred_by, local_referrer=True):
+        """Insert a user row, crediting the referrer on the same cursor
+        
+        A referrer on another shard cannot be credited in this transaction,
+        so the bonus is recorded in the referral_credits outbox instead.
+        """
+        referral_code = make_referral_code(user_id)
+        
+        cursor.execute(f'''
+            INSERT INTO users (user_id, username, first_name, last_name, referral_code, referred_by)
+            VALUES (?, ?, ?, ?, ?, ?)
+            RETURNING {USER_SELECT}
+        ''', (user_id, username, first_name, last_name, referral_code, referred_by))
+        user = dict(zip(USER_COLUMNS, cursor.fetchone()))
+        self._bump_stats(cursor, total_users=1)
+        
+        # If user was referred, add referral bonus
+        if referred_by and local_referrer:
+            self._credit_referral(cursor, referred_by, user_id)
+        elif referred_by:
+            cursor.execute(
+                'INSERT INTO referral_credits (referred_id, referrer_id) VALUES (?, ?)', (user_id, referred_by)
+            )
+        
+        return user
+    
+    def settle_referral_credits(self, batch_size=REFERRAL_CREDIT_BATCH_SIZE):
+        """Credit the bonuses queued in the referral_credits outbox by cross-shard signups
+        
+        Crediting skips referrals already recorded, so rows left by a failed
+        round are retried safely. Returns the number of bonuses credited.
+        """
+        credited = 0
+        while True:
+            owed = {}
+            for shard in self.storage.shards:
+                with self._connection(shard) as conn:
+                    rows = conn.execute(
+                        'SELECT referred_id, referrer_id FROM referral_credits ORDER BY referred_id LIMIT ?',
+                        (batch_size,)
+                    ).fetchall()
+                for referred_id, referrer_id in rows:
+                    owed.setdefault(self._shard(referrer_id), []).append((referred_id, referrer_id))
+            if not owed:
+                return credited
             
-            # If user was referred, add referral bonus
-            if referred_by:
-                self.add_referral_bonus(referred_by, user_id)
+            settled, failed = {}, False
+            for shard, referrals in owed.items():
+                try:
+                    credited_now = self._write(shard, self._credit_referrals_once, referrals)
+                except Exception as e:
+                    logger.error(f"Error crediting {len(referrals)} queued referral bonuses on shard {shard}: {e}")
+                    failed = True
+                    continue
+                credited += len(credited_now)
+                self._invalidate(*credited_now)
+                for referred_id, referrer_id in referrals:
+                    settled.setdefault(self._shard(referred_id), []).append(referred_id)
             
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
+            for shard, referred_ids in settled.items():
+                try:
+                    self._write(shard, self._clear_referral_credits, referred_ids)
+                except Exception as e:
+                    logger.error(f"Error clearing {len(referred_ids)} credited referral bonuses on shard {shard}: {e}")
+                    failed = True
+            if failed:
+                return credited
+    
+    def _credit_referrals_once(self, cursor, referrals):
+        """Credit (referred_id, referrer_id) pairs not already recorded; returns the referrers credited"""
+        return [
+            referrer_id for referred_id, referrer_id in referrals
+            if self._credit_referral_once(cursor, referrer_id, referred_id)
+        ]
+    
+    def _clear_referral_credits(self, cursor, referred_ids):
+        """Remove settled referrals from the outbox on the given cursor"""
+        cursor.executemany(
+            'DELETE FROM referral_credits WHERE referred_id = ?', ((referred_id,) for referred_id in referred_ids)
+        )
+    
+    def _credit_referral_once(self, cursor, referrer_id, referred_id):
+        """Credit a referral unless it has already been recorded"""
+        if cursor.execute(HOT_QUERIES['referral_of_user'][0], (referred_id,)).fetchone():
             return False
-        finally:
-            conn.close()
+        return self._credit_referral(cursor, referrer_id, referred_id)
     
     def get_user(self, user_id):
         """Get user information"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if self.user_cache:
+            cached = self.user_cache.get(user_id)
+            if cached is not None:
+                return cached
+            version = self.user_cache.version
         
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
+        with self._connection(self._shard(user_id)) as conn:
+            cursor = conn.execute(f'SELECT {USER_SELECT} FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
         
         if user:
-            return {
-                'user_id': user[0],
-                'username': user[1],
-                'first_name': user[2],
-                'last_name': user[3],
-                'referral_code': user[4],
-                'referred_by': user[5],
-                'balance': user[6],
-                'total_earned': user[7],
-                'total_referrals': user[8],
-                'join_date': user[9],
-                'is_active': user[10]
-            }
+            user = dict(zip(USER_COLUMNS, user))
+            if self.user_cache:
+                self.user_cache.put(user_id, user, version)
+            return user
         return None
     
+    def warm_referral_index(self):
+        """Load every referral code, from every shard, into the in-memory index"""
+        started = time.perf_counter()
+        with self._across_shards(HOT_QUERIES['referral_codes_sorted'][0], key=lambda row: row[0]) as rows:
+            loaded = self.referral_index.warm(rows)
+        stats = self.referral_index.stats()
+        logger.info(
+            f"Referral index warmed with {loaded} codes in {time.perf_counter() - started:.2f}s "
+            f"({stats['memory_bytes'] / 1024 / 1024:.1f} MiB)"
+        )
+        if not stats['complete']:
+            logger.warning("Referral index hit its memory budget; remaining codes are looked up in SQLite")
+    
+    def warm_referral_graph(self):
+        """Build the in-memory referral graph in one pass over referrals
+        
+        One file is read in referral order. Shards are each read by
+        created_at, the only order they share, and merged on it.
+        """
+        started = time.perf_counter()
+        order = 'id' if self.storage.shard_count == 1 else 'created_at, id'
+        with self._across_shards(
+            f'SELECT referrer_id, referred_id, created_at FROM referrals ORDER BY {order}', key=lambda row: row[2]
+        ) as rows:
+            linked = self.referral_graph.warm(rows)
+        stats = self.referral_graph.stats()
+        logger.info(
+            f"Referral graph built with {linked} referrals between {stats['users']} users in "
+            f"{time.perf_counter() - started:.2f}s ({stats['memory_bytes'] / 1024 / 1024:.1f} MiB, "
+            f"deepest chain {stats['max_depth']})"
+        )
+        if stats['ignored']:
+            logger.warning(f"Referral graph skipped {stats['ignored']} repeated or cyclic referrals")
+    
+    def get_downline(self, user_id, max_depth=REFERRAL_GRAPH_MAX_DEPTH):
+        """Count a user's downline with a recursive query, up to `max_depth` levels
+        
+        Returns (members, deepest level). The in-memory graph answers this in
+        O(1); this is the fallback when it is disabled and a cross-check.
+        Sharded storage walks one level at a time, asking each shard for the
+        referrals of the frontier members it holds.
+        """
+        if self.storage.shard_count == 1:
+            with self._connection() as conn:
+                return conn.execute(HOT_QUERIES['downline'][0], (user_id, max_depth)).fetchone()
+        
+        members = depth = 0
+        frontier = [user_id]
+        while frontier and depth < max_depth:
+            by_shard = {}
+            for member in frontier:
+                by_shard.setdefault(self._shard(member), []).append(member)
+            
+            frontier = []
+            for shard, referrers in by_shard.items():
+                frontier.extend(row[0] for row in self._chunked_in_query(
+                    shard, 'SELECT referred_id FROM referrals WHERE referrer_id IN ({})', referrers
+                ))
+            if frontier:
+                members += len(frontier)
+                depth += 1
+        return members, depth
+    
     def get_user_by_referral_code(self, referral_code):
         """Get user by referral code"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
-        result = cursor.fetchone()
-        conn.close()
+        if self.referral_index is not None:
+            user_id = self.referral_index.get(referral_code)
+            if user_id is not None:
+                return None if user_id == ReferralCodeIndex.MISSING else user_id
         
+        # Codes made from a user id lead straight to that user's shard; any
+        # other code has to be asked of every shard
+        user_id = referral_code_user_id(referral_code)
+        shards = self.storage.shards if user_id is None else (self._shard(user_id),)
+        result = None
+        for shard in shards:
+            with self._connection(shard) as conn:
+                result = conn.execute(HOT_QUERIES['user_by_referral_code'][0], (referral_code,)).fetchone()
+            if result:
+                break
+
+        if self.referral_index is not None:
+            if result:
+                self.referral_index.add(referral_code, result[0])
+            else:
+                self.referral_index.add_missing(referral_code)
         return result[0] if result else None
     
     def add_referral_bonus(self, referrer_id, referred_id):
         """Add referral bonus to referrer"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        return self._run_plan(self._add_referral_bonus_plan(referrer_id, referred_id))
+    
+    def _add_referral_bonus_plan(self, referrer_id, referred_id):
         try:
-            # Add bonus to referrer
-            cursor.execute('''
-                UPDATE users 
-                SET balance = balance + ?, total_earned = total_earned + ?, total_referrals = total_referrals + 1
-                WHERE user_id = ?
-            ''', (REFERRAL_BONUS, REFERRAL_BONUS, referrer_id))
-            
-            # Record the referral
-            cursor.execute('''
-                INSERT INTO referrals (referrer_id, referred_id, bonus_amount)
-                VALUES (?, ?, ?)
-            ''', (referrer_id, referred_id, REFERRAL_BONUS))
-            
-            conn.commit()
-            return True
+            credited = yield self._shard(referrer_id), self._credit_referral, (referrer_id, referred_id)
         except Exception as e:
             logger.error(f"Error adding referral bonus: {e}")
             return False
-        finally:
-            conn.close()
+        
+        self._invalidate(referrer_id)
+        if credited and self.referral_graph is not None:
+            self.referral_graph.add(referrer_id, referred_id)
+        return credited
+    
+    def _credit_referral(self, cursor, referrer_id, referred_id):
+        """Credit the referral bonus and record the referral on the given cursor"""
+        # Add bonus to referrer
+        cursor.execute('''
+            UPDATE users 
+            SET balance_paise = balance_paise + :bonus, balance = (balance_paise + :bonus) / 100.0,
+                earned_paise = earned_paise + :bonus, total_earned = (earned_paise + :bonus) / 100.0,
+                total_referrals = total_referrals + 1
+            WHERE user_id = :user_id
+        ''', {'bonus': REFERRAL_BONUS_PAISE, 'user_id': referrer_id})
+        if cursor.rowcount == 0:
+            return False
+        
+        # Record the referral
+        cursor.execute('''
+            INSERT INTO referrals (referrer_id, referred_id, bonus_amount, bonus_paise)
+            VALUES (?, ?, ?, ?)
+        ''', (referrer_id, referred_id, REFERRAL_BONUS, REFERRAL_BONUS_PAISE))
+        self._append_ledger(cursor, referrer_id, 'referral_bonus', REFERRAL_BONUS_PAISE, cursor.lastrowid)
+        self._bump_stats(
+            cursor, total_balance_paise=REFERRAL_BONUS_PAISE, total_earned_paise=REFERRAL_BONUS_PAISE,
+            total_referrals=1
+        )
+        return True
     
     def create_withdrawal_request(self, user_id, amount, payment_method, payment_details):
-        """Create a withdrawal request"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Create a withdrawal request
         
+        Raises InsufficientBalance if the balance no longer covers `amount`,
+        e.g. because another withdrawal was debited first.
+        """
+        return self._run_plan(
+            self._create_withdrawal_request_plan(user_id, amount, payment_method, payment_details)
+        )
+    
+    def _create_withdrawal_request_plan(self, user_id, amount, payment_method, payment_details):
         try:
-            cursor.execute('''
-                INSERT INTO withdrawals (user_id, amount, payment_method, payment_details)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, amount, payment_method, payment_details))
-            
-            # Deduct amount from user balance
-            cursor.execute('''
-                UPDATE users SET balance = balance - ? WHERE user_id = ?
-            ''', (amount, user_id))
-            
-            conn.commit()
-            return True
+            yield self._shard(user_id), self._insert_withdrawal, (user_id, amount, payment_method, payment_details)
+        except InsufficientBalance:
+            self._invalidate(user_id)
+            raise
         except Exception as e:
             logger.error(f"Error creating withdrawal request: {e}")
             return False
-        finally:
-            conn.close()
+        
+        self._invalidate(user_id)
+        return True
+    
+    def _insert_withdrawal(self, cursor, user_id, amount, payment_method, payment_details):
+        """Deduct a withdrawal from the balance and record it on the given cursor
+        
+        The debit only applies while the balance covers it, so concurrent
+        withdrawals cannot overdraw however they interleave; the one that
+        loses finds no matching row and nothing is written.
+        """
+        amount_paise = to_paise(amount)
+        cursor.execute('''
+            UPDATE users SET balance_paise = balance_paise - :amount, balance = (balance_paise - :amount) / 100.0
+            WHERE user_id = :user_id AND balance_paise >= :amount
+        ''', {'amount': amount_paise, 'user_id': user_id})
+        if cursor.rowcount == 0:
+            row = cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            raise InsufficientBalance(row[0] if row else 0.0)
+        
+        # Ids step by the shard count from an offset of the shard, so they are
+        # unique across shards and lead back to theirs; with one shard this
+        # is plain MAX(id) + 1
+        cursor.execute('''
+            INSERT INTO withdrawals (id, user_id, amount, amount_paise, payment_method, payment_details)
+            SELECT (COALESCE(MAX(id), 0) / :shards + 1) * :shards + :shard, :user_id, :amount, :amount_paise,
+                   :payment_method, :payment_details
+            FROM withdrawals
+        ''', {
+            'shards': self.storage.shard_count, 'shard': self._shard(user_id), 'user_id': user_id,
+            'amount': amount_paise / 100, 'amount_paise': amount_paise,
+            'payment_method': payment_method, 'payment_details': payment_details
+        })
+        self._append_ledger(cursor, user_id, 'withdrawal_hold', -amount_paise, cursor.lastrowid)
+        self._bump_stats(
+            cursor, total_balance_paise=-amount_paise, pending_withdrawals=1, pending_amount_paise=amount_paise
+        )
+    
+    def _append_ledger(self, cursor, user_id, entry, amount_paise, ref_id=None):
+        """Append one signed balance entry inside the caller's transaction"""
+        cursor.execute(
+            'INSERT INTO ledger (user_id, entry, amount_paise, ref_id) VALUES (?, ?, ?, ?)',
+            (user_id, entry, amount_paise, ref_id)
+        )
     
     def get_all_users(self):
         """Get all users (admin function)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        join_date = USER_COLUMNS.index('join_date')
+        with self._across_shards(
+            'SELECT * FROM users ORDER BY join_date DESC', key=lambda row: row[join_date], reverse=True
+        ) as rows:
+            return list(rows)
+    
+    def get_user_stats(self):
+        """Aggregate user totals in SQL (admin function)"""
+        with self._across_shards('''
+            SELECT COUNT(*), COALESCE(SUM(balance_paise), 0), COALESCE(SUM(earned_paise), 0),
+                   COALESCE(SUM(total_referrals), 0)
+            FROM users
+        ''') as rows:
+            row = [sum(column) for column in zip(*rows)]
+        
+        return {
+            'total_users': row[0],
+            'total_balance': row[1] / 100,
+            'total_earned': row[2] / 100,
+            'total_referrals': row[3]
+        }
+    
+    def _bump_stats(self, cursor, **deltas):
+        """Apply counter deltas to bot_stats inside the caller's transaction"""
+        assignments = ', '.join(f'{column} = {column} + ?' for column in deltas)
+        cursor.execute(f'UPDATE bot_stats SET {assignments} WHERE id = 1', tuple(deltas.values()))
+    
+    def get_bot_stats(self):
+        """Read the incrementally maintained global counters in O(1)
+        
+        Paise counters are returned in rupees under their unsuffixed names;
+        with sharded storage they are summed over the shards.
+        """
+        with self._across_shards(f'SELECT {", ".join(STATS_COLUMNS)} FROM bot_stats WHERE id = 1') as rows:
+            row = [sum(column) for column in zip(*rows)]
+        return {
+            column.removesuffix('_paise'): value / 100 if column.endswith('_paise') else value
+            for column, value in zip(STATS_COLUMNS, row)
+        }
+    
+    def reconcile_stats(self, repair=True):
+        """Compare bot_stats with the base tables and return any drift
+        
+        Counters and base tables are read in one snapshot. Drift is repaired
+        by applying the difference as a delta, so writes that commit between
+        the check and the repair are not lost. Each shard keeps its own
+        counters and is repaired on its own; the drift returned is the sum.
+        """
+        total_drift = {}
+        for shard in self.storage.shards:
+            with self._connection(shard) as conn:
+                conn.execute('BEGIN')
+                try:
+                    counters = conn.execute(
+                        f'SELECT {", ".join(STATS_COLUMNS)} FROM bot_stats WHERE id = 1'
+                    ).fetchone()
+                    actual = conn.execute(STATS_FROM_BASE_TABLES).fetchone()[1:]
+                finally:
+                    conn.rollback()
+            
+            drift = {
+                column: expected - counted
+                for column, counted, expected in zip(STATS_COLUMNS, counters, actual)
+                if expected != counted
+            }
+            
+            if drift:
+                logger.warning(f"bot_stats drifted from base tables: {drift}")
+                if repair:
+                    self._write(shard, lambda cursor: self._bump_stats(cursor, **drift))
+            for column, delta in drift.items():
+                total_drift[column] = total_drift.get(column, 0) + delta
+        return total_drift
+    
+    def verify_ledger(self, repair=False, max_reported=LEDGER_MAX_REPORTED):
+        """Replay the ledger and check every user's balance snapshot against it
         
-        cursor.execute('SELECT * FROM users ORDER BY join_date DESC')
-        users = cursor.fetchall()
-        conn.close()
+        Reads each shard in one snapshot; `repair` applies the replayed
+        difference as a delta and reconciles bot_stats.
+        """
+        started = time.perf_counter()
+        result = {'users': 0, 'entries': 0, 'mismatched': 0, 'orphaned': 0, 'repaired': 0, 'reported': []}
         
-        return users
+        for shard in self.storage.shards:
+            repairs = []
+            with self._connection(shard) as conn:
+                conn.execute('BEGIN')
+                try:
+                    totals = conn.execute(HOT_QUERIES['ledger_totals'][0])
+                    users = conn.execute(
+                        'SELECT user_id, balance_paise, earned_paise, balance, total_earned FROM users ORDER BY user_id'
+                    )
+                    pending = next(totals, None)
+                    for user_id, balance_paise, earned_paise, balance, total_earned in users:
+                        while pending is not None and pending[0] < user_id:
+                            result['orphaned'] += 1
+                            result['entries'] += pending[3]
+                            pending = next(totals, None)
+                        
+                        replayed_balance = replayed_earned = 0
+                        if pending is not None and pending[0] == user_id:
+                            _, replayed_balance, replayed_earned, entries = pending
+                            result['entries'] += entries
+                            pending = next(totals, None)
+                        result['users'] += 1
+                        
+                        if (balance_paise != replayed_balance or earned_paise != replayed_earned
+                                or balance != balance_paise / 100 or total_earned != earned_paise / 100):
+                            result['mismatched'] += 1
+                            if len(result['reported']) < max_reported:
+                                result['reported'].append(
+                                    (user_id, balance_paise, replayed_balance, earned_paise, replayed_earned)
+                                )
+                            if repair:
+                                repairs.append({
+                                    'user_id': user_id,
+                                    'balance': replayed_balance - balance_paise,
+                                    'earned': replayed_earned - earned_paise
+                                })
+                    
+                    while pending is not None:
+                        result['orphaned'] += 1
+                        result['entries'] += pending[3]
+                        pending = next(totals, None)
+                finally:
+                    conn.rollback()
+            
+            for start in range(0, len(repairs), LEDGER_REPAIR_CHUNK_SIZE):
+                chunk = repairs[start:start + LEDGER_REPAIR_CHUNK_SIZE]
+                self._write(shard, self._apply_ledger_repairs, chunk)
+                self._invalidate(*(row['user_id'] for row in chunk))
+                result['repaired'] += len(chunk)
+        
+        result['seconds'] = time.perf_counter() - started
+        if result['mismatched'] or result['orphaned']:
+            logger.warning(
+                f"Ledger replay found {result['mismatched']} mismatched balances and "
+                f"{result['orphaned']} ledger users without a users row"
+            )
+        
+        if result['repaired']:
+            self.reconcile_stats()
+        return result
+    
+    def _apply_ledger_repairs(self, cursor, repairs):
+        """Shift balance snapshots by replayed differences on the given cursor"""
+        cursor.executemany('''
+            UPDATE users SET
+                balance_paise = balance_paise + :balance, balance = (balance_paise + :balance) / 100.0,
+                earned_paise = earned_paise + :earned, total_earned = (earned_paise + :earned) / 100.0
+            WHERE user_id = :user_id
+        ''', repairs)
+    
+    def get_users_page(self, older_than=None, newer_than=None, limit=ADMIN_PAGE_SIZE):
+        """Get one page of users, newest first (admin function)
+        
+        Pages are keyset-based: pass the (join_date, user_id) of the last row
+        as `older_than` for the next page, or of the first row as
+        `newer_than` for the previous one. Returns a dict with the user rows
+        and whether older/newer pages exist.
+        """
+        if newer_than:
+            query, params = 'users_page_newer', (*newer_than, limit + 1)
+        elif older_than:
+            query, params = 'users_page_older', (*older_than, limit + 1)
+        else:
+            query, params = 'users_page_first', (limit + 1,)
+        
+        # Every shard returns its own page; merging them keeps the first limit + 1
+        join_date = USER_COLUMNS.index('join_date')
+        with self._across_shards(
+            HOT_QUERIES[query][0], params, key=lambda row: (row[join_date], row[0]), reverse=not newer_than
+        ) as rows:
+            rows = list(itertools.islice(rows, limit + 1))
+        
+        if newer_than:
+            has_newer = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_older = True
+        else:
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+            has_newer = older_than is not None
+        
+        return {'users': rows, 'has_older': has_older, 'has_newer': has_newer}
     
     def get_pending_withdrawals(self):
         """Get pending withdrawal requests"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # w.created_at is the 7th column of w.*
+        with self._across_shards(HOT_QUERIES['pending_withdrawals'][0], key=lambda row: row[6], reverse=True) as rows:
+            return list(rows)
+
+    def get_pending_withdrawals_chunk(self, after_id=0, limit=PAYOUT_CHUNK_SIZE):
+        """Get up to `limit` pending withdrawals with id > after_id, oldest first"""
+        with self._across_shards(
+            HOT_QUERIES['pending_withdrawals_chunk'][0], (after_id, limit), key=lambda row: row[0]
+        ) as rows:
+            return list(itertools.islice(rows, limit))
+    
+    def iter_pending_withdrawals(self, chunk_size=PAYOUT_CHUNK_SIZE):
+        """Stream every pending withdrawal in keyset-paginated chunks
         
-        cursor.execute('''
-            SELECT w.*, u.username, u.first_name 
-            FROM withdrawals w 
-            JOIN users u ON w.user_id = u.user_id 
-            WHERE w.status = 'pending' 
-            ORDER BY w.created_at DESC
-        ''')
-        withdrawals = cursor.fetchall()
-        conn.close()
+        Only one chunk is held in memory and no connection or read
+        transaction is kept open between chunks.
+        """
+        after_id = 0
+        while True:
+            rows = self.get_pending_withdrawals_chunk(after_id, chunk_size)
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            after_id = rows[-1][0]
+    
+    def process_withdrawals(self, withdrawal_ids, approve=True):
+        """Approve or reject pending withdrawals in batched transactions
+        
+        Rejected withdrawals are refunded to the user's balance. Ids that are
+        unknown or no longer pending are skipped. Returns a dict with the
+        number processed, skipped and the total amount.
+        """
+        status = 'approved' if approve else 'rejected'
+        withdrawal_ids = list(withdrawal_ids)
+        summary = {'processed': 0, 'skipped': 0, 'amount': 0.0}
+        
+        for start in range(0, len(withdrawal_ids), PAYOUT_CHUNK_SIZE):
+            chunk = withdrawal_ids[start:start + PAYOUT_CHUNK_SIZE]
+            # A withdrawal id is congruent to its shard modulo the shard count
+            by_shard = {}
+            for withdrawal_id in chunk:
+                by_shard.setdefault(withdrawal_id % self.storage.shard_count, []).append(withdrawal_id)
+            
+            for shard, ids in by_shard.items():
+                settled = self._write(shard, self._settle_withdrawals, ids, status)
+                summary['processed'] += len(settled)
+                summary['skipped'] += len(ids) - len(settled)
+                summary['amount'] += sum(amount_paise for _, _, amount_paise in settled) / 100
+                if not approve:
+                    self._invalidate(*{user_id for _, user_id, _ in settled})
+        
+        return summary
+    
+    def _settle_withdrawals(self, cursor, withdrawal_ids, status):
+        """Mark pending withdrawals as processed on the given cursor"""
+        placeholders = ', '.join('?' * len(withdrawal_ids))
+        cursor.execute(f'''
+            UPDATE withdrawals SET status = ?, processed_at = CURRENT_TIMESTAMP
+            WHERE id IN ({placeholders}) AND status = 'pending'
+            RETURNING id, user_id, amount_paise
+        ''', (status, *withdrawal_ids))
+        settled = cursor.fetchall()
+        if not settled:
+            return settled
+        
+        total = sum(amount_paise for _, _, amount_paise in settled)
+        if status == 'rejected':
+            # Refund the held amount
+            cursor.executemany('''
+                UPDATE users SET balance_paise = balance_paise + :amount, balance = (balance_paise + :amount) / 100.0
+                WHERE user_id = :user_id
+            ''', [{'amount': amount_paise, 'user_id': user_id} for _, user_id, amount_paise in settled])
+            cursor.executemany(
+                "INSERT INTO ledger (user_id, entry, amount_paise, ref_id) VALUES (?, 'withdrawal_refund', ?, ?)",
+                [(user_id, amount_paise, withdrawal_id) for withdrawal_id, user_id, amount_paise in settled]
+            )
+            self._bump_stats(
+                cursor, total_balance_paise=total, pending_withdrawals=-len(settled), pending_amount_paise=-total
+            )
+        else:
+            self._bump_stats(cursor, pending_withdrawals=-len(settled), pending_amount_paise=-total)
+        return settled
+    
+    def export_pending_withdrawals_csv(self, fileobj):
+        """Write every pending withdrawal as CSV for the payment provider
+        
+        Rows are streamed chunk by chunk; returns the number written.
+        """
+        writer = csv.writer(fileobj)
+        writer.writerow(PAYOUT_CSV_COLUMNS)
+        count = 0
+        for row in self.iter_pending_withdrawals():
+            # Names and payment details are user input, opened by admins in a spreadsheet
+            writer.writerow((*map(spreadsheet_safe, row), ''))
+            count += 1
+        return count
+    
+    def import_withdrawal_decisions_csv(self, fileobj):
+        """Apply approve/reject decisions from a CSV in the export format
+        
+        Rows with an empty or unknown decision are left pending. Decisions
+        are applied in PAYOUT_CHUNK_SIZE batches as the file is read.
+        """
+        summary = {'approved': 0, 'rejected': 0, 'skipped': 0, 'ignored': 0, 'amount': 0.0}
+        batches = {'approve': [], 'reject': []}
+        
+        def flush(decision):
+            result = self.process_withdrawals(batches[decision], approve=decision == 'approve')
+            summary[PAYOUT_DECISIONS[decision]] += result['processed']
+            summary['skipped'] += result['skipped']
+            summary['amount'] += result['amount']
+            batches[decision] = []
+        
+        for row in csv.DictReader(fileobj):
+            decision = (row.get('decision') or '').strip().lower()
+            if decision not in batches or not (row.get('id') or '').strip().isdigit():
+                summary['ignored'] += 1
+                continue
+            batches[decision].append(int(row['id']))
+            if len(batches[decision]) >= PAYOUT_CHUNK_SIZE:
+                flush(decision)
         
-        return withdrawals
+        for decision in batches:
+            if batches[decision]:
+                flush(decision)
+        return summary
+    
+    def get_referral_history(self, referrer_id, limit=10):
+        """Get the most recent referrals credited to a user"""
+        with self._connection(self._shard(referrer_id)) as conn:
+            cursor = conn.execute(HOT_QUERIES['referrals_by_referrer'][0], (referrer_id, limit))
+            return cursor.fetchall()
+    
+    def get_withdrawal_history(self, user_id, limit=10):
+        """Get a user's most recent withdrawal requests"""
+        with self._connection(self._shard(user_id)) as conn:
+            cursor = conn.execute(HOT_QUERIES['withdrawals_of_user'][0], (user_id, limit))
+            return cursor.fetchall()
+
+class AsyncDatabaseManager:
+    """Awaitable facade that runs DatabaseManager calls on dedicated DB threads
+    
+    Every public DatabaseManager method is available as a coroutine, e.g.
+    `await db.get_user(user_id)`; at most `max_pending` calls run at once.
+    """
+    
+    def __init__(self, database, max_workers=DB_WORKERS, max_pending=DB_MAX_PENDING, write_workers=None):
+        if write_workers is None:
+            write_workers = len(database.storage.writers)
+        self.database = database
+        self.max_workers = max_workers
+        self.write_workers = write_workers
+        self.max_pending = max_pending
+        self._queues = {'read': queue.Queue(), 'write': queue.Queue()}
+        self._threads = []
+        self._slots = None
+        self._lock = threading.Lock()
+    
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for lane, count in (('read', self.max_workers), ('write', self.write_workers)):
+                for index in range(count):
+                    thread = threading.Thread(
+                        target=self._worker, args=(self._queues[lane],), name=f"db-{lane}-{index}", daemon=True
+                    )
+                    thread.start()
+                    self._threads.append((lane, thread))
+    
+    def _worker(self, calls):
+        while True:
+            item = calls.get()
+            if item is None:
+                return
+            
+            future, func, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with metrics.time('db_call_seconds', method=func.__name__):
+                    result = func(*args, **kwargs)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+    
+    def submit(self, func, *args, write=False, **kwargs):
+        """Queue a call for the DB threads and return a concurrent Future"""
+        if not self._threads:
+            self._start()
+        future = Future()
+        lane = 'write' if write and self.write_workers else 'read'
+        self._queues[lane].put((future, func, args, kwargs))
+        return future
+    
+    async def run(self, func, *args, write=False, **kwargs):
+        """Run a blocking database call without stalling the event loop"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        
+        async with self._slots:
+            return await asyncio.wrap_future(self.submit(func, *args, write=write, **kwargs))
+    
+    async def run_plan(self, name, *args, **kwargs):
+        """Drive the write plan of DatabaseManager method `name` on the event loop
+        
+        Same as DatabaseManager._run_plan(), except that each write is
+        submitted to its shard's group commit writer and awaited.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        
+        writers = self.database.storage.writers
+        plan = getattr(self.database, f'_{name}_plan')(*args, **kwargs)
+        async with self._slots:
+            with metrics.time('db_call_seconds', method=name):
+                try:
+                    shard, op, op_args = next(plan)
+                    while True:
+                        try:
+                            result = await asyncio.wrap_future(writers[shard].submit(op, *op_args))
+                        except Exception as e:
+                            shard, op, op_args = plan.throw(e)
+                        else:
+                            shard, op, op_args = plan.send(result)
+                except StopIteration as done:
+                    return done.value
+    
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        write = name in self.database.WRITE_METHODS
+        
+        if name in self.database.WRITE_PLANS and self.database.storage.writers:
+            async def call(*args, **kwargs):
+                return await self.run_plan(name, *args, **kwargs)
+        else:
+            async def call(*args, **kwargs):
+                return await self.run(attr, *args, write=write, **kwargs)
+        
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        self.__dict__[name] = call
+        return call
+    
+    def shutdown(self):
+        """Stop the worker threads after draining queued calls"""
+        with self._lock:
+            for lane, thread in self._threads:
+                self._queues[lane].put(None)
+            for lane, thread in self._threads:
+                thread.join()
+            self._threads.clear()
 
 # Initialize database
-db = DatabaseManager()
+database = DatabaseManager(
+    storage=open_storage(
+        DB_STORAGE,
+        DB_PATH,
+        pooled=DB_POOLED,
+        pool_size=DB_POOL_SIZE,
+        group_commit=DB_GROUP_COMMIT,
+        flush_interval=GROUP_COMMIT_INTERVAL,
+        batch_size=GROUP_COMMIT_BATCH_SIZE
+    ),
+    user_cache=UserCache(USER_CACHE_SIZE, USER_CACHE_TTL) if USER_CACHE_SIZE else None,
+    referral_index=ReferralCodeIndex() if REFERRAL_INDEX else None,
+    referral_graph=ReferralGraph() if REFERRAL_GRAPH else None
+)
+db = AsyncDatabaseManager(database, max_workers=DB_WORKERS, max_pending=DB_MAX_PENDING)
+
+class WithdrawalDigest:
+    """Collects new withdrawal requests and sends the admin one digest per window
+    
+    add() only appends to a list, so the user's request path never waits on
+    Telegram. A background task started on the first event sends a digest
+    `window` seconds after the first pending event, or as soon as
+    `max_events` are waiting.
+    """
+    
+    # Withdrawals listed in full per digest; the rest are only counted
+    MAX_LISTED = 20
+    
+    def __init__(self, chat_id=ADMIN_ID, window=ADMIN_DIGEST_WINDOW, max_events=ADMIN_DIGEST_MAX_EVENTS):
+        self.chat_id = chat_id
+        self.window = window
+        self.max_events = max_events
+        self.events_received = 0
+        self.digests_sent = 0
+        self._events = []
+        self._pending = None
+        self._full = None
+        self._task = None
+    
+    def add(self, bot, event):
+        """Queue a withdrawal event for the next digest"""
+        if self._task is None:
+            self._pending = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run(bot))
+        
+        self._events.append(event)
+        self.events_received += 1
+        self._pending.set()
+        if len(self._events) >= self.max_events:
+            self._full.set()
+    
+    async def _run(self, bot):
+        while True:
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.window)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush(bot)
+    
+    def render(self, events):
+        """Format a digest message for a list of withdrawal events"""
+        total = sum(event['amount'] for event in events)
+        lines = [f"🔔 **{len(events)} New Withdrawal Request(s)** - ₹{total:.2f} total\n"]
+        for event in events[:self.MAX_LISTED]:
+            lines.append(
+                f"• {event['first_name']} (@{event['username']}, ID {event['user_id']}): "
+                f"₹{event['amount']:.2f} via {event['payment_method']} - {event['payment_details']}"
+            )
+        if len(events) > self.MAX_LISTED:
+            lines.append(f"\n…and {len(events) - self.MAX_LISTED} more. Use /admin withdrawals for the full list.")
+        return "\n".join(lines)
+    
+    async def flush(self, bot):
+        """Send everything collected so far as one message"""
+        events, self._events = self._events, []
+        if self._pending:
+            self._pending.clear()
+            self._full.clear()
+        if not events:
+            return
+        
+        try:
+            await bot.send_message(self.chat_id, self.render(events))
+            self.digests_sent += 1
+        except asyncio.CancelledError:
+            # Keep the events for the final flush in stop()
+            self._events[:0] = events
+            raise
+        except Exception as e:
+            logger.error(f"Error sending withdrawal digest ({len(events)} requests): {e}")
+    
+    async def stop(self, bot):
+        """Cancel the background task and send whatever is still pending"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(bot)
+
+withdrawal_digest = WithdrawalDigest()
+
+# Pre-built keyboards, shared by every message that shows them
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 Balance", callback_data='balance')],
+    [InlineKeyboardButton("👥 Referrals", callback_data='referrals')],
+    [InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
+    [InlineKeyboardButton("📊 Statistics", callback_data='stats')]
+])
+NEW_USER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 Balance", callback_data='balance')],
+    [InlineKeyboardButton("👥 My Referral Link", callback_data='referrals')],
+    [InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
+    [InlineKeyboardButton("📊 Statistics", callback_data='stats')]
+])
+BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
+])
+HELP_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')],
+    [InlineKeyboardButton("💰 Balance", callback_data='balance')],
+    [InlineKeyboardButton("👥 Referrals", callback_data='referrals')]
+])
+
+USER_NOT_FOUND_MESSAGE = "❌ User not found. Please use /start to register."
+REFERRED_BONUS_MESSAGE = f"\n🎁 You were referred by someone and they earned ₹{REFERRAL_BONUS}!"
+
+# Message templates per screen. Bot-wide constants are filled in once at
+# import time (f-string parts); per-user fields are left for render().
+TEMPLATES = {
+    'welcome': (
+        "🎉 Welcome to EarnyHa, {first_name}!\n\n"
+        "Your referral code: {referral_code}\n"
+        "Current balance: ₹{balance:.2f}{bonus_msg}\n\n"
+        "💡 **How to earn:**\n"
+        "1. Share your referral link with friends\n"
+        f"2. Earn ₹{REFERRAL_BONUS} for each successful referral\n"
+        f"3. Withdraw when you reach ₹{MIN_WITHDRAWAL}\n\n"
+        "What would you like to do?"
+    ),
+    'main_menu': (
+        "Welcome back, {first_name}! 🎉\n\n"
+        "Your current balance: ₹{balance:.2f}\n"
+        "Total referrals: {total_referrals}\n\n"
+        "What would you like to do?"
+    ),
+    'balance': (
+        "💰 **Your Balance**\n\n"
+        "Current Balance: ₹{balance:.2f}\n"
+        "Total Earned: ₹{total_earned:.2f}\n"
+        "Total Referrals: {total_referrals}\n\n"
+        f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}"
+    ),
+    'referrals': (
+        "👥 **Your Referral Information**\n\n"
+        "Your referral code: {referral_code}\n"
+        "Your referral link:\n{referral_link}\n\n"
+        "Total referrals: {total_referrals}\n"
+        f"Earned per referral: ₹{REFERRAL_BONUS}\n\n"
+        "💡 Share this link with friends to earn money!"
+    ),
+    'withdraw_insufficient': (
+        "❌ **Insufficient Balance**\n\n"
+        "Current Balance: ₹{balance:.2f}\n"
+        f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}\n\n"
+        "You need ₹{shortfall:.2f} more to withdraw."
+    ),
+    'withdraw': (
+        "💸 **Withdrawal Request**\n\n"
+        "Available balance: ₹{balance:.2f}\n"
+        f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}\n\n"
+        "To request a withdrawal, please send a message in this format:\n"
+        "/withdraw <amount> <payment_method> <payment_details>\n\n"
+        "Example:\n"
+        "/withdraw 100 UPI user@paytm\n"
+        "/withdraw 200 Bank 1234567890"
+    ),
+    'stats': (
+        "📊 **Your Statistics**\n\n"
+        "Member since: {member_since}\n"
+        "Total referrals: {total_referrals}\n"
+        "Total earned: ₹{total_earned:.2f}\n"
+        "Current balance: ₹{balance:.2f}\n"
+        "Referral code: {referral_code}\n\n"
+        "Keep sharing your referral link to earn more!"
+    ),
+}
+
+HELP_TEXT = (
+    "**EarnyHa Bot - Help**\n\n"
+    "**Available Commands:**\n"
+    "/start - Register or view main menu\n"
+    "/menu - Show main menu\n"
+    "/balance - Check your balance\n"
+    "/referrals - Get your referral link\n"
+    "/withdraw <amount> <method> <details> - Request withdrawal\n"
+    "/help - Show this help message\n\n"
+    "**How to earn:**\n"
+    "1. Share your referral link with friends\n"
+    "2. Earn ₹10 for each successful referral\n"
+    "3. Withdraw when you reach ₹50\n\n"
+    "**Contact:** For support, contact the bot administrator."
+)
+
+# Screen name -> (template, keyboard)
+SCREENS = {
+    'welcome': (TEMPLATES['welcome'], NEW_USER_KEYBOARD),
+    'main_menu': (TEMPLATES['main_menu'], MAIN_MENU_KEYBOARD),
+    'balance': (TEMPLATES['balance'], BACK_TO_MENU_KEYBOARD),
+    'referrals': (TEMPLATES['referrals'], BACK_TO_MENU_KEYBOARD),
+    'withdraw_insufficient': (TEMPLATES['withdraw_insufficient'], BACK_TO_MENU_KEYBOARD),
+    'withdraw': (TEMPLATES['withdraw'], BACK_TO_MENU_KEYBOARD),
+    'stats': (TEMPLATES['stats'], BACK_TO_MENU_KEYBOARD),
+}
+
+def screen_fields(user_data, first_name):
+    """Template fields for a user record, including derived values"""
+    return {
+        **user_data,
+        'first_name': first_name,
+        'referral_link': f"https://t.me/Earnyha_bot?start={user_data['referral_code']}",
+        'shortfall': (MIN_WITHDRAWAL_PAISE - user_data['balance_paise']) / 100,
+        'member_since': user_data['join_date'][:10]
+    }
+
+def render(screen, **fields):
+    """Render a screen to (text, reply_markup)"""
+    template, keyboard = SCREENS[screen]
+    return template.format(**fields), keyboard
+
+class CallbackRouter:
+    """Dispatch table for inline button callbacks
+    
+    callback_data is "<route>" or "<route>|<args>". Each route declares
+    whether it needs the pressing user's record, so the database is only
+    queried for screens that show user data.
+    """
+    
+    def __init__(self):
+        self.routes = {}
+        self.latency = {}
+    
+    def route(self, *names, needs_user=True):
+        """Decorator registering `handler(query, user_data, args)` for routes"""
+        def register(handler):
+            for name in names:
+                self.routes[name] = (handler, needs_user)
+                self.latency[name] = LatencyHistogram()
+            return handler
+        return register
+    
+    async def dispatch(self, query):
+        name, _, args = query.data.partition('|')
+        route = self.routes.get(name)
+        if route is None:
+            logger.warning(f"No callback route for {query.data!r}")
+            return
+        
+        handler, needs_user = route
+        started = time.perf_counter()
+        try:
+            user_data = None
+            if needs_user:
+                user_data = await db.get_user(query.from_user.id)
+                if not user_data:
+                    await edit_screen(query, USER_NOT_FOUND_MESSAGE, None)
+                    return
+            await handler(query, user_data, args)
+        finally:
+            self.latency[name].observe(time.perf_counter() - started)
+    
+    def stats(self):
+        """Latency summary per route that has been called, slowest first"""
+        stats = {name: hist.stats() for name, hist in self.latency.items() if hist.count}
+        return dict(sorted(stats.items(), key=lambda item: item[1]['p95'], reverse=True))
+
+callback_router = CallbackRouter()
+
+def send_in_background(context, chat_id, text, **kwargs):
+    """Queue a non-interactive message without waiting for it to be sent"""
+    async def send():
+        try:
+            await context.bot.send_message(chat_id, text, **kwargs)
+        except Exception as e:
+            logger.error(f"Error sending background message to {chat_id}: {e}")
+    
+    context.application.create_task(send())
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.effective_user
     
     # Check if user exists
-    existing_user = db.get_user(user.id)
+    existing_user = await db.get_user(user.id)
     
     if existing_user:
         # Existing user
-        keyboard = [
-            [InlineKeyboardButton("💰 Balance", callback_data='balance')],
-            [InlineKeyboardButton("👥 Referrals", callback_data='referrals')],
-            [InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
-            [InlineKeyboardButton("📊 Statistics", callback_data='stats')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            f"Welcome back, {user.first_name}! 🎉\n\n"
-            f"Your current balance: ₹{existing_user['balance']:.2f}\n"
-            f"Total referrals: {existing_user['total_referrals']}\n\n"
-            f"What would you like to do?",
-            reply_markup=reply_markup
-        )
+        text, reply_markup = render('main_menu', **screen_fields(existing_user, user.first_name))
+        await update.message.reply_text(text, reply_markup=reply_markup)
     else:
         # New user - check for referral code
         referred_by = None
         if context.args and len(context.args) > 0:
             referral_code = context.args[0]
-            referred_by = db.get_user_by_referral_code(referral_code)
+            referred_by = await db.get_user_by_referral_code(referral_code)
         
         # Add new user
-        success = db.add_user(
+        new_user = await db.add_user(
             user.id, 
             user.username, 
             user.first_name, 
@@ -260,136 +3131,54 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             referred_by
         )
         
-        if success:
-            new_user = db.get_user(user.id)
-            bonus_msg = ""
-            if referred_by:
-                bonus_msg = f"\n🎁 You were referred by someone and they earned ₹{REFERRAL_BONUS}!"
-            
-            keyboard = [
-                [InlineKeyboardButton("💰 Balance", callback_data='balance')],
-                [InlineKeyboardButton("👥 My Referral Link", callback_data='referrals')],
-                [InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
-                [InlineKeyboardButton("📊 Statistics", callback_data='stats')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                f"🎉 Welcome to EarnyHa, {user.first_name}!\n\n"
-                f"Your referral code: {new_user['referral_code']}\n"
-                f"Current balance: ₹{new_user['balance']:.2f}{bonus_msg}\n\n"
-                f"💡 **How to earn:**\n"
-                f"1. Share your referral link with friends\n"
-                f"2. Earn ₹{REFERRAL_BONUS} for each successful referral\n"
-                f"3. Withdraw when you reach ₹{MIN_WITHDRAWAL}\n\n"
-                f"What would you like to do?",
-                reply_markup=reply_markup
+        if new_user:
+            text, reply_markup = render(
+                'welcome',
+                bonus_msg=REFERRED_BONUS_MESSAGE if referred_by else "",
+                **screen_fields(new_user, user.first_name)
             )
+            await update.message.reply_text(text, reply_markup=reply_markup)
         else:
             await update.message.reply_text(
                 "❌ Something went wrong. Please try again later."
             )
 
+async def edit_screen(query, text, reply_markup):
+    """Edit the callback's message, skipping the API call if nothing changed"""
+    message = query.message
+    if message and message.text == text and message.reply_markup == reply_markup:
+        return
+    
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Telegram rejects edits that change nothing (e.g. text it normalized)
+        if 'not modified' not in str(e).lower():
+            raise
+
+@callback_router.route('main_menu', 'balance', 'referrals', 'withdraw', 'stats')
+async def show_screen(query, user_data, args):
+    """Show one of the user's menu screens"""
+    screen = query.data.partition('|')[0]
+    if screen == 'withdraw' and user_data['balance_paise'] < MIN_WITHDRAWAL_PAISE:
+        screen = 'withdraw_insufficient'
+    
+    text, reply_markup = render(screen, **screen_fields(user_data, query.from_user.first_name))
+    await edit_screen(query, text, reply_markup)
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
     query = update.callback_query
     await query.answer()
-    
-    user_id = query.from_user.id
-    user_data = db.get_user(user_id)
-    
-    if not user_data:
-        await query.edit_message_text("❌ User not found. Please use /start to register.")
-        return
-    
-    if query.data == 'balance':
-        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            f"💰 **Your Balance**\n\n"
-            f"Current Balance: ₹{user_data['balance']:.2f}\n"
-            f"Total Earned: ₹{user_data['total_earned']:.2f}\n"
-            f"Total Referrals: {user_data['total_referrals']}\n\n"
-            f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}",
-            reply_markup=reply_markup
-        )
-    
-    elif query.data == 'referrals':
-        referral_link = f"https://t.me/Earnyha_bot?start={user_data['referral_code']}"
-        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            f"👥 **Your Referral Information**\n\n"
-            f"Your referral code: {user_data['referral_code']}\n"
-            f"Your referral link:\n{referral_link}\n\n"
-            f"Total referrals: {user_data['total_referrals']}\n"
-            f"Earned per referral: ₹{REFERRAL_BONUS}\n\n"
-            f"💡 Share this link with friends to earn money!",
-            reply_markup=reply_markup
-        )
-    
-    elif query.data == 'withdraw':
-        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        if user_data['balance'] < MIN_WITHDRAWAL:
-            await query.edit_message_text(
-                f"❌ **Insufficient Balance**\n\n"
-                f"Current Balance: ₹{user_data['balance']:.2f}\n"
-                f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}\n\n"
-                f"You need ₹{MIN_WITHDRAWAL - user_data['balance']:.2f} more to withdraw.",
-                reply_markup=reply_markup
-            )
-        else:
-            await query.edit_message_text(
-                f"💸 **Withdrawal Request**\n\n"
-                f"Available balance: ₹{user_data['balance']:.2f}\n"
-                f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}\n\n"
-                f"To request a withdrawal, please send a message in this format:\n"
-                f"/withdraw <amount> <payment_method> <payment_details>\n\n"
-                f"Example:\n"
-                f"/withdraw 100 UPI user@paytm\n"
-                f"/withdraw 200 Bank 1234567890",
-                reply_markup=reply_markup
-            )
-    
-    elif query.data == 'stats':
-        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            f"📊 **Your Statistics**\n\n"
-            f"Member since: {user_data['join_date'][:10]}\n"
-            f"Total referrals: {user_data['total_referrals']}\n"
-            f"Total earned: ₹{user_data['total_earned']:.2f}\n"
-            f"Current balance: ₹{user_data['balance']:.2f}\n"
-            f"Referral code: {user_data['referral_code']}\n\n"
-            f"Keep sharing your referral link to earn more!",
-            reply_markup=reply_markup
-        )
-    
-    elif query.data == 'main_menu':
-        # Show main menu
-        keyboard = [
-            [InlineKeyboardButton("💰 Balance", callback_data='balance')],
-            [InlineKeyboardButton("👥 Referrals", callback_data='referrals')],
-            [InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
-            [InlineKeyboardButton("📊 Statistics", callback_data='stats')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            f"Welcome back, {query.from_user.first_name}! 🎉\n\n"
-            f"Your current balance: ₹{user_data['balance']:.2f}\n"
-            f"Total referrals: {user_data['total_referrals']}\n\n"
-            f"What would you like to do?",
-            reply_markup=reply_markup
-        )
+    await callback_router.dispatch(query)
 
 async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /withdraw command"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     
     if not user_data:
-        await update.message.reply_text("❌ User not found. Please use /start to register.")
+        await update.message.reply_text(USER_NOT_FOUND_MESSAGE)
         return
     
     if len(context.args) < 3:
@@ -410,20 +3199,27 @@ async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid amount. Please enter a valid number.")
         return
     
-    if amount < MIN_WITHDRAWAL:
+    if to_paise(amount) < MIN_WITHDRAWAL_PAISE:
         await update.message.reply_text(
             f"❌ Minimum withdrawal amount is ₹{MIN_WITHDRAWAL}"
         )
         return
     
-    if amount > user_data['balance']:
+    if to_paise(amount) > user_data['balance_paise']:
         await update.message.reply_text(
             f"❌ Insufficient balance. Your current balance is ₹{user_data['balance']:.2f}"
         )
         return
     
-    # Create withdrawal request
-    success = db.create_withdrawal_request(user_id, amount, payment_method, payment_details)
+    # Create withdrawal request; the balance check above used a snapshot, the
+    # database re-checks it atomically with the debit
+    try:
+        success = await db.create_withdrawal_request(user_id, amount, payment_method, payment_details)
+    except InsufficientBalance as e:
+        await update.message.reply_text(
+            f"❌ Insufficient balance. Your current balance is ₹{e.balance:.2f}"
+        )
+        return
     
     if success:
         await update.message.reply_text(
@@ -434,20 +3230,27 @@ async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Your request will be processed within 24-48 hours."
         )
         
-        # Notify admin if configured
-        if ADMIN_ID and ADMIN_ID != 123456789:
-            try:
-                await context.bot.send_message(
-                    ADMIN_ID,
-                    f"🔔 **New Withdrawal Request**\n\n"
-                    f"User: {user_data['first_name']} (@{user_data['username']})\n"
-                    f"Amount: ₹{amount:.2f}\n"
-                    f"Method: {payment_method}\n"
-                    f"Details: {payment_details}\n\n"
-                    f"User ID: {user_id}"
-                )
-            except Exception as e:
-                logger.error(f"Error notifying admin: {e}")
+        # Notify admin if configured, without holding up the user's reply
+        if ADMIN_ID and ADMIN_ID != 123456789 and ADMIN_DIGEST:
+            withdrawal_digest.add(context.bot, {
+                'user_id': user_id,
+                'first_name': user_data['first_name'],
+                'username': user_data['username'],
+                'amount': amount,
+                'payment_method': payment_method,
+                'payment_details': payment_details
+            })
+        elif ADMIN_ID and ADMIN_ID != 123456789:
+            send_in_background(
+                context,
+                ADMIN_ID,
+                f"🔔 **New Withdrawal Request**\n\n"
+                f"User: {user_data['first_name']} (@{user_data['username']})\n"
+                f"Amount: ₹{amount:.2f}\n"
+                f"Method: {payment_method}\n"
+                f"Details: {payment_details}\n\n"
+                f"User ID: {user_id}"
+            )
     else:
         await update.message.reply_text(
             "❌ Something went wrong. Please try again later."
@@ -456,37 +3259,399 @@ async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /balance command"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     
     if not user_data:
-        await update.message.reply_text("❌ User not found. Please use /start to register.")
+        await update.message.reply_text(USER_NOT_FOUND_MESSAGE)
         return
     
-    await update.message.reply_text(
-        f"💰 **Your Balance**\n\n"
-        f"Current Balance: ₹{user_data['balance']:.2f}\n"
-        f"Total Earned: ₹{user_data['total_earned']:.2f}\n"
-        f"Total Referrals: {user_data['total_referrals']}\n\n"
-        f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}"
-    )
+    text, _ = render('balance', **screen_fields(user_data, update.effective_user.first_name))
+    withdrawals = await db.get_withdrawal_history(user_id, HISTORY_SIZE)
+    if withdrawals:
+        text += "\n\n**Recent withdrawals:**\n" + "\n".join(
+            f"• ₹{amount:.2f} {status} ({created_at[:10]})" for _, amount, status, created_at in withdrawals
+        )
+    await update.message.reply_text(text)
 
 async def referrals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /referrals command"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     
     if not user_data:
-        await update.message.reply_text("❌ User not found. Please use /start to register.")
+        await update.message.reply_text(USER_NOT_FOUND_MESSAGE)
+        return
+    
+    text, _ = render('referrals', **screen_fields(user_data, update.effective_user.first_name))
+    referrals = await db.get_referral_history(user_id, HISTORY_SIZE)
+    if referrals:
+        text += "\n\n**Recent referrals:**\n" + "\n".join(
+            f"• +₹{bonus_amount:.2f} ({created_at[:10]})" for _, bonus_amount, created_at in referrals
+        )
+    await update.message.reply_text(text)
+
+def render_users_page(page):
+    """Build the /admin users message and its paging buttons"""
+    users = page['users']
+    lines = ["**All Users:**\n"]
+    for user in users:
+        lines.append(
+            f"ID: {user[0]}\n"
+            f"Name: {user[2]} {user[3] or ''}\n"
+            f"Username: @{user[1] or 'N/A'}\n"
+            f"Balance: ₹{user[6]:.2f}\n"
+            f"Referrals: {user[8]}\n"
+            f"Joined: {user[9][:10]}\n"
+        )
+    
+    buttons = []
+    if page['has_newer']:
+        first = users[0]
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_users|newer|{first[9]}|{first[0]}"))
+    if page['has_older']:
+        last = users[-1]
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin_users|older|{last[9]}|{last[0]}"))
+    
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join(lines), reply_markup
+
+@callback_router.route('admin_users', needs_user=False)
+async def admin_users_page(query, user_data, args):
+    """Handle the /admin users paging buttons"""
+    if query.from_user.id != ADMIN_ID:
+        await query.edit_message_text("❌ You are not authorized to use this command.")
+        return
+    
+    direction, join_date, user_id = args.split('|')
+    cursor = (join_date, int(user_id))
+    if direction == 'newer':
+        page = await db.get_users_page(newer_than=cursor)
+    else:
+        page = await db.get_users_page(older_than=cursor)
+    
+    if not page['users']:
+        await query.edit_message_text("No users found.")
+        return
+    
+    message, reply_markup = render_users_page(page)
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+def message_length(text):
+    """Length of text as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def truncate_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Cut text to at most `limit` UTF-16 code units, ending in an ellipsis if cut"""
+    if message_length(text) <= limit:
+        return text
+    # A surrogate pair split by the cut is dropped whole
+    return text.encode('utf-16-le')[:(limit - 1) * 2].decode('utf-16-le', errors='ignore') + '…'
+
+async def iter_message_chunks(header, entries, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Pack formatted entries from an async iterator into messages within `limit`
+    
+    Entries are joined into a list and each message is built once, so
+    memory stays at one message no matter how many entries there are.
+    """
+    parts, size = [header], message_length(header)
+    async for entry in entries:
+        length = message_length(entry)
+        if length > limit:
+            entry = truncate_message(entry, limit)
+            length = message_length(entry)
+        if size + length > limit:
+            yield ''.join(parts)
+            parts, size = [], 0
+        parts.append(entry)
+        size += length
+    if parts:
+        yield ''.join(parts)
+
+async def send_listing(message, header, entries, filename, max_messages=ADMIN_LISTING_MAX_MESSAGES):
+    """Reply with a listing split into messages, or as a text file if it is too long
+    
+    Messages are held back until either the listing ends or it exceeds
+    `max_messages`; in the latter case everything is written to a temporary
+    file on disk and sent as a document.
+    """
+    chunks = iter_message_chunks(header, entries)
+    pending = []
+    async for chunk in chunks:
+        pending.append(chunk)
+        if len(pending) > max_messages:
+            break
+    else:
+        for chunk in pending:
+            await message.reply_text(chunk)
+        return
+    
+    with tempfile.TemporaryFile('w+b') as fileobj:
+        for chunk in pending:
+            fileobj.write(chunk.encode('utf-8'))
+        async for chunk in chunks:
+            fileobj.write(chunk.encode('utf-8'))
+        fileobj.seek(0)
+        await message.reply_document(fileobj, filename=filename, caption=header.strip())
+
+async def stream_pending_withdrawals():
+    """Yield pending withdrawals from the database one keyset chunk at a time"""
+    after_id = 0
+    while True:
+        rows = await db.get_pending_withdrawals_chunk(after_id)
+        for row in rows:
+            yield row
+        if len(rows) < PAYOUT_CHUNK_SIZE:
+            return
+        after_id = rows[-1][0]
+
+def format_withdrawal(row):
+    """Format one row of get_pending_withdrawals_chunk for admin listings"""
+    withdrawal_id, user_id, username, first_name, amount, payment_method, payment_details, created_at = row
+    return (
+        f"#{withdrawal_id} User: {first_name} (@{username or 'N/A'}, ID {user_id})\n"
+        f"Amount: ₹{amount:.2f}\n"
+        f"Method: {payment_method}\n"
+        f"Details: {payment_details}\n"
+        f"Date: {created_at[:10]}\n\n"
+    )
+
+def export_pending_withdrawals_file(path):
+    """Write the pending-withdrawal CSV to a file; returns the row count"""
+    with open(path, 'w', newline='', encoding='utf-8') as fileobj:
+        return database.export_pending_withdrawals_csv(fileobj)
+
+def import_withdrawal_decisions_file(path):
+    """Apply a decisions CSV file; returns the import summary"""
+    with open(path, newline='', encoding='utf-8') as fileobj:
+        return database.import_withdrawal_decisions_csv(fileobj)
+
+async def admin_payout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /admin payout subcommands"""
+    action = context.args[1].lower() if len(context.args) > 1 else ''
+    
+    if action == 'export':
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'pending_withdrawals.csv')
+            count = await db.run(export_pending_withdrawals_file, path)
+            if not count:
+                await update.message.reply_text("No pending withdrawals.")
+                return
+            with open(path, 'rb') as fileobj:
+                await update.message.reply_document(
+                    fileobj,
+                    filename=f"pending_withdrawals_{datetime.now():%Y%m%d_%H%M}.csv",
+                    caption=f"{count} pending withdrawals. Fill in the decision column "
+                            f"(approve/reject) and send the file back."
+                )
+    
+    elif action in ('approve', 'reject'):
+        try:
+            withdrawal_ids = [int(arg) for arg in context.args[2:]]
+        except ValueError:
+            withdrawal_ids = []
+        if not withdrawal_ids:
+            await update.message.reply_text(f"Usage: /admin payout {action} <withdrawal_id> [...]")
+            return
+        
+        summary = await db.process_withdrawals(withdrawal_ids, approve=action == 'approve')
+        await update.message.reply_text(
+            f"✅ {summary['processed']} withdrawal(s) {action}d (₹{summary['amount']:.2f}), "
+            f"{summary['skipped']} skipped (unknown or not pending)."
+        )
+    
+    else:
+        await update.message.reply_text(
+            "**Payout Commands:**\n\n"
+            "/admin payout export - Download pending withdrawals as CSV\n"
+            "/admin payout approve <id> [...] - Mark withdrawals as paid\n"
+            "/admin payout reject <id> [...] - Reject and refund withdrawals\n\n"
+            "Send an exported CSV back with the decision column filled in to process it in bulk."
+        )
+
+async def payout_import_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle an uploaded payout decisions CSV (admin only)"""
+    tg_file = await update.message.document.get_file()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'decisions.csv')
+        await tg_file.download_to_drive(path)
+        try:
+            summary = await db.run(import_withdrawal_decisions_file, path, write=True)
+        except (csv.Error, UnicodeDecodeError) as e:
+            await update.message.reply_text(f"❌ Could not read the CSV file: {e}")
+            return
+    
+    await update.message.reply_text(
+        f"**Payout Import:**\n\n"
+        f"Approved: {summary['approved']}\n"
+        f"Rejected and refunded: {summary['rejected']}\n"
+        f"Skipped (not pending): {summary['skipped']}\n"
+        f"Rows without a decision: {summary['ignored']}\n"
+        f"Amount processed: ₹{summary['amount']:.2f}"
+    )
+
+class Profiler:
+    """Runs cProfile over the event loop thread for a fixed time
+    
+    Handlers, the rate limiter and the digest all run on that thread; the
+    DB threads are not profiled (their time shows up in db_call_seconds).
+    Only one profile runs at a time.
+    """
+    
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.running = False
+        self.task = None
+    
+    async def run(self, seconds):
+        """Profile for `seconds`; return the .prof path and a text summary"""
+        if self.running:
+            raise RuntimeError("a profile is already running")
+        
+        self.running = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+        finally:
+            self.running = False
+        
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        profile.dump_stats(path)
+        
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).strip_dirs().sort_stats('cumulative').print_stats(15)
+        return path, summary.getvalue().strip()
+
+profiler = Profiler()
+
+def parse_duration(text):
+    """Parse '30', '30s', '2m' or '1h' into seconds"""
+    text = text.strip().lower()
+    unit = 1
+    if text.endswith('h'):
+        unit, text = 3600, text[:-1]
+    elif text.endswith('m'):
+        unit, text = 60, text[:-1]
+    elif text.endswith('s'):
+        text = text[:-1]
+    return float(text) * unit
+
+async def send_profile(message, seconds):
+    """Profile the running bot and reply with the .prof file and top functions"""
+    try:
+        path, summary = await profiler.run(seconds)
+        with open(path, 'rb') as fileobj:
+            await message.reply_document(
+                fileobj,
+                filename=os.path.basename(path),
+                caption=f"Profile of {seconds:.0f}s. Open with snakeviz or flameprof for a flame graph."
+            )
+        await message.reply_text(summary[:TELEGRAM_MESSAGE_LIMIT])
+    except Exception as e:
+        logger.error(f"Profiling failed: {e}")
+        await message.reply_text(f"❌ Profiling failed: {e}")
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /admin profile [duration]"""
+    try:
+        seconds = parse_duration(context.args[1] if len(context.args) > 1 else '30s')
+    except ValueError:
+        seconds = 0
+    
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(
+            f"Usage: /admin profile <duration>, e.g. /admin profile 30s (at most {PROFILE_MAX_SECONDS}s)"
+        )
+        return
+    
+    if profiler.running:
+        await update.message.reply_text("A profile is already running.")
         return
     
-    referral_link = f"https://t.me/Earnyha_bot?start={user_data['referral_code']}"
+    await update.message.reply_text(f"⏱ Profiling the bot for {seconds:.0f}s...")
+    # Not application.create_task: stopping the bot must not wait for the profile
+    profiler.task = asyncio.create_task(send_profile(update.message, seconds))
+
+def format_leaders(title, leaders):
+    """Format (user_id, direct, downline) rows as a ranked list"""
+    lines = [f"**{title}:**"]
+    for rank, (user_id, direct, downline) in enumerate(leaders, 1):
+        lines.append(f"{rank}. {user_id}: {direct} direct, {downline} in downline")
+    if not leaders:
+        lines.append("No referrals yet.")
+    return "\n".join(lines)
+
+async def admin_graph(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /admin graph [user <id> | bursts [window] [threshold]]"""
+    graph = database.referral_graph
+    args = [arg.lower() for arg in context.args[1:]]
+    
+    if args[:1] == ['user'] and len(args) > 1 and args[1].isdigit():
+        user_id = int(args[1])
+        if graph is None:
+            members, depth = await db.get_downline(user_id)
+            await update.message.reply_text(
+                f"**Referral Graph for {user_id}:**\n\nDownline: {members} users, {depth} levels deep"
+            )
+            return
+        
+        # Walks up to REFERRAL_GRAPH_MAX_WALK members under the graph lock; keep it off the event loop
+        profile = await asyncio.to_thread(graph.profile, user_id)
+        if profile is None:
+            await update.message.reply_text(f"User {user_id} has not referred or been referred by anyone.")
+            return
+        levels = ", ".join(f"L{level}: {count}" for level, count in enumerate(profile['levels'], 1))
+        await update.message.reply_text(
+            f"**Referral Graph for {user_id}:**\n\n"
+            f"Referred by: {' ← '.join(map(str, profile['upline'])) or 'nobody'}\n"
+            f"Chain depth: {profile['depth']}\n"
+            f"Direct referrals: {profile['direct']}\n"
+            f"Downline: {profile['downline']} users\n"
+            f"Per level: {levels or 'none'}{'' if profile['levels_complete'] else ' (truncated)'}\n"
+            f"Cluster: {profile['cluster']} users under {profile['cluster_root']}"
+        )
+        return
+    
+    if graph is None:
+        await update.message.reply_text("Referral graph is disabled. Use /admin graph user <id> for a SQL count.")
+        return
+    
+    if args[:1] == ['bursts']:
+        try:
+            window = parse_duration(args[1]) if len(args) > 1 else REFERRAL_BURST_WINDOW
+            threshold = int(args[2]) if len(args) > 2 else REFERRAL_BURST_THRESHOLD
+        except ValueError:
+            window = threshold = 0
+        if window <= 0 or threshold <= 0:
+            await update.message.reply_text("Usage: /admin graph bursts [window, e.g. 1h] [threshold]")
+            return
+        
+        bursts = await asyncio.to_thread(graph.bursts, window, threshold)
+        lines = [
+            f"**Referral Bursts (≥{threshold} in {window / 60:.0f} min, "
+            f"last {graph.burst_history / 3600:.0f}h):**\n"
+        ]
+        for user_id, count, ended in bursts:
+            ended = datetime.fromtimestamp(ended, timezone.utc).strftime('%Y-%m-%d %H:%M')
+            lines.append(f"• {user_id}: {count} referrals in the window ending {ended} UTC")
+        if not bursts:
+            lines.append("No referrer crossed the threshold.")
+        await update.message.reply_text("\n".join(lines))
+        return
+    
+    stats = graph.stats()
     await update.message.reply_text(
-        f"👥 **Your Referral Information**\n\n"
-        f"Your referral code: {user_data['referral_code']}\n"
-        f"Your referral link:\n{referral_link}\n\n"
-        f"Total referrals: {user_data['total_referrals']}\n"
-        f"Earned per referral: ₹{REFERRAL_BONUS}\n\n"
-        f"💡 Share this link with friends to earn money!"
+        f"**Referral Graph:**\n\n"
+        f"Users: {stats['users']}\n"
+        f"Referrals: {stats['referrals']} ({stats['ignored']} repeated or cyclic skipped)\n"
+        f"Deepest chain: {stats['max_depth']}\n"
+        f"Memory: {stats['memory_bytes'] / 1024 / 1024:.1f} MiB\n\n"
+        f"{format_leaders('Top Referrers', graph.top('direct'))}\n\n"
+        f"{format_leaders('Largest Downlines', graph.top('downline'))}"
     )
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -500,138 +3665,709 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(
             "**Admin Commands:**\n\n"
-            "/admin users - Show all users\n"
+            "/admin users - Browse users, newest first\n"
             "/admin withdrawals - Show pending withdrawals\n"
-            "/admin stats - Show bot statistics"
+            "/admin stats - Show bot statistics\n"
+            "/admin cache - Show user cache and referral index statistics\n"
+            "/admin writes - Show group commit statistics\n"
+            "/admin outbox - Show outgoing message queue statistics\n"
+            "/admin routes - Show button response times per screen\n"
+            "/admin payout - Export, approve or reject pending withdrawals\n"
+            "/admin ledger [repair] - Check every balance against the ledger\n"
+            "/admin graph [user <id> | bursts 1h] - Referral leaders, downlines and bursts\n"
+            "/admin backup [now] - List backups or take one now\n"
+            "/admin profile 30s - Profile the bot and send the result"
         )
         return
     
     command = context.args[0].lower()
     
     if command == 'users':
-        users = db.get_all_users()
-        if not users:
+        page = await db.get_users_page()
+        if not page['users']:
             await update.message.reply_text("No users found.")
             return
         
-        message = "**All Users:**\n\n"
-        for user in users[:10]:  # Show first 10 users
-            message += f"ID: {user[0]}\n"
-            message += f"Name: {user[2]} {user[3] or ''}\n"
-            message += f"Username: @{user[1] or 'N/A'}\n"
-            message += f"Balance: ₹{user[6]:.2f}\n"
-            message += f"Referrals: {user[8]}\n"
-            message += f"Joined: {user[9][:10]}\n\n"
+        message, reply_markup = render_users_page(page)
+        await update.message.reply_text(message, reply_markup=reply_markup)
+    
+    elif command == 'payout':
+        await admin_payout(update, context)
+    
+    elif command == 'profile':
+        await admin_profile(update, context)
+    
+    elif command == 'graph':
+        await admin_graph(update, context)
+    
+    elif command == 'ledger':
+        repair = len(context.args) > 1 and context.args[1].lower() == 'repair'
+        await update.message.reply_text("🧾 Replaying the ledger...")
+        result = await db.verify_ledger(repair=repair)
+        
+        lines = [
+            "**Ledger Verification:**\n",
+            f"Users: {result['users']}",
+            f"Entries replayed: {result['entries']} in {result['seconds']:.1f}s",
+            f"Mismatched balances: {result['mismatched']}",
+            f"Ledger users without an account: {result['orphaned']}"
+        ]
+        for user_id, balance, replayed_balance, earned, replayed_earned in result['reported']:
+            lines.append(
+                f"• {user_id}: balance ₹{balance / 100:.2f} (ledger ₹{replayed_balance / 100:.2f}), "
+                f"earned ₹{earned / 100:.2f} (ledger ₹{replayed_earned / 100:.2f})"
+            )
+        if repair:
+            lines.append(f"\n✅ Repaired {result['repaired']} balance(s) from the ledger")
+        elif result['mismatched']:
+            lines.append("\nUse /admin ledger repair to rewrite them from the ledger.")
+        await update.message.reply_text("\n".join(lines))
+    
+    elif command == 'backup':
+        if len(context.args) > 1 and context.args[1].lower() == 'now':
+            await update.message.reply_text("💾 Backing up the database...")
+            try:
+                result = await asyncio.to_thread(database.backup)
+            except BackupInProgress:
+                await update.message.reply_text("⏳ A backup is already running; check /admin backup when it is done.")
+                return
+            except (OSError, sqlite3.Error) as e:
+                await update.message.reply_text(f"❌ Backup failed: {e}")
+                return
+            await update.message.reply_text(
+                f"✅ Backup {result['name']} written: {result['bytes'] / 1024 / 1024:.1f} MiB in "
+                f"{result['seconds']:.1f}s, {result['pruned']} old backup(s) pruned"
+            )
+            return
+        
+        backups = list_backups()
+        if not backups:
+            await update.message.reply_text("No backups yet. Use /admin backup now to take one.")
+            return
         
-        await update.message.reply_text(message)
+        lines = [f"**Backups ({len(backups)} kept, newest first):**\n"]
+        for path, manifest in backups:
+            lines.append(
+                f"• {os.path.basename(path)}: schema v{manifest['schema_version']}, {len(manifest['files'])} file(s)"
+            )
+        if BACKUP_INTERVAL:
+            lines.append(f"\nA backup runs every {BACKUP_INTERVAL / 3600:g}h; {BACKUP_RETENTION} are kept.")
+        lines.append("Restore with: python EarnyHa.py restore <name>")
+        await update.message.reply_text("\n".join(lines))
     
     elif command == 'withdrawals':
-        withdrawals = db.get_pending_withdrawals()
-        if not withdrawals:
+        stats = await db.get_bot_stats()
+        if not stats['pending_withdrawals']:
             await update.message.reply_text("No pending withdrawals.")
             return
         
-        message = "**Pending Withdrawals:**\n\n"
-        for withdrawal in withdrawals:
-            message += f"User: {withdrawal[9]} {withdrawal[10] or ''}\n"
-            message += f"Amount: ₹{withdrawal[2]:.2f}\n"
-            message += f"Method: {withdrawal[4]}\n"
-            message += f"Details: {withdrawal[5]}\n"
-            message += f"Date: {withdrawal[6][:10]}\n\n"
-        
-        await update.message.reply_text(message)
+        entries = (format_withdrawal(row) async for row in stream_pending_withdrawals())
+        await send_listing(
+            update.message,
+            f"**Pending Withdrawals ({stats['pending_withdrawals']}, oldest first):**\n\n",
+            entries,
+            'pending_withdrawals.txt'
+        )
     
     elif command == 'stats':
-        users = db.get_all_users()
-        total_users = len(users)
-        total_balance = sum(user[6] for user in users)
-        total_earned = sum(user[7] for user in users)
-        total_referrals = sum(user[8] for user in users)
+        stats = await db.get_bot_stats()
         
         await update.message.reply_text(
             f"**Bot Statistics:**\n\n"
-            f"Total Users: {total_users}\n"
-            f"Total Balance: ₹{total_balance:.2f}\n"
-            f"Total Earned: ₹{total_earned:.2f}\n"
-            f"Total Referrals: {total_referrals}"
+            f"Total Users: {stats['total_users']}\n"
+            f"Total Balance: ₹{stats['total_balance']:.2f}\n"
+            f"Total Earned: ₹{stats['total_earned']:.2f}\n"
+            f"Total Referrals: {stats['total_referrals']}\n"
+            f"Pending Withdrawals: {stats['pending_withdrawals']} (₹{stats['pending_amount']:.2f})"
+        )
+    
+    elif command == 'cache':
+        sections = []
+        if database.user_cache:
+            stats = database.user_cache.stats()
+            sections.append(
+                f"**User Cache:**\n\n"
+                f"Entries: {stats['size']}/{stats['max_size']}\n"
+                f"Hits: {stats['hits']}\n"
+                f"Misses: {stats['misses']}\n"
+                f"Hit rate: {stats['hit_rate']:.1%}\n"
+                f"Evictions: {stats['evictions']}"
+            )
+        else:
+            sections.append("User cache is disabled.")
+        
+        if database.referral_index is not None:
+            stats = database.referral_index.stats()
+            sections.append(
+                f"**Referral Code Index:**\n\n"
+                f"Codes: {stats['codes']}{'' if stats['complete'] else ' (over budget, partial)'}\n"
+                f"Memory: {stats['memory_bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MiB\n"
+                f"Hits: {stats['hits']}\n"
+                f"Unknown codes: {stats['misses']} (repeats served from cache: {stats['negative_hits']})\n"
+                f"SQLite fallbacks: {stats['fallbacks']}"
+            )
+        else:
+            sections.append("Referral code index is disabled.")
+        
+        await update.message.reply_text("\n\n".join(sections))
+    
+    elif command == 'writes':
+        writers = database.storage.writers
+        if not writers:
+            await update.message.reply_text("Group commit is disabled.")
+            return
+        
+        sections = []
+        for shard, writer in enumerate(writers):
+            stats = writer.stats()
+            sections.append(
+                f"**Group Commit{f' (shard {shard})' if len(writers) > 1 else ''}:**\n\n"
+                f"Queued writes: {stats['queued']}\n"
+                f"Batches committed: {stats['batches']}\n"
+                f"Writes committed: {stats['operations']}\n"
+                f"Failed batches: {stats['failed_batches']}\n"
+                f"Average batch: {stats['average_batch']:.1f} (max {stats['largest_batch']})\n"
+                f"Average commit: {stats['average_commit_ms']:.2f} ms\n"
+                f"Flush every {stats['flush_interval_ms']:.0f} ms or {stats['batch_size']} writes"
+            )
+        await update.message.reply_text("\n\n".join(sections))
+    
+    elif command == 'routes':
+        stats = callback_router.stats()
+        if not stats:
+            await update.message.reply_text("No button presses handled yet.")
+            return
+        
+        lines = ["**Button Routes (slowest first):**\n"]
+        for name, route in stats.items():
+            lines.append(
+                f"{name}: {route['count']} calls, avg {route['average'] * 1000:.1f} ms, "
+                f"p50/p95/max {route['p50'] * 1000:.0f}/{route['p95'] * 1000:.0f}/"
+                f"{route['max'] * 1000:.0f} ms"
+            )
+        await update.message.reply_text("\n".join(lines))
+    
+    elif command == 'outbox':
+        rate_limiter = context.bot.rate_limiter
+        if not rate_limiter:
+            await update.message.reply_text("Outgoing rate limiting is disabled.")
+            return
+        
+        stats = rate_limiter.stats()
+        await update.message.reply_text(
+            f"**Outgoing Messages:**\n\n"
+            f"Waiting for send slot: {stats['waiting']}\n"
+            f"Sent: {stats['sent']}\n"
+            f"Flood-control retries: {stats['retries']}\n"
+            f"Failed after retries: {stats['failed']}\n"
+            f"Tracked chats: {stats['chats']}\n"
+            f"Send latency p50/p95/max: {stats['latency_p50'] * 1000:.0f}/"
+            f"{stats['latency_p95'] * 1000:.0f}/{stats['latency_max'] * 1000:.0f} ms\n"
+            f"Withdrawal digests: {withdrawal_digest.digests_sent} sent for "
+            f"{withdrawal_digest.events_received} requests"
         )
 
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /menu command"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     
     if not user_data:
-        await update.message.reply_text("❌ User not found. Please use /start to register.")
+        await update.message.reply_text(USER_NOT_FOUND_MESSAGE)
         return
     
-    keyboard = [
-        [InlineKeyboardButton("💰 Balance", callback_data='balance')],
-        [InlineKeyboardButton("👥 Referrals", callback_data='referrals')],
-        [InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
-        [InlineKeyboardButton("📊 Statistics", callback_data='stats')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        f"Welcome back, {update.effective_user.first_name}! 🎉\n\n"
-        f"Your current balance: ₹{user_data['balance']:.2f}\n"
-        f"Total referrals: {user_data['total_referrals']}\n\n"
-        f"What would you like to do?",
-        reply_markup=reply_markup
-    )
+    text, reply_markup = render('main_menu', **screen_fields(user_data, update.effective_user.first_name))
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command"""
-    keyboard = [
-        [InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')],
-        [InlineKeyboardButton("💰 Balance", callback_data='balance')],
-        [InlineKeyboardButton("👥 Referrals", callback_data='referrals')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "**EarnyHa Bot - Help**\n\n"
-        "**Available Commands:**\n"
-        "/start - Register or view main menu\n"
-        "/menu - Show main menu\n"
-        "/balance - Check your balance\n"
-        "/referrals - Get your referral link\n"
-        "/withdraw <amount> <method> <details> - Request withdrawal\n"
-        "/help - Show this help message\n\n"
-        "**How to earn:**\n"
-        "1. Share your referral link with friends\n"
-        "2. Earn ₹10 for each successful referral\n"
-        "3. Withdraw when you reach ₹50\n\n"
-        "**Contact:** For support, contact the bot administrator.",
-        reply_markup=reply_markup
-    )
+    await update.message.reply_text(HELP_TEXT, reply_markup=HELP_KEYBOARD)
+
+async def reconcile_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically verify bot_stats against the base tables"""
+    drift = await db.reconcile_stats()
+    if not drift:
+        logger.info("bot_stats counters match the base tables")
+
+async def referral_credit_job(context: ContextTypes.DEFAULT_TYPE):
+    """Credit referrers on another shard; bonuses a failed drain left queued are retried here"""
+    await db.settle_referral_credits()
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically back up the database while the bot keeps running"""
+    # A thread of its own: a long backup must not tie up a database worker
+    try:
+        await asyncio.to_thread(database.backup)
+    except BackupInProgress:
+        logger.info("Skipping the scheduled backup; one is already running")
+    except (OSError, sqlite3.Error) as e:
+        metrics.inc('errors_total', error=type(e).__name__)
+        logger.error(f"Scheduled backup failed: {e}")
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors"""
+    metrics.inc('errors_total', error=type(context.error).__name__)
     logger.error(f"Update {update} caused error {context.error}")
 
-def main():
-    """Start the bot"""
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    """Start the metrics endpoint and warm the user cache once the bot is initialized"""
+    if METRICS_PORT:
+        try:
+            metrics_server.start()
+        except OSError as e:
+            logger.warning(f"Metrics endpoint disabled, cannot listen on port {metrics_server.port}: {e}")
+    await asyncio.to_thread(database.warm_cache_snapshot)
+
+async def post_stop(application: Application):
+    """Send pending notifications while the bot can still reach Telegram"""
+    await withdrawal_digest.stop(application.bot)
+
+async def post_shutdown(application: Application):
+    """Release database resources once the bot has stopped"""
+    metrics_server.stop()
+    db.shutdown()
+    database.save_cache_snapshot()
+    database.close()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while serializing each user's own updates
+    
+    Updates from different users run in parallel up to the processor limit.
+    Updates from the same user (e.g. a double-clicked button) wait for the
+    previous one to finish and run in arrival order. Only the update holding
+    its user's lock takes one of the processor's slots, so a user hammering
+    a slow button cannot starve everyone else.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}
+    
+    async def process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # The user's lock first, then a slot
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+class TokenBucket:
+    """Async token bucket refilled at `rate` tokens per second up to `burst`"""
+    
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        """Wait for a token; waiters are served first come, first served"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def block(self, seconds):
+        """Hand out no tokens for the next `seconds` (flood control)"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+        self.updated = now
+    
+    def is_idle(self, now):
+        """True when the bucket is full and nobody is waiting on it"""
+        return not self._lock.locked() and self.tokens + (now - self.updated) * self.rate >= self.burst
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Schedules every Bot API call that targets a chat through token buckets
+    
+    Each call waits for a token from its chat's bucket and from the global
+    bucket, so bursts are smoothed out instead of hitting Telegram's limits.
+    A RetryAfter pauses the chat and global buckets for the requested time
+    and retries the call up to `max_retries` times. Per-call overrides can
+    be passed as `rate_limit_args={'max_retries': n}`.
+    """
+    
+    # Per-chat buckets are dropped once idle if more than this many exist
+    MAX_IDLE_BUCKETS = 10000
+    
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 group_rate=SEND_GROUP_RATE, max_retries=SEND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.waiting = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)
+        self._global = None
+        self._chats = {}
+    
+    async def initialize(self):
+        self._global = TokenBucket(self.global_rate, max(1, int(self.global_rate)))
+    
+    async def shutdown(self):
+        self._chats.clear()
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > self.MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                for idle in [key for key, value in self._chats.items() if value.is_idle(now)]:
+                    del self._chats[idle]
+            # Negative ids are groups and channels, which Telegram limits harder
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # Not a message to a chat (answerCallbackQuery, getMe, ...)
+            return await callback(*args, **kwargs)
+        
+        max_retries = (rate_limit_args or {}).get('max_retries', self.max_retries)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            self.waiting += 1
+            try:
+                await self._chat_bucket(chat_id).acquire()
+                await self._global.acquire()
+            finally:
+                self.waiting -= 1
+            
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                self._chat_bucket(chat_id).block(retry_after)
+                self._global.block(retry_after)
+                if attempt >= max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Flood control on {endpoint} to {chat_id}; retrying in {retry_after}s")
+                continue
+            
+            self.sent += 1
+            self.latencies.append(time.monotonic() - started)
+            return result
+    
+    def stats(self):
+        """Return queue depth and send latency for the admin panel"""
+        latencies = sorted(self.latencies)
+        
+        def percentile(pct):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * pct))] if latencies else 0.0
+        
+        return {
+            'waiting': self.waiting,
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'chats': len(self._chats),
+            'latency_p50': percentile(0.50),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else 0.0
+        }
+
+# Update types each handler class needs Telegram to deliver. Commands only
+# read update.message, so edited messages are deliberately not requested.
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: (Update.MESSAGE,),
+    MessageHandler: (Update.MESSAGE,),
+    CallbackQueryHandler: (Update.CALLBACK_QUERY,),
+    TypeHandler: (),  # only used to observe updates the other handlers asked for
+}
+
+def allowed_update_types(application):
+    """Derive the allowed_updates list from the registered handlers"""
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler_types = HANDLER_UPDATE_TYPES.get(type(handler))
+            if handler_types is None:
+                logger.warning(f"No update types known for {type(handler).__name__}; requesting all updates")
+                return Update.ALL_TYPES
+            types.update(handler_types)
+    return sorted(types)
+
+def update_type(update):
+    """Name of the update's payload field, e.g. 'message' or 'callback_query'"""
+    for kind in Update.ALL_TYPES:
+        if getattr(update, kind, None) is not None:
+            return str(kind)
+    return 'unknown'
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Count incoming updates by type; runs before the regular handlers"""
+    metrics.inc('updates_total', type=update_type(update))
+
+def instrumented(callback):
+    """Wrap a handler callback to record its latency and failures"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('handler_errors_total', handler=callback.__name__)
+            raise
+        finally:
+            metrics.observe('handler_seconds', time.perf_counter() - started, handler=callback.__name__)
+    return wrapper
+
+def collect_bot_metrics():
+    """Metrics kept by other components, read at scrape time"""
+    waits = lock_waits.stats()
+    yield 'db_write_transactions_total', 'counter', "Write transactions started", [({}, waits['begins'])]
+    yield 'db_lock_waits_total', 'counter', "Write transactions that waited for SQLite's write lock", [
+        ({}, waits['waits'])
+    ]
+    yield 'db_lock_wait_seconds_total', 'counter', "Time spent waiting for SQLite's write lock", [
+        ({}, waits['wait_seconds'])
+    ]
+    yield 'db_lock_timeouts_total', 'counter', "Write transactions that failed with database is locked", [
+        ({}, waits['timeouts'])
+    ]
+    
+    if database.user_cache:
+        stats = database.user_cache.stats()
+        yield 'user_cache_lookups_total', 'counter', "User cache lookups by result", [
+            ({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])
+        ]
+        yield 'user_cache_entries', 'gauge', "User records in the cache", [({}, stats['size'])]
+    
+    if database.referral_index is not None:
+        stats = database.referral_index.stats()
+        yield 'referral_index_codes', 'gauge', "Referral codes held in memory", [({}, stats['codes'])]
+        yield 'referral_index_bytes', 'gauge', "Estimated memory used by the referral index", [
+            ({}, stats['memory_bytes'])
+        ]
+        yield 'referral_lookups_total', 'counter', "Referral code lookups by outcome", [
+            ({'result': 'hit'}, stats['hits']),
+            ({'result': 'unknown'}, stats['misses']),
+            ({'result': 'negative_cached'}, stats['negative_hits']),
+            ({'result': 'sqlite'}, stats['fallbacks'])
+        ]
+    
+    if database.referral_graph is not None:
+        stats = database.referral_graph.stats()
+        yield 'referral_graph_users', 'gauge', "Users in the in-memory referral graph", [({}, stats['users'])]
+        yield 'referral_graph_max_depth', 'gauge', "Longest referral chain", [({}, stats['max_depth'])]
+        yield 'referral_graph_bytes', 'gauge', "Estimated memory used by the referral graph", [
+            ({}, stats['memory_bytes'])
+        ]
+    
+    if database.last_backup:
+        yield 'backup_last_success_timestamp_seconds', 'gauge', "When the last successful backup started", [
+            ({}, database.last_backup['created'])
+        ]
+        yield 'backup_last_bytes', 'gauge', "Size of the last backup", [({}, database.last_backup['bytes'])]
+        yield 'backup_last_duration_seconds', 'gauge', "Time the last backup took", [
+            ({}, database.last_backup['seconds'])
+        ]
+    
+    if database.storage.writers:
+        stats = [(str(shard), writer.stats()) for shard, writer in enumerate(database.storage.writers)]
+        yield 'group_commit_batches_total', 'counter', "Group commit batches committed, by shard", [
+            ({'shard': shard}, shard_stats['batches']) for shard, shard_stats in stats
+        ]
+        yield 'group_commit_writes_total', 'counter', "Writes committed via group commit, by shard", [
+            ({'shard': shard}, shard_stats['operations']) for shard, shard_stats in stats
+        ]
+    
+    yield 'callback_route_seconds', 'histogram', "Time to handle a button press, by route", [
+        ({'route': name}, histogram) for name, histogram in callback_router.latency.items()
+    ]
+
+metrics.add_collector(collect_bot_metrics)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics in the Prometheus text format"""
+    
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        # Scraped every few seconds; keep it out of the bot's log
+        pass
+
+class MetricsServer:
+    """HTTP server for the metrics endpoint, on its own thread"""
+    
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT):
+        self.listen = listen
+        self.port = port
+        self._server = None
+        self._thread = None
+    
+    def start(self):
+        self._server = ThreadingHTTPServer((self.listen, self.port), MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on http://{self.listen}:{self.port}/metrics")
+    
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+metrics_server = MetricsServer()
+
+def build_application(builder=None, rate_limiter=None):
+    """Create the Application with all handlers and background jobs registered
+    
+    Pass a pre-configured ApplicationBuilder to swap the token or the
+    request backends (e.g. a fake Bot API in benchmarks), and a rate
+    limiter to replace the default OutboundRateLimiter.
+    """
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    builder = builder.rate_limiter(rate_limiter or OutboundRateLimiter())
+    application = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
+    
+    # Count every update before the handlers see it
+    application.add_handler(TypeHandler(Update, count_update), group=-1)
     
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("menu", menu_command))
-    application.add_handler(CommandHandler("balance", balance_command))
-    application.add_handler(CommandHandler("referrals", referrals_command))
-    application.add_handler(CommandHandler("withdraw", withdraw_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CommandHandler("start", instrumented(start)))
+    application.add_handler(CommandHandler("menu", instrumented(menu_command)))
+    application.add_handler(CommandHandler("balance", instrumented(balance_command)))
+    application.add_handler(CommandHandler("referrals", instrumented(referrals_command)))
+    application.add_handler(CommandHandler("withdraw", instrumented(withdraw_command)))
+    application.add_handler(CommandHandler("admin", instrumented(admin_command)))
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CallbackQueryHandler(instrumented(button_handler)))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("csv") & filters.User(ADMIN_ID) & filters.ChatType.PRIVATE,
+        instrumented(payout_import_handler)
+    ))
     
     # Add error handler
     application.add_error_handler(error_handler)
     
+    # Schedule background jobs
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            reconcile_stats_job, interval=STATS_RECONCILE_INTERVAL, first=STATS_RECONCILE_INTERVAL
+        )
+        if database.storage.shard_count > 1:
+            application.job_queue.run_repeating(
+                referral_credit_job, interval=REFERRAL_CREDIT_INTERVAL, first=REFERRAL_CREDIT_INTERVAL
+            )
+        if BACKUP_INTERVAL:
+            application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+    else:
+        logger.warning(
+            "JobQueue unavailable (install APScheduler); bot_stats reconciliation and backups disabled, "
+            "and cross-shard referral bonuses wait for a restart"
+        )
+    
+    return application
+
+def webhook_settings():
+    """Return the run_webhook arguments for the configured webhook"""
+    if not WEBHOOK_URL:
+        raise ValueError("UPDATE_MODE is 'webhook' but WEBHOOK_URL is not set")
+    
+    return {
+        'listen': WEBHOOK_LISTEN,
+        'port': WEBHOOK_PORT,
+        'url_path': WEBHOOK_PATH,
+        'webhook_url': f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        # Telegram echoes the secret in every POST; anything else gets a 403
+        'secret_token': WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        'max_connections': WEBHOOK_MAX_CONNECTIONS
+    }
+
+def main(argv=None):
+    """Start the bot
+    
+    `python EarnyHa.py backup` takes one backup and exits;
+    `python EarnyHa.py restore <name|path|latest>` restores a backup, with
+    caches warmed from it, and then starts the bot.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['backup']:
+        database.backup()
+        database.close()
+        return
+    if argv[:1] == ['restore']:
+        result = database.restore(find_backup(argv[1] if len(argv) > 1 else 'latest'))
+        print(f"♻️ Restored the backup taken {result['created']}; {result['users_warmed']} users warmed")
+        # The restored cache is already warm; an older snapshot would only evict it
+        if os.path.isfile(CACHE_SNAPSHOT_PATH):
+            os.remove(CACHE_SNAPSHOT_PATH)
+    
+    application = build_application()
+    
     # Start the bot
     print("🤖 EarnyHa Bot is starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    allowed_updates = allowed_update_types(application)
+    if UPDATE_MODE == 'webhook':
+        application.run_webhook(allowed_updates=allowed_updates, **webhook_settings())
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
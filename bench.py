@@ -0,0 +1,1676 @@
+"""Benchmarks and consistency checks for the EarnyHa bot
+
+Usage: python bench.py <benchmark> [options]
+Run `python bench.py -h` for the list of benchmarks.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import random
+import re
+import statistics
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import Application, ExtBot
+from telegram.request import BaseRequest
+
+import EarnyHa
+
+FAKE_TOKEN = "123456:BENCH"
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': "EarnyHa", 'username': "Earnyha_bot"}
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, samples):
+    """Print mean/p50/p99 of latency samples given in seconds"""
+    print(
+        f"{name:<28} n={len(samples):<7} "
+        f"mean={statistics.mean(samples) * 1e6:8.1f}us "
+        f"p50={percentile(samples, 50) * 1e6:8.1f}us "
+        f"p99={percentile(samples, 99) * 1e6:8.1f}us"
+    )
+
+
+def temp_db_path(tmpdir, name):
+    return os.path.join(tmpdir, f"{name}.db")
+
+
+def use_temp_database(db_path, **options):
+    """Point the bot's handlers at a fresh database"""
+    options.setdefault('referral_index', EarnyHa.ReferralCodeIndex())
+    options.setdefault('referral_graph', EarnyHa.ReferralGraph())
+    EarnyHa.database = EarnyHa.DatabaseManager(db_path, pooled=True, user_cache=EarnyHa.UserCache(), **options)
+    EarnyHa.db = EarnyHa.AsyncDatabaseManager(EarnyHa.database)
+    return EarnyHa.database
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotAPI(BaseRequest):
+    """In-process stand-in for the Telegram Bot API
+
+    Answers the methods the bot uses, serves queued updates to getUpdates
+    and counts outgoing messages so benchmarks know when work is done.
+    With `flood_control` it enforces Telegram-like send limits (per chat
+    and global, per second) and answers 429 RetryAfter when exceeded.
+    """
+
+    def __init__(self, latency=0.0, flood_control=False, chat_limit=3, global_limit=30):
+        self.latency = latency
+        self.flood_control = flood_control
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.flood_errors = 0
+        self._recent = {}
+        self.updates = []
+        self.calls = {}
+        self.sent = 0
+        self.sent_event = asyncio.Event()
+        self.expected = None
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def expect(self, count):
+        """Set the number of outgoing messages that completes a run"""
+        self.sent = 0
+        self.expected = count
+        self.sent_event = asyncio.Event()
+
+    def _flooded(self, chat_id):
+        """Record a send and report whether it breaks the one-second limits"""
+        now = time.monotonic()
+        for key, limit in ((chat_id, self.chat_limit), (None, self.global_limit)):
+            window = self._recent.setdefault(key, [])
+            while window and window[0] <= now - 1:
+                window.pop(0)
+            if len(window) >= limit:
+                return True
+        self._recent[chat_id].append(now)
+        self._recent[None].append(now)
+        return False
+
+    def _message(self, params):
+        return {
+            'message_id': params.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': params.get('chat_id') or 0, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint == 'getUpdates':
+            offset = params.get('offset') or 0
+            pending = [u for u in self.updates if u['update_id'] >= offset][:params.get('limit', 100)]
+            if not pending:
+                await asyncio.sleep(0.01)
+            result = pending
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+            if self.flood_control and self._flooded(params.get('chat_id')):
+                self.flood_errors += 1
+                return 429, json.dumps({
+                    'ok': False, 'error_code': 429, 'description': "Too Many Requests: retry after 1",
+                    'parameters': {'retry_after': 1},
+                }).encode()
+            result = self._message(params)
+            self.sent += 1
+            if self.expected is not None and self.sent >= self.expected:
+                self.sent_event.set()
+        else:
+            # setWebhook, deleteWebhook, answerCallbackQuery, ...
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def fake_application(api, send_rate=None):
+    """Build the bot Application wired to a FakeBotAPI
+
+    The fake API has no real send limits, so benchmarks measuring handler
+    throughput pass a high `send_rate` to keep the rate limiter out of the way.
+    """
+    builder = (
+        Application.builder().token(FAKE_TOKEN)
+        .request(api).get_updates_request(api)
+    )
+    rate_limiter = None
+    if send_rate:
+        rate_limiter = EarnyHa.OutboundRateLimiter(global_rate=send_rate, chat_rate=send_rate, chat_burst=send_rate)
+    return EarnyHa.build_application(builder, rate_limiter)
+
+
+_update_ids = itertools.count(1)
+
+
+def command_update(user_id, text):
+    """Build a raw Telegram update for a private-chat command"""
+    command = text.split()[0]
+    return {
+        'update_id': next(_update_ids),
+        'message': {
+            'message_id': next(_update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }
+
+
+def callback_update(user_id, data):
+    """Build a raw Telegram update for an inline button press"""
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'chat_instance': str(user_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+            'data': data,
+            'message': {
+                'message_id': next(_update_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': "menu",
+            },
+        },
+    }
+
+
+def recorded_updates(count, first_user_id=1000):
+    """A signup followed by menu clicks for each simulated user"""
+    updates = []
+    for n in range(count):
+        user_id = first_user_id + n // 3
+        if n % 3 == 0:
+            updates.append(command_update(user_id, "/start"))
+        else:
+            updates.append(callback_update(user_id, random.choice(['balance', 'referrals', 'stats'])))
+    return updates
+
+
+def bench_db_calls(args):
+    """Per-call latency of DatabaseManager with and without the connection pool and user cache"""
+    modes = (("per-call", False, False), ("pooled", True, False), ("pooled+cache", True, True))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, pooled, cached in modes:
+            user_cache = EarnyHa.UserCache() if cached else None
+            db = EarnyHa.DatabaseManager(temp_db_path(tmpdir, label), pooled=pooled, user_cache=user_cache)
+
+            samples = []
+            for user_id in range(1, args.users + 1):
+                started = time.perf_counter()
+                db.add_user(user_id, f"user{user_id}", "Bench", None)
+                samples.append(time.perf_counter() - started)
+            report(f"{label} add_user", samples)
+
+            samples = []
+            for _ in range(args.calls):
+                user_id = random.randint(1, args.users)
+                started = time.perf_counter()
+                db.get_user(user_id)
+                samples.append(time.perf_counter() - started)
+            report(f"{label} get_user", samples)
+            if user_cache:
+                print(f"{'':<28} cache {user_cache.stats()}")
+
+            db.close()
+
+
+async def _heartbeat(lags, stop, interval=0.005):
+    """Record how late the event loop wakes a periodic timer"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def _burst(adb, sync_db, concurrency, first_id, referrer_code):
+    """Fire one referral signup plus menu read per simulated user at once
+
+    Latency is measured from the start of the burst, as seen by an update
+    that arrived together with all the others.
+    """
+    started = time.perf_counter()
+
+    async def handle(user_id):
+        if adb:
+            referrer = await adb.get_user_by_referral_code(referrer_code)
+            await adb.add_user(user_id, None, "Burst", None, referrer)
+            await adb.get_user(user_id)
+        else:
+            referrer = sync_db.get_user_by_referral_code(referrer_code)
+            sync_db.add_user(user_id, None, "Burst", None, referrer)
+            sync_db.get_user(user_id)
+        return time.perf_counter() - started
+
+    lags, stop = [], asyncio.Event()
+    ticker = asyncio.create_task(_heartbeat(lags, stop))
+    await asyncio.sleep(0)
+    latencies = await asyncio.gather(*(handle(first_id + n) for n in range(concurrency)))
+    stop.set()
+    await ticker
+    return latencies, lags
+
+
+def bench_async_burst(args):
+    """Event-loop lag and handler latency during a referral burst, sync vs async DB calls"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, use_async in (("sync", False), ("async", True)):
+            db = EarnyHa.DatabaseManager(temp_db_path(tmpdir, label), pooled=True, pool_size=args.workers)
+            db.add_user(1, "referrer", "Referrer", None)
+            code = db.get_user(1)['referral_code']
+            adb = EarnyHa.AsyncDatabaseManager(db, max_workers=args.workers) if use_async else None
+
+            first_id = 2
+            for concurrency in args.concurrency:
+                latencies, lags = asyncio.run(_burst(adb, db, concurrency, first_id, code))
+                first_id += concurrency
+                print(
+                    f"{label:<6} users={concurrency:<5} "
+                    f"handler p99={percentile(latencies, 99) * 1e3:8.2f}ms "
+                    f"loop lag p99={percentile(lags, 99) * 1e3:8.2f}ms "
+                    f"max={max(lags, default=0.0) * 1e3:8.2f}ms"
+                )
+
+            if adb:
+                adb.shutdown()
+            db.close()
+
+
+def check_referral_ledger(db_path):
+    """Return a list of inconsistencies between users and referrals"""
+    conn = sqlite3.connect(db_path)
+    problems = []
+    try:
+        orphans = conn.execute('''
+            SELECT COUNT(*) FROM referrals r
+            LEFT JOIN users u ON u.user_id = r.referred_id
+            WHERE u.user_id IS NULL
+        ''').fetchone()[0]
+        if orphans:
+            problems.append(f"{orphans} referrals credit a user row that does not exist")
+
+        uncredited = conn.execute('''
+            SELECT COUNT(*) FROM users u
+            WHERE u.referred_by IS NOT NULL
+              AND (SELECT COUNT(*) FROM referrals r WHERE r.referred_id = u.user_id) != 1
+        ''').fetchone()[0]
+        if uncredited:
+            problems.append(f"{uncredited} referred users do not have exactly one referral row")
+
+        mismatched = conn.execute('''
+            SELECT COUNT(*) FROM users u
+            WHERE u.total_referrals != (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = u.user_id)
+               OR abs(u.total_earned - (
+                   SELECT COALESCE(SUM(bonus_amount), 0) FROM referrals r WHERE r.referrer_id = u.user_id
+               )) > 1e-6
+        ''').fetchone()[0]
+        if mismatched:
+            problems.append(f"{mismatched} referrers have counters that disagree with the referrals table")
+    finally:
+        conn.close()
+    return problems
+
+
+def bench_signup_storm(args):
+    """Concurrent /start signups with referral codes, then check the referral ledger"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, "storm")
+        # Several managers emulate independent bot processes sharing the file
+        managers = [EarnyHa.DatabaseManager(db_path, pooled=True) for _ in range(args.processes)]
+        for referrer_id in range(1, args.referrers + 1):
+            managers[0].add_user(referrer_id, None, "Referrer", None)
+        codes = [managers[0].get_user(r)['referral_code'] for r in range(1, args.referrers + 1)]
+
+        errors = []
+        lock = threading.Lock()
+
+        def signup(n):
+            db = managers[n % len(managers)]
+            # Every user signs up twice to exercise the duplicate path
+            user_id = args.referrers + 1 + n // 2
+            started = time.perf_counter()
+            try:
+                referrer = db.get_user_by_referral_code(random.choice(codes))
+                db.add_user(user_id, None, "Storm", None, referrer)
+            except sqlite3.Error as e:
+                with lock:
+                    errors.append(repr(e))
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            samples = list(pool.map(signup, range(args.signups * 2)))
+        elapsed = time.perf_counter() - started
+
+        report("signup", samples)
+        print(f"{args.signups / elapsed:.0f} signups/s, {len(errors)} database errors")
+        drift = managers[0].reconcile_stats(repair=False)
+        for manager in managers:
+            manager.close()
+
+        problems = check_referral_ledger(db_path)
+        if drift:
+            problems.append(f"bot_stats drifted from the base tables: {drift}")
+        for problem in problems + errors[:5]:
+            print(f"FAIL: {problem}")
+        if problems or errors:
+            return 1
+        print("referral ledger consistent")
+        return 0
+
+
+async def _signup_wave(adb, first_id, count, codes):
+    async def signup(user_id):
+        referrer = await adb.get_user_by_referral_code(random.choice(codes))
+        await adb.add_user(user_id, None, "Wave", None, referrer)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(signup(first_id + n) for n in range(count)))
+    return time.perf_counter() - started
+
+
+def bench_group_commit(args):
+    """Awaited referral signup throughput with and without group commit"""
+    EarnyHa.DB_SYNCHRONOUS = args.synchronous
+    failed = False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, group_commit in (("per-write commit", False), ("group commit", True)):
+            db_path = temp_db_path(tmpdir, label.replace(' ', '-'))
+            db = EarnyHa.DatabaseManager(
+                db_path, pooled=True, group_commit=group_commit,
+                flush_interval=args.interval / 1000, batch_size=args.batch_size
+            )
+            for referrer_id in range(1, 11):
+                db.add_user(referrer_id, None, "Referrer", None)
+            codes = [db.get_user(r)['referral_code'] for r in range(1, 11)]
+
+            adb = EarnyHa.AsyncDatabaseManager(db)
+            elapsed = asyncio.run(_signup_wave(adb, 11, args.signups, codes))
+            adb.shutdown()
+            stats = db.storage.writers[0].stats() if db.storage.writers else None
+            db.close()
+
+            print(f"{label:<18} {args.signups / elapsed:8.0f} signups/s (synchronous={args.synchronous})")
+            if stats:
+                print(f"{'':<18} {stats}")
+            for problem in check_referral_ledger(db_path):
+                print(f"FAIL: {problem}")
+                failed = True
+    return 1 if failed else 0
+
+
+def bench_query_plans(args):
+    """Assert via EXPLAIN QUERY PLAN that every hot query uses its index"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = EarnyHa.DatabaseManager(temp_db_path(tmpdir, "plans"))
+        print(f"schema version {db.get_schema_version()}")
+        failures = 0
+        for name, (sql, index) in EarnyHa.HOT_QUERIES.items():
+            plan = db.explain_query_plan(sql, (None,) * sql.count('?'))
+            uses_index = any(index in line for line in plan)
+            # A bare "SCAN <table>" (no index) or a sort means the index is not doing its job;
+            # scanning a recursive query's own working set is fine
+            ctes = set(re.findall(r'WITH RECURSIVE (\w+)', sql))
+            full_scan = [
+                line for line in plan
+                if line.startswith('SCAN') and 'INDEX' not in line and line.split()[1] not in ctes
+            ]
+            sorts = [line for line in plan if 'TEMP B-TREE' in line]
+            ok = uses_index and not full_scan and not sorts
+            failures += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {name:<24} {' | '.join(plan)}")
+        db.close()
+        return 1 if failures else 0
+
+
+async def _run_polling(api, updates, send_rate):
+    application = fake_application(api, send_rate)
+    api.updates = updates
+    api.expect(len(updates))
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await application.updater.start_polling(poll_interval=0)
+        await asyncio.wait_for(api.sent_event.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    return elapsed
+
+
+async def _run_webhook(api, updates, concurrency, send_rate):
+    application = fake_application(api, send_rate)
+    port = free_port()
+    secret = EarnyHa.secrets.token_urlsafe(16)
+    url = f"http://127.0.0.1:{port}/{EarnyHa.WEBHOOK_PATH}"
+    api.expect(len(updates))
+    async with application:
+        await application.start()
+        await application.updater.start_webhook(
+            listen='127.0.0.1', port=port, url_path=EarnyHa.WEBHOOK_PATH,
+            webhook_url=url, secret_token=secret, max_connections=concurrency
+        )
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits) as client:
+            rejected = await client.post(url, json=updates[0], headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+            if rejected.status_code != 403:
+                raise RuntimeError(f"webhook accepted a bad secret token ({rejected.status_code})")
+
+            slots = asyncio.Semaphore(concurrency)
+
+            async def deliver(update):
+                async with slots:
+                    response = await client.post(
+                        url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret}
+                    )
+                    response.raise_for_status()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(deliver(update) for update in updates))
+            await asyncio.wait_for(api.sent_event.wait(), timeout=120)
+            elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    return elapsed
+
+
+def bench_update_modes(args):
+    """Updates/sec through the real handlers via long polling vs webhook, against a fake Bot API"""
+    EarnyHa.CONCURRENT_UPDATES = args.concurrent_updates
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode in args.modes:
+            database = use_temp_database(temp_db_path(tmpdir, mode))
+            api = FakeBotAPI(latency=args.api_latency / 1000)
+            updates = recorded_updates(args.updates)
+            if mode == 'polling':
+                elapsed = asyncio.run(_run_polling(api, updates, args.send_rate))
+            else:
+                elapsed = asyncio.run(_run_webhook(api, updates, args.concurrency, args.send_rate))
+            database.close()
+            print(
+                f"{mode:<8} {len(updates) / elapsed:8.0f} updates/s "
+                f"({len(updates)} updates, {elapsed:.2f}s, concurrent_updates={args.concurrent_updates})"
+            )
+
+
+async def _send_burst(bot, chats, per_chat):
+    """Send `per_chat` messages to each chat at once; return latencies and failures"""
+    latencies, failures = [], 0
+
+    async def send(chat_id, n):
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            await bot.send_message(chat_id, f"notification {n}")
+        except RetryAfter:
+            failures += 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(chat, n) for chat in chats for n in range(per_chat)))
+    return latencies, failures, time.perf_counter() - started
+
+
+def bench_outbox(args):
+    """Burst sends against a flood-controlled fake Bot API, with and without the rate limiter"""
+    chats = list(range(1, args.chats + 1))
+    failed = False
+    for label, limited in (("unlimited", False), ("rate-limited", True)):
+        api = FakeBotAPI(flood_control=True, chat_limit=args.chat_limit, global_limit=args.global_limit)
+        limiter = EarnyHa.OutboundRateLimiter(
+            global_rate=args.global_limit, chat_rate=args.chat_limit, chat_burst=args.chat_limit
+        ) if limited else None
+        bot = ExtBot(FAKE_TOKEN, request=api, get_updates_request=FakeBotAPI(), rate_limiter=limiter)
+
+        async def run():
+            async with bot:
+                return await _send_burst(bot, chats, args.per_chat)
+
+        latencies, failures, elapsed = asyncio.run(run())
+        print(
+            f"{label:<13} sent={len(latencies):<5} failed={failures:<5} 429s={api.flood_errors:<5} "
+            f"elapsed={elapsed:6.2f}s p50={percentile(latencies, 50) * 1e3:7.1f}ms "
+            f"p99={percentile(latencies, 99) * 1e3:7.1f}ms"
+        )
+        if limiter:
+            print(f"{'':<13} {limiter.stats()}")
+            if failures:
+                print(f"FAIL: {failures} sends failed with the rate limiter retrying flood control")
+                failed = True
+    return 1 if failed else 0
+
+
+def seed_withdrawals(db_path, count, amount=60.0):
+    """Bulk-insert `count` users with one pending withdrawal each"""
+    amount_paise = EarnyHa.to_paise(amount)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany('''
+            INSERT INTO users (user_id, first_name, referral_code, balance, total_earned, earned_paise)
+            VALUES (?, ?, ?, 0, ?, ?)
+        ''', ((n, f"Payee{n}", f"P{n:08d}", amount, amount_paise) for n in range(1, count + 1)))
+        conn.executemany(
+            'INSERT INTO withdrawals (id, user_id, amount, amount_paise, payment_method, payment_details) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            ((n, n, amount, amount_paise, "UPI", f"payee{n}@upi") for n in range(1, count + 1))
+        )
+        conn.executemany(
+            'INSERT INTO ledger (user_id, entry, amount_paise, ref_id) VALUES (?, ?, ?, ?)',
+            (row for n in range(1, count + 1)
+             for row in ((n, 'opening_earned', amount_paise, None), (n, 'withdrawal_hold', -amount_paise, n)))
+        )
+    conn.close()
+
+
+def bench_payouts(args):
+    """Bulk payout round trip: stream CSV export, decide, import; checks memory and balances"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, "payouts")
+        db = EarnyHa.DatabaseManager(db_path, pooled=True)
+        seed_withdrawals(db_path, args.withdrawals)
+        db.reconcile_stats()
+
+        export_path = os.path.join(tmpdir, "export.csv")
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open(export_path, 'w', newline='') as fileobj:
+            exported = db.export_pending_withdrawals_csv(fileobj)
+        export_seconds = time.perf_counter() - started
+        export_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # Payment provider approves even ids and rejects odd ones
+        decisions_path = os.path.join(tmpdir, "decisions.csv")
+        with open(export_path, newline='') as source, open(decisions_path, 'w', newline='') as target:
+            reader = EarnyHa.csv.DictReader(source)
+            writer = EarnyHa.csv.DictWriter(target, EarnyHa.PAYOUT_CSV_COLUMNS)
+            writer.writeheader()
+            for row in reader:
+                row['decision'] = 'approve' if int(row['id']) % 2 == 0 else 'reject'
+                writer.writerow(row)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open(decisions_path, newline='') as fileobj:
+            summary = db.import_withdrawal_decisions_csv(fileobj)
+        import_seconds = time.perf_counter() - started
+        import_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"export {exported} rows in {export_seconds:.2f}s, peak {export_peak / 1024:.0f} KiB")
+        print(f"import {summary} in {import_seconds:.2f}s, peak {import_peak / 1024:.0f} KiB")
+
+        problems = []
+        stats = db.get_bot_stats()
+        if stats['pending_withdrawals']:
+            problems.append(f"{stats['pending_withdrawals']} withdrawals still pending")
+        conn = sqlite3.connect(db_path)
+        unstamped = conn.execute(
+            "SELECT COUNT(*) FROM withdrawals WHERE status != 'pending' AND processed_at IS NULL"
+        ).fetchone()[0]
+        refunded = conn.execute('''
+            SELECT COUNT(*) FROM users u JOIN withdrawals w ON w.user_id = u.user_id
+            WHERE w.status = 'rejected' AND abs(u.balance - w.amount) > 1e-6
+        ''').fetchone()[0]
+        conn.close()
+        if unstamped:
+            problems.append(f"{unstamped} processed withdrawals have no processed_at")
+        if refunded:
+            problems.append(f"{refunded} rejected withdrawals were not refunded exactly once")
+        drift = db.reconcile_stats(repair=False)
+        if drift:
+            problems.append(f"bot_stats drifted: {drift}")
+        db.close()
+
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        return 1 if problems else 0
+
+LOAD_MIXES = {
+    # kind -> weight
+    'signup-storm': {'signup': 85, 'returning': 10, 'menu': 5},
+    'menu-browsing': {'menu': 70, 'command': 25, 'returning': 5},
+    'payout-day': {'withdraw': 55, 'menu': 35, 'admin': 10},
+}
+
+
+def seed_users(db_path, count, balance=0.0):
+    """Bulk-insert `count` registered users with the given balance"""
+    balance_paise = EarnyHa.to_paise(balance)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, first_name, referral_code, balance, balance_paise) VALUES (?, ?, ?, ?, ?)',
+            ((n, f"User{n}", f"L{n:08d}", balance, balance_paise) for n in range(1, count + 1))
+        )
+        if balance_paise:
+            conn.executemany(
+                "INSERT INTO ledger (user_id, entry, amount_paise) VALUES (?, 'opening_balance', ?)",
+                ((n, balance_paise) for n in range(1, count + 1))
+            )
+    conn.close()
+
+
+def load_updates(mix, count, existing_users, admin_id):
+    """Yield (kind, raw update) pairs for a traffic mix"""
+    kinds, weights = zip(*LOAD_MIXES[mix].items())
+    next_signup = existing_users + 1
+    for kind in random.choices(kinds, weights, k=count):
+        user_id = random.randint(1, existing_users)
+        if kind == 'signup':
+            update = command_update(next_signup, f"/start L{user_id:08d}")
+            next_signup += 1
+        elif kind == 'returning':
+            update = command_update(user_id, "/start")
+        elif kind == 'menu':
+            data = random.choice(['main_menu', 'balance', 'referrals', 'withdraw', 'stats'])
+            kind = f"button {data}"
+            update = callback_update(user_id, data)
+        elif kind == 'command':
+            command = random.choice(['/menu', '/balance', '/referrals'])
+            kind = command
+            update = command_update(user_id, command)
+        elif kind == 'withdraw':
+            kind = '/withdraw'
+            update = command_update(user_id, f"/withdraw {EarnyHa.MIN_WITHDRAWAL:.0f} UPI user{user_id}@upi")
+        else:
+            command = random.choice(['/admin stats', '/admin withdrawals'])
+            kind = command
+            update = command_update(admin_id, command)
+        yield kind, update
+
+
+async def _drive_load(application, updates, concurrency):
+    """Feed updates through the update processor with `concurrency` in flight"""
+    latencies = {}
+    errors = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def count_error(update, context):
+        errors.append(context.error)
+
+    application.add_error_handler(count_error)
+
+    async def handle(kind, raw):
+        async with slots:
+            update = Update.de_json(raw, application.bot)
+            started = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    async with application:
+        started = time.perf_counter()
+        await asyncio.gather(*(handle(kind, raw) for kind, raw in updates))
+        elapsed = time.perf_counter() - started
+        await EarnyHa.withdrawal_digest.stop(application.bot)
+    return latencies, errors, elapsed
+
+
+def bench_load(args):
+    """Replay a synthetic traffic mix through the real handlers; reports throughput, latency and lock waits"""
+    EarnyHa.CONCURRENT_UPDATES = args.concurrent_updates
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, args.mix)
+        database = use_temp_database(db_path, group_commit=args.group_commit)
+        balance = EarnyHa.MIN_WITHDRAWAL * 2.5 if args.mix == 'payout-day' else 0.0
+        seed_users(db_path, args.users, balance)
+        database.reconcile_stats()
+        # The index was built empty; seeded codes would all resolve as unknown
+        database.warm_referral_index()
+        database.warm_referral_graph()
+
+        api = FakeBotAPI(latency=args.api_latency / 1000)
+        application = fake_application(api, args.send_rate)
+        updates = list(load_updates(args.mix, args.updates, args.users, EarnyHa.ADMIN_ID))
+
+        EarnyHa.lock_waits.reset()
+        latencies, errors, elapsed = asyncio.run(_drive_load(application, updates, args.concurrency))
+        waits = EarnyHa.lock_waits.stats()
+        drift = database.reconcile_stats(repair=False)
+        EarnyHa.db.shutdown()
+        database.close()
+
+        everything = [sample for samples in latencies.values() for sample in samples]
+        print(
+            f"{args.mix}: {len(updates)} updates in {elapsed:.2f}s = {len(updates) / elapsed:.0f} updates/s "
+            f"(concurrency={args.concurrency}, group_commit={args.group_commit})"
+        )
+        for kind, samples in sorted(latencies.items(), key=lambda item: -len(item[1])) + [("all", everything)]:
+            print(
+                f"  {kind:<22} n={len(samples):<6} "
+                f"p50={percentile(samples, 50) * 1e3:7.2f}ms "
+                f"p95={percentile(samples, 95) * 1e3:7.2f}ms "
+                f"p99={percentile(samples, 99) * 1e3:7.2f}ms"
+            )
+        print(
+            f"  lock waits: {waits['waits']} of {waits['begins']} write transactions, "
+            f"{waits['wait_seconds'] * 1e3:.1f}ms total, max {waits['max_wait'] * 1e3:.1f}ms, "
+            f"{waits['timeouts']} timeouts"
+        )
+        print(f"  API calls: {api.calls}")
+
+        problems = check_referral_ledger(db_path)
+        # Every synthetic signup carries the code of a seeded user
+        signups = sum(1 for kind, _ in updates if kind == 'signup')
+        conn = sqlite3.connect(db_path)
+        credited = conn.execute('SELECT COUNT(*) FROM referrals').fetchone()[0]
+        conn.close()
+        if credited != signups:
+            problems.append(f"{credited} referrals credited for {signups} signups with a referral code")
+        if drift:
+            problems.append(f"bot_stats drifted from the base tables: {drift}")
+        for error in errors[:5]:
+            problems.append(f"handler error: {error!r}")
+        if len(errors) > 5:
+            problems.append(f"... and {len(errors) - 5} more handler errors")
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        return 1 if problems else 0
+
+
+def seed_referral_codes(db_path, count):
+    """Bulk-insert `count` users with unique 8-char hex referral codes; return the codes"""
+    codes = set()
+    while len(codes) < count:
+        codes.add(f"{random.getrandbits(32):08X}")
+    codes = list(codes)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, first_name, referral_code) VALUES (?, ?, ?)',
+            ((n, "Seed", code) for n, code in enumerate(codes, 1))
+        )
+    conn.close()
+    return codes
+
+
+def bench_referral_index(args):
+    """Referral code lookups via SQLite vs the in-memory index, with warm-up time and memory"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, "referrals")
+        EarnyHa.DatabaseManager(db_path).close()
+        started = time.perf_counter()
+        codes = seed_referral_codes(db_path, args.users)
+        print(f"seeded {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        # Viral traffic: a few hot links, a long tail, and repeated spam codes
+        hot = random.sample(codes, 100)
+        spam = [f"Z{n:07d}" for n in range(100)] + [f"spam-{n}" for n in range(100)]
+        lookups = [
+            random.choice(hot) if r < 0.8 else random.choice(codes) if r < 0.95 else random.choice(spam)
+            for r in (random.random() for _ in range(args.lookups))
+        ]
+
+        results = {}
+        for label in ("sqlite", "index"):
+            index = EarnyHa.ReferralCodeIndex(max_bytes=args.budget * 1024 * 1024) if label == "index" else None
+            started = time.perf_counter()
+            db = EarnyHa.DatabaseManager(db_path, pooled=True, referral_index=index)
+            warm_seconds = time.perf_counter() - started
+
+            samples = []
+            found = []
+            for code in lookups:
+                started = time.perf_counter()
+                found.append(db.get_user_by_referral_code(code))
+                samples.append(time.perf_counter() - started)
+            results[label] = found
+            report(f"{label} lookup", samples)
+            if index is not None:
+                # Warm a second index under tracemalloc; tracing would distort the timing above
+                tracemalloc.start()
+                probe = EarnyHa.ReferralCodeIndex(max_bytes=args.budget * 1024 * 1024)
+                conn = sqlite3.connect(db_path)
+                probe.warm(conn.execute(EarnyHa.HOT_QUERIES['referral_codes_sorted'][0]))
+                conn.close()
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                del probe
+
+                stats = index.stats()
+                print(
+                    f"{'':<28} warm {warm_seconds:.2f}s, traced {memory / 1024 / 1024:.1f} MiB, "
+                    f"estimated {stats['memory_bytes'] / 1024 / 1024:.1f} MiB for {stats['codes']} codes "
+                    f"(complete={stats['complete']})"
+                )
+                print(f"{'':<28} {stats}")
+
+                started = time.perf_counter()
+                for n in range(args.inserts):
+                    index.add(f"{random.getrandbits(40):010X}", args.users + 1 + n)
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{'':<28} {args.inserts / elapsed:.0f} inserts/s, {index.merges} merges, "
+                    f"{index.memory_bytes() / 1024 / 1024:.1f} MiB after inserts"
+                )
+            db.close()
+
+        if results["sqlite"] != results["index"]:
+            mismatches = sum(a != b for a, b in zip(results["sqlite"], results["index"]))
+            print(f"FAIL: {mismatches} lookups disagree between SQLite and the index")
+            return 1
+        print("index and SQLite agree on every lookup")
+        return 0
+
+
+def legacy_referral_code():
+    """The random 8-hex-char code add_user used to generate"""
+    return str(uuid.uuid4())[:8].upper()
+
+
+def bench_referral_codes(args):
+    """Referral code generation cost and a property check: no collisions, exact round-trip"""
+    batch = 100000
+    print(f"generation, {batch} codes per id range:")
+    ranges = (
+        ("ids from 1", 1),
+        ("ids around 7.5e9", 7_500_000_000),
+        ("ids above 2**39", 1 << 39),
+        ("ids near 2**52", (1 << 52) - batch),
+    )
+    for label, first in ranges:
+        started = time.perf_counter()
+        for user_id in range(first, first + batch):
+            EarnyHa.make_referral_code(user_id)
+        print(f"  {label:<20} {(time.perf_counter() - started) / batch * 1e9:7.0f} ns/code")
+    started = time.perf_counter()
+    for _ in range(batch):
+        legacy_referral_code()
+    print(f"  {'legacy uuid4 code':<20} {(time.perf_counter() - started) / batch * 1e9:7.0f} ns/code")
+
+    # Random legacy codes collide like the birthday problem predicts
+    seen = set()
+    legacy_collisions = 0
+    for _ in range(args.legacy):
+        code = legacy_referral_code()
+        legacy_collisions += code in seen
+        seen.add(code)
+    del seen
+    print(f"legacy: {legacy_collisions} collisions in {args.legacy} codes")
+
+    alphabet = set(EarnyHa.REFERRAL_CODE_ALPHABET)
+    hex_digits = set("0123456789ABCDEF")
+    failures = []
+    seen = set()
+    random_ids = (random.randrange(1, 1 << 52) for _ in range(args.codes // 2))
+    sequential_ids = range(1, args.codes - args.codes // 2 + 1)
+    for n, user_id in enumerate(itertools.chain(sequential_ids, random_ids)):
+        code = EarnyHa.make_referral_code(user_id)
+        expected_length = 8 if user_id < 1 << 39 else 11
+        if EarnyHa.referral_code_user_id(code) != user_id:
+            failures.append(f"{code} does not decode back to {user_id}")
+        elif len(code) != expected_length or code[0] not in EarnyHa.REFERRAL_CODE_LEADS:
+            failures.append(f"{code} for {user_id} has the wrong shape")
+        elif not set(code) <= alphabet or set(code) <= hex_digits:
+            failures.append(f"{code} for {user_id} uses bad characters or could clash with a legacy code")
+        # Round-trip already proves distinct codes; also check the first block directly
+        if n < args.unique_check:
+            if code in seen:
+                failures.append(f"{code} generated twice")
+            seen.add(code)
+        if len(failures) >= 10:
+            break
+    print(
+        f"checked {args.codes} codes ({len(sequential_ids)} sequential ids, the rest random up to 2**52); "
+        f"{min(args.codes, args.unique_check)} compared directly for duplicates"
+    )
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("no collisions, every code decodes back to its user id")
+    return 1 if failures else 0
+
+
+def legacy_withdrawal(db_path, user_id, amount):
+    """The old check-then-debit: balance read in one step, unconditional debit in the next"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        balance = conn.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+        if amount > balance:
+            return False
+        time.sleep(0)  # the handler awaited the database here
+        with conn:
+            conn.execute(
+                'INSERT INTO withdrawals (user_id, amount, payment_method, payment_details) VALUES (?, ?, ?, ?)',
+                (user_id, amount, "UPI", "race@upi")
+            )
+            conn.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (amount, user_id))
+        return True
+    finally:
+        conn.close()
+
+
+def check_withdrawal_ledger(db_path, starting_balance):
+    """Return a list of overdrawn or unbalanced accounts"""
+    conn = sqlite3.connect(db_path)
+    problems = []
+    try:
+        negative = conn.execute('SELECT COUNT(*), MIN(balance) FROM users WHERE balance < 0').fetchone()
+        if negative[0]:
+            problems.append(f"{negative[0]} users have a negative balance (lowest {negative[1]:.2f})")
+        unbalanced = conn.execute('''
+            SELECT COUNT(*) FROM users u
+            WHERE abs(u.balance + (
+                SELECT COALESCE(SUM(amount), 0) FROM withdrawals w WHERE w.user_id = u.user_id
+            ) - ?) > 1e-6
+        ''', (starting_balance,)).fetchone()[0]
+        if unbalanced:
+            problems.append(f"{unbalanced} users' balance plus withdrawals differs from the starting balance")
+    finally:
+        conn.close()
+    return problems
+
+
+def bench_withdraw_race(args):
+    """Concurrent withdrawals from the same accounts; checks no balance ever goes negative"""
+    amount = EarnyHa.MIN_WITHDRAWAL
+    starting_balance = amount * args.allowed
+    attempts = [user_id for user_id in range(1, args.users + 1) for _ in range(args.attempts)]
+    random.shuffle(attempts)
+    modes = [("conditional debit", False), ("conditional + group commit", True)]
+    if args.legacy:
+        modes.insert(0, ("legacy check-then-debit", None))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, group_commit in modes:
+            db_path = temp_db_path(tmpdir, label.replace(' ', '-'))
+            EarnyHa.DatabaseManager(db_path).close()
+            seed_users(db_path, args.users, starting_balance)
+            managers = [
+                EarnyHa.DatabaseManager(db_path, pooled=True, group_commit=bool(group_commit))
+                for _ in range(args.processes)
+            ]
+            managers[0].reconcile_stats()
+            outcomes = {'created': 0, 'insufficient': 0, 'error': 0}
+            lock = threading.Lock()
+
+            def withdraw(n):
+                user_id = attempts[n]
+                db = managers[n % len(managers)]
+                started = time.perf_counter()
+                if group_commit is None:
+                    outcome = 'created' if legacy_withdrawal(db_path, user_id, amount) else 'insufficient'
+                else:
+                    try:
+                        outcome = 'created' if db.create_withdrawal_request(
+                            user_id, amount, "UPI", "race@upi"
+                        ) else 'error'
+                    except EarnyHa.InsufficientBalance:
+                        outcome = 'insufficient'
+                with lock:
+                    outcomes[outcome] += 1
+                return time.perf_counter() - started
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.threads) as pool:
+                samples = list(pool.map(withdraw, range(len(attempts))))
+            elapsed = time.perf_counter() - started
+
+            drift = managers[0].reconcile_stats(repair=False) if group_commit is not None else None
+            for manager in managers:
+                manager.close()
+
+            print(f"{label}: {len(attempts) / elapsed:.0f} withdrawals/s, {outcomes}")
+            report("  withdraw", samples)
+            problems = check_withdrawal_ledger(db_path, starting_balance)
+            if outcomes['created'] != args.users * args.allowed:
+                problems.append(f"{outcomes['created']} withdrawals created, expected {args.users * args.allowed}")
+            if drift:
+                problems.append(f"bot_stats drifted: {drift}")
+            for problem in problems:
+                print(f"  {'overdraw (expected for legacy)' if group_commit is None else 'FAIL'}: {problem}")
+            if not problems:
+                print("  no negative balances, every account debited exactly as allowed")
+            failed = failed or (bool(problems) and group_commit is not None)
+    return 1 if failed else 0
+
+
+def seed_ledger(db_path, users, entries_per_user):
+    """Bulk-insert users whose balances are built from `entries_per_user` ledger entries each
+
+    Every user earns referral bonuses and holds one withdrawal; snapshots are
+    set to what the ledger replays to. Returns the number of entries.
+    """
+    bonus = EarnyHa.REFERRAL_BONUS_PAISE
+    earned = bonus * (entries_per_user - 1)
+    hold = random.randrange(0, earned + 1, 100)
+
+    def entries():
+        for n in range(1, users + 1):
+            for _ in range(entries_per_user - 1):
+                yield n, 'referral_bonus', bonus
+            yield n, 'withdrawal_hold', -hold
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany('''
+            INSERT INTO users (user_id, first_name, referral_code, balance, total_earned, balance_paise, earned_paise)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            (n, f"User{n}", f"L{n:08d}", (earned - hold) / 100, earned / 100, earned - hold, earned)
+            for n in range(1, users + 1)
+        ))
+        conn.executemany('INSERT INTO ledger (user_id, entry, amount_paise) VALUES (?, ?, ?)', entries())
+    conn.close()
+    return users * entries_per_user
+
+
+def bench_ledger(args):
+    """Replay millions of ledger entries against balance snapshots, then corrupt, detect and repair"""
+    failures = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, "ledger")
+        db = EarnyHa.DatabaseManager(db_path, pooled=True)
+        started = time.perf_counter()
+        entries = seed_ledger(db_path, args.users, args.entries_per_user)
+        print(f"seeded {entries} entries for {args.users} users in {time.perf_counter() - started:.1f}s")
+        db.reconcile_stats()
+
+        result = db.verify_ledger()
+        print(
+            f"verify: {result['entries']} entries, {result['users']} users in {result['seconds']:.2f}s "
+            f"({result['entries'] / result['seconds'] / 1e6:.2f}M entries/s)"
+        )
+        if result['entries'] != entries or result['mismatched'] or result['orphaned']:
+            failures.append(f"clean ledger did not verify: {result}")
+
+        tracemalloc.start()
+        db.verify_ledger()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"verify peak memory {peak / 1024:.0f} KiB")
+
+        # Drift some snapshots behind the ledger's back
+        corrupted = random.sample(range(1, args.users + 1), min(args.corrupt, args.users))
+        conn = sqlite3.connect(db_path)
+        with conn:
+            conn.executemany(
+                'UPDATE users SET balance_paise = balance_paise + 1, balance = (balance_paise + 1) / 100.0 '
+                'WHERE user_id = ?',
+                ((user_id,) for user_id in corrupted[::2])
+            )
+            conn.executemany(
+                'UPDATE users SET total_earned = total_earned + 0.5 WHERE user_id = ?',
+                ((user_id,) for user_id in corrupted[1::2])
+            )
+        for statement in ('UPDATE ledger SET amount_paise = 0', 'DELETE FROM ledger'):
+            try:
+                with conn:
+                    conn.execute(statement)
+                failures.append(f"ledger accepted {statement!r}")
+            except sqlite3.IntegrityError:
+                pass
+        conn.close()
+
+        result = db.verify_ledger(repair=True)
+        print(f"repair: found {result['mismatched']} of {len(corrupted)} corrupted, repaired {result['repaired']}")
+        if result['mismatched'] != len(corrupted):
+            failures.append(f"found {result['mismatched']} mismatches, expected {len(corrupted)}")
+        result = db.verify_ledger()
+        if result['mismatched']:
+            failures.append(f"{result['mismatched']} mismatches left after repair")
+        drift = db.reconcile_stats(repair=False)
+        if drift:
+            failures.append(f"bot_stats drifted after repair: {drift}")
+        db.close()
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("ledger is append-only; every corrupted snapshot was found and repaired")
+    return 1 if failures else 0
+
+
+def sqlite_timestamp(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def seed_referral_graph(db_path, users, chain_length, burst_size, now):
+    """Bulk-insert referrals for a random referral forest; return the bursting referrer
+
+    Each user is referred by a random earlier one, so chains stay shallow,
+    except for one chain of `chain_length` users. Referrals are spread over
+    the 30 days before `now`; in the last hour one referrer signs up
+    `burst_size` users within ten minutes.
+    """
+    forest = users - chain_length - burst_size
+    start = now - 30 * 86400
+    step = (30 * 86400 - 3 * 3600) / forest
+    burster = random.randrange(1, forest)
+
+    def referrals():
+        for n in range(2, forest + 1):
+            yield random.randrange(1, n), n, start + n * step
+        for n in range(forest + 1, forest + chain_length + 1):
+            yield n - 1, n, now - 2 * 3600 + (n - forest)
+        for n in range(forest + chain_length + 1, users + 1):
+            yield burster, n, now - 3600 + (n - forest - chain_length) * 600 / burst_size
+
+    bonus = EarnyHa.REFERRAL_BONUS_PAISE
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO referrals (referrer_id, referred_id, bonus_amount, bonus_paise, created_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((referrer, referred, bonus / 100, bonus, sqlite_timestamp(at)) for referrer, referred, at in referrals())
+        )
+    conn.close()
+    return burster
+
+
+def bench_referral_graph(args):
+    """Build the referral graph for a large forest, time its reports and check them against SQL"""
+    failures = []
+    now = time.time()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, "graph")
+        EarnyHa.DatabaseManager(db_path).close()
+        started = time.perf_counter()
+        burster = seed_referral_graph(db_path, args.users, args.chain, args.burst, now)
+        print(f"seeded {args.users - 1} referrals in {time.perf_counter() - started:.1f}s")
+
+        graph = EarnyHa.ReferralGraph()
+        started = time.perf_counter()
+        db = EarnyHa.DatabaseManager(db_path, pooled=True, referral_graph=graph)
+        warm_seconds = time.perf_counter() - started
+
+        tracemalloc.start()
+        probe = EarnyHa.ReferralGraph()
+        conn = sqlite3.connect(db_path)
+        probe.warm(conn.execute('SELECT referrer_id, referred_id, created_at FROM referrals ORDER BY id'))
+        conn.close()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del probe
+        stats = graph.stats()
+        print(f"warm {warm_seconds:.2f}s, traced {memory / 1024 / 1024:.1f} MiB, {stats}")
+
+        user_ids = [random.randrange(1, args.users + 1) for _ in range(args.queries)]
+        for label, query in (
+            ("top referrers", lambda user_id: graph.top('direct')),
+            ("top downlines", lambda user_id: graph.top('downline')),
+            ("user profile", graph.profile),
+            ("bursts 1h", lambda user_id: graph.bursts(3600, 20)),
+        ):
+            samples = []
+            for user_id in user_ids[:args.queries if label != "bursts 1h" else 20]:
+                started = time.perf_counter()
+                query(user_id)
+                samples.append(time.perf_counter() - started)
+            report(label, samples)
+
+        samples = []
+        for user_id in user_ids[:200]:
+            started = time.perf_counter()
+            db.get_downline(user_id, args.users)
+            samples.append(time.perf_counter() - started)
+        report("sql downline", samples)
+
+        # Reports against SQL
+        for user_id in user_ids[:200]:
+            profile = graph.profile(user_id)
+            members, depth = db.get_downline(user_id, args.users)
+            if profile['downline'] != members or len(profile['levels']) != depth:
+                failures.append(f"user {user_id}: graph {profile['downline']}/{len(profile['levels'])}, sql {members}/{depth}")
+        conn = sqlite3.connect(db_path)
+        leaders = [count for _, count in conn.execute(
+            'SELECT referrer_id, COUNT(*) FROM referrals GROUP BY referrer_id ORDER BY 2 DESC LIMIT 10'
+        )]
+        if [direct for _, direct, _ in graph.top('direct')] != leaders:
+            failures.append(f"top referrers {graph.top('direct')} disagree with SQL counts {leaders}")
+        bursts = graph.bursts(3600, 20)
+        if not bursts or bursts[0][:2] != (burster, args.burst):
+            failures.append(f"burst by {burster} not reported first: {bursts}")
+        if stats['max_depth'] < args.chain:
+            failures.append(f"deepest chain {stats['max_depth']} is shorter than the seeded {args.chain}")
+
+        # Live referrals must leave the graph as a rebuild would
+        added = [(random.randrange(1, args.users + n), args.users + n) for n in range(1, args.inserts + 1)]
+        started = time.perf_counter()
+        for referrer, referred in added:
+            graph.add(referrer, referred, now)
+        elapsed = time.perf_counter() - started
+        print(f"{args.inserts / elapsed:.0f} live referrals/s")
+        with conn:
+            conn.executemany(
+                'INSERT INTO referrals (referrer_id, referred_id, created_at) VALUES (?, ?, ?)',
+                ((referrer, referred, sqlite_timestamp(now)) for referrer, referred in added)
+            )
+        rebuilt = EarnyHa.ReferralGraph()
+        rebuilt.warm(conn.execute('SELECT referrer_id, referred_id, created_at FROM referrals ORDER BY id'), now)
+        conn.close()
+        for board in ('direct', 'downline'):
+            if graph.top(board) != rebuilt.top(board):
+                failures.append(f"live {board} leaders differ from a rebuild")
+        for user_id in user_ids[:200]:
+            if graph.profile(user_id) != rebuilt.profile(user_id):
+                failures.append(f"live profile of {user_id} differs from a rebuild")
+                break
+        db.close()
+
+    for failure in failures[:10]:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("graph matches SQL and a rebuild; burst detected")
+    return 1 if failures else 0
+
+
+def storage_workload(db, users, seed):
+    """Signups with referrals, withdrawals and payout decisions, the same for every seed"""
+    rng = random.Random(seed)
+    for user_id in range(1, users + 1):
+        referrer = rng.randrange(1, user_id) if user_id > 1 and rng.random() < 0.8 else None
+        db.add_user(user_id, None, "Engine", None, referrer)
+    # What referral_credit_job does for referrers on another shard
+    db.settle_referral_credits()
+    for user_id in rng.sample(range(1, users + 1), users // 3):
+        balance = db.get_user(user_id)['balance']
+        if balance >= EarnyHa.MIN_WITHDRAWAL:
+            db.create_withdrawal_request(user_id, balance / 2, "UPI", "engine@upi")
+    # Withdrawal ids depend on the engine, so decisions follow the users
+    pending = [row[0] for row in sorted(db.iter_pending_withdrawals(chunk_size=97), key=lambda row: row[1])]
+    rng.shuffle(pending)
+    db.process_withdrawals(pending[:len(pending) // 3], approve=True)
+    db.process_withdrawals(pending[len(pending) // 3:2 * len(pending) // 3], approve=False)
+
+
+def storage_snapshot(db, users):
+    """Everything the engines must agree on after storage_workload"""
+    ledger = db.verify_ledger()
+    return {
+        'stats': db.get_bot_stats(),
+        'user_stats': db.get_user_stats(),
+        'drift': db.reconcile_stats(repair=False),
+        'ledger': (ledger['users'], ledger['entries'], ledger['mismatched'], ledger['orphaned']),
+        'users': [
+            (user['balance'], user['total_earned'], user['total_referrals'], user['referred_by'])
+            for user in map(db.get_user, range(1, users + 1))
+        ],
+        'codes': [db.get_user_by_referral_code(EarnyHa.make_referral_code(u)) for u in range(1, users + 1, 7)],
+        'downlines': [db.get_downline(u) for u in range(1, users + 1, 50)],
+        'pending': len(db.get_pending_withdrawals()),
+        'page': [row[0] for row in db.get_users_page(limit=25)['users']],
+        'graph': db.referral_graph.top('downline'),
+    }
+
+
+def bench_storage_engines(args):
+    """Run one workload on every storage engine and check they end in the same state"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engines = {
+            "memory": lambda: EarnyHa.MemoryStorage(),
+            "file": lambda: EarnyHa.SingleFileStorage(temp_db_path(tmpdir, "file"), pooled=True),
+            f"sharded x{args.shards}": lambda: EarnyHa.ShardedStorage(
+                temp_db_path(tmpdir, "sharded"), args.shards, pooled=True
+            ),
+            f"sharded x{args.shards} group commit": lambda: EarnyHa.ShardedStorage(
+                temp_db_path(tmpdir, "grouped"), args.shards, pooled=True, group_commit=True, flush_interval=0.0005
+            ),
+        }
+        snapshots = {}
+        for label, make_storage in engines.items():
+            db = EarnyHa.DatabaseManager(
+                storage=make_storage(), user_cache=EarnyHa.UserCache(),
+                referral_index=EarnyHa.ReferralCodeIndex(), referral_graph=EarnyHa.ReferralGraph()
+            )
+            started = time.perf_counter()
+            storage_workload(db, args.users, args.seed)
+            elapsed = time.perf_counter() - started
+            snapshots[label] = storage_snapshot(db, args.users)
+            db.close()
+            print(f"{label:<28} workload {elapsed:.2f}s, {snapshots[label]['stats']}")
+    
+    failures = []
+    reference_label, reference = next(iter(snapshots.items()))
+    if reference['drift'] or reference['ledger'][2:] != (0, 0):
+        failures.append(f"{reference_label} is inconsistent: drift {reference['drift']}, ledger {reference['ledger']}")
+    for label, snapshot in snapshots.items():
+        for key, value in snapshot.items():
+            if value != reference[key]:
+                failures.append(f"{label} {key} differs from {reference_label}")
+    
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print(f"all {len(snapshots)} engines agree")
+    return 1 if failures else 0
+
+
+def settle_until(db, stop, interval=EarnyHa.REFERRAL_CREDIT_INTERVAL):
+    """Drain the cross-shard referral outbox every `interval` seconds, like referral_credit_job, until `stop` is set"""
+    while not stop.wait(interval):
+        db.settle_referral_credits()
+
+
+def bench_shard_scaling(args):
+    """Concurrent referral signups and withdrawals against 1..N shards"""
+    EarnyHa.DB_SYNCHRONOUS = args.synchronous
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for shards in args.shards:
+            db = EarnyHa.DatabaseManager(storage=EarnyHa.ShardedStorage(
+                temp_db_path(tmpdir, f"x{shards}"), shards, pooled=True, pool_size=args.threads
+            ))
+            for referrer_id in range(1, args.referrers + 1):
+                db.add_user(referrer_id, None, "Referrer", None)
+            
+            def write(n):
+                user_id = args.referrers + 1 + n
+                started = time.perf_counter()
+                db.add_user(user_id, None, "Scale", None, random.randrange(1, args.referrers + 1))
+                try:
+                    db.create_withdrawal_request(user_id, 1.0, "UPI", "scale@upi")
+                except EarnyHa.InsufficientBalance:
+                    pass
+                return time.perf_counter() - started
+            
+            stop = threading.Event()
+            settler = threading.Thread(target=settle_until, args=(db, stop))
+            settler.start()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.threads) as pool:
+                samples = list(pool.map(write, range(args.signups)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            settler.join()
+            db.settle_referral_credits()
+            settled = time.perf_counter() - started
+            
+            drift = db.reconcile_stats(repair=False)
+            stats = db.get_bot_stats()
+            db.close()
+            results.append((shards, args.signups / elapsed))
+            print(f"{shards} shard(s): {args.signups / elapsed:8.0f} signups/s, all bonuses credited after "
+                  f"{settled:.2f}s (synchronous={args.synchronous}, {args.threads} threads)")
+            report(f"signup x{shards}", samples)
+            if drift or stats['total_referrals'] != args.signups:
+                print(f"FAIL: {shards} shard(s) drift {drift}, {stats['total_referrals']} referrals credited")
+                return 1
+    
+    baseline = results[0][1]
+    print("scaling: " + ", ".join(f"{shards}x -> {rate / baseline:.2f}" for shards, rate in results))
+    return 0
+
+
+def timed_signups(db, first_user_id, stop, samples):
+    """Referral signups until `stop` is set, appending each one's latency"""
+    user_id = first_user_id
+    while not stop.is_set():
+        started = time.perf_counter()
+        db.add_user(user_id, None, "Backup", None, random.randrange(1, first_user_id))
+        samples.append(time.perf_counter() - started)
+        user_id += 1
+
+
+def bench_backup(args):
+    """Online backup under write load, then restore it and check consistency, retention and cache warmth"""
+    failures = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = temp_db_path(tmpdir, "live")
+        backup_dir = os.path.join(tmpdir, "backups")
+        EarnyHa.DatabaseManager(db_path).close()
+        seed_users(db_path, args.users, 100.0)
+        db = EarnyHa.DatabaseManager(db_path, pooled=True, user_cache=EarnyHa.UserCache(args.hot_users))
+        db.reconcile_stats()
+        hot_users = random.sample(range(1, args.users + 1), args.hot_users)
+        for user_id in hot_users:
+            db.get_user(user_id)
+        print(f"seeded {args.users} users, {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB")
+        
+        # Signup latency alone, then with a backup running alongside
+        next_user_id = args.users + 1
+        for label in ("writes alone", "writes during backup"):
+            samples, stop = [], threading.Event()
+            threads = [
+                threading.Thread(target=timed_signups, args=(db, next_user_id + n * 1000000, stop, samples))
+                for n in range(args.writers)
+            ]
+            for thread in threads:
+                thread.start()
+            if label == "writes alone":
+                time.sleep(args.seconds)
+            else:
+                result = db.backup(backup_dir, retention=args.retention)
+                label = f"writes during {result['seconds']:.2f}s backup ({result['bytes'] / 1024 / 1024:.1f} MiB)"
+            stop.set()
+            for thread in threads:
+                thread.join()
+            next_user_id += args.writers * 1000000
+            report(label, samples)
+        
+        # The backup must be a consistent snapshot
+        restored = EarnyHa.DatabaseManager(
+            temp_db_path(tmpdir, "restored"), pooled=True, user_cache=EarnyHa.UserCache(args.hot_users),
+            referral_index=EarnyHa.ReferralCodeIndex()
+        )
+        summary = restored.restore(result['path'])
+        print(f"restore {summary['seconds']:.2f}s, {summary['users_warmed']} users warmed")
+        drift = restored.reconcile_stats(repair=False)
+        ledger = restored.verify_ledger()
+        if drift or ledger['mismatched'] or ledger['orphaned']:
+            failures.append(f"restored copy is inconsistent: drift {drift}, ledger {ledger['mismatched']} mismatched")
+        if restored.get_user_stats()['total_users'] < args.users:
+            failures.append("restored copy is missing seeded users")
+        
+        # Users hot at backup time must be served from memory right after the restore
+        with open(os.path.join(result['path'], 'manifest.json')) as f:
+            hot_users = json.load(f)['hot_users']
+        for label, manager in (
+            ("cold get_user", EarnyHa.DatabaseManager(temp_db_path(tmpdir, "restored"), pooled=True,
+                                                      user_cache=EarnyHa.UserCache(args.hot_users))),
+            ("warm get_user", restored),
+        ):
+            samples = []
+            for user_id in hot_users:
+                started = time.perf_counter()
+                manager.get_user(user_id)
+                samples.append(time.perf_counter() - started)
+            report(label, samples)
+            if label == "warm get_user" and manager.user_cache.stats()['misses']:
+                failures.append(f"{manager.user_cache.stats()['misses']} hot users missed the warmed cache")
+            manager.close()
+        
+        # One backup at a time
+        with db._backup_lock:
+            try:
+                db.backup(backup_dir, retention=args.retention)
+                failures.append("a second backup ran while one was in progress")
+            except EarnyHa.BackupInProgress:
+                pass
+        
+        # Retention; another process's unfinished backup survives, an abandoned one is pruned
+        in_flight = os.path.join(backup_dir, f"{EarnyHa.BACKUP_PREFIX}in-flight.partial")
+        abandoned = os.path.join(backup_dir, f"{EarnyHa.BACKUP_PREFIX}abandoned.partial")
+        for path in (in_flight, abandoned):
+            os.makedirs(path)
+        stale = time.time() - EarnyHa.BACKUP_PARTIAL_MAX_AGE - 60
+        os.utime(abandoned, (stale, stale))
+        for _ in range(args.retention + 1):
+            db.backup(backup_dir, retention=args.retention)
+        kept = EarnyHa.list_backups(backup_dir)
+        if len(kept) != args.retention or len(os.listdir(backup_dir)) != args.retention + 1:
+            failures.append(f"{len(os.listdir(backup_dir))} backups on disk, expected {args.retention} and one in flight")
+        if not os.path.isdir(in_flight) or os.path.isdir(abandoned):
+            failures.append("pruning removed an in-flight backup or kept an abandoned one")
+        db.close()
+    
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("backup is consistent under writes; restore warms the cache; retention holds")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    sub = subparsers.add_parser('db-calls', help=bench_db_calls.__doc__)
+    sub.add_argument('--users', type=int, default=2000)
+    sub.add_argument('--calls', type=int, default=20000)
+    sub.set_defaults(func=bench_db_calls)
+
+    sub = subparsers.add_parser('async-burst', help=bench_async_burst.__doc__)
+    sub.add_argument('--workers', type=int, default=EarnyHa.DB_WORKERS)
+    sub.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000])
+    sub.set_defaults(func=bench_async_burst)
+
+    sub = subparsers.add_parser('signup-storm', help=bench_signup_storm.__doc__)
+    sub.add_argument('--signups', type=int, default=5000)
+    sub.add_argument('--referrers', type=int, default=20)
+    sub.add_argument('--threads', type=int, default=32)
+    sub.add_argument('--processes', type=int, default=3)
+    sub.set_defaults(func=bench_signup_storm)
+
+    sub = subparsers.add_parser('group-commit', help=bench_group_commit.__doc__)
+    sub.add_argument('--signups', type=int, default=5000)
+    sub.add_argument('--interval', type=float, default=EarnyHa.GROUP_COMMIT_INTERVAL * 1000, help="flush interval in ms")
+    sub.add_argument('--batch-size', type=int, default=EarnyHa.GROUP_COMMIT_BATCH_SIZE)
+    sub.add_argument('--synchronous', default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    sub.set_defaults(func=bench_group_commit)
+
+    sub = subparsers.add_parser('query-plans', help=bench_query_plans.__doc__)
+    sub.set_defaults(func=bench_query_plans)
+
+    sub = subparsers.add_parser('update-modes', help=bench_update_modes.__doc__)
+    sub.add_argument('--modes', nargs='+', default=['polling', 'webhook'], choices=['polling', 'webhook'])
+    sub.add_argument('--updates', type=int, default=3000)
+    sub.add_argument('--concurrency', type=int, default=EarnyHa.WEBHOOK_MAX_CONNECTIONS)
+    sub.add_argument('--concurrent-updates', type=int, default=EarnyHa.CONCURRENT_UPDATES)
+    sub.add_argument('--api-latency', type=float, default=0.0, help="simulated Bot API latency in ms")
+    sub.add_argument('--send-rate', type=int, default=100000, help="rate limiter messages/s (0 = bot defaults)")
+    sub.set_defaults(func=bench_update_modes)
+
+    sub = subparsers.add_parser('outbox', help=bench_outbox.__doc__)
+    sub.add_argument('--chats', type=int, default=20)
+    sub.add_argument('--per-chat', type=int, default=10)
+    sub.add_argument('--chat-limit', type=int, default=3, help="messages per second per chat")
+    sub.add_argument('--global-limit', type=int, default=30, help="messages per second overall")
+    sub.set_defaults(func=bench_outbox)
+
+    sub = subparsers.add_parser('payouts', help=bench_payouts.__doc__)
+    sub.add_argument('--withdrawals', type=int, default=50000)
+    sub.set_defaults(func=bench_payouts)
+
+    sub = subparsers.add_parser('load', help=bench_load.__doc__)
+    sub.add_argument('--mix', default='menu-browsing', choices=sorted(LOAD_MIXES))
+    sub.add_argument('--updates', type=int, default=5000)
+    sub.add_argument('--users', type=int, default=2000, help="registered users before the run")
+    sub.add_argument('--concurrency', type=int, default=EarnyHa.CONCURRENT_UPDATES, help="updates in flight")
+    sub.add_argument('--concurrent-updates', type=int, default=EarnyHa.CONCURRENT_UPDATES)
+    sub.add_argument('--api-latency', type=float, default=0.0, help="simulated Bot API latency in ms")
+    sub.add_argument('--send-rate', type=int, default=100000, help="rate limiter messages/s (0 = bot defaults)")
+    sub.add_argument('--group-commit', action='store_true')
+    sub.add_argument('--seed', type=int, default=1)
+    sub.set_defaults(func=bench_load)
+
+    sub = subparsers.add_parser('referral-index', help=bench_referral_index.__doc__)
+    sub.add_argument('--users', type=int, default=1000000)
+    sub.add_argument('--lookups', type=int, default=200000)
+    sub.add_argument('--inserts', type=int, default=100000)
+    sub.add_argument('--budget', type=int, default=EarnyHa.REFERRAL_INDEX_MAX_BYTES // 1024 // 1024, help="MiB")
+    sub.set_defaults(func=bench_referral_index)
+
+    sub = subparsers.add_parser('referral-codes', help=bench_referral_codes.__doc__)
+    sub.add_argument('--codes', type=int, default=5000000)
+    sub.add_argument('--unique-check', type=int, default=2000000, help="codes kept in a set to compare directly")
+    sub.add_argument('--legacy', type=int, default=1000000, help="legacy random codes to generate")
+    sub.set_defaults(func=bench_referral_codes)
+
+    sub = subparsers.add_parser('withdraw-race', help=bench_withdraw_race.__doc__)
+    sub.add_argument('--users', type=int, default=200)
+    sub.add_argument('--allowed', type=int, default=3, help="withdrawals each starting balance covers")
+    sub.add_argument('--attempts', type=int, default=10, help="withdrawals attempted per user")
+    sub.add_argument('--threads', type=int, default=32)
+    sub.add_argument('--processes', type=int, default=3)
+    sub.add_argument('--legacy', action='store_true', help="also run the old check-then-debit for comparison")
+    sub.set_defaults(func=bench_withdraw_race)
+
+    sub = subparsers.add_parser('ledger', help=bench_ledger.__doc__)
+    sub.add_argument('--users', type=int, default=200000)
+    sub.add_argument('--entries-per-user', type=int, default=10)
+    sub.add_argument('--corrupt', type=int, default=100, help="user snapshots to corrupt before repairing")
+    sub.set_defaults(func=bench_ledger)
+
+    sub = subparsers.add_parser('referral-graph', help=bench_referral_graph.__doc__)
+    sub.add_argument('--users', type=int, default=1000000)
+    sub.add_argument('--chain', type=int, default=200, help="length of one deep referral chain")
+    sub.add_argument('--burst', type=int, default=50, help="referrals one user makes within ten minutes")
+    sub.add_argument('--queries', type=int, default=1000)
+    sub.add_argument('--inserts', type=int, default=20000)
+    sub.set_defaults(func=bench_referral_graph)
+    
+    sub = subparsers.add_parser('storage-engines', help=bench_storage_engines.__doc__)
+    sub.add_argument('--users', type=int, default=3000)
+    sub.add_argument('--shards', type=int, default=EarnyHa.DB_SHARDS)
+    sub.add_argument('--seed', type=int, default=1)
+    sub.set_defaults(func=bench_storage_engines)
+    
+    sub = subparsers.add_parser('shard-scaling', help=bench_shard_scaling.__doc__)
+    sub.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    sub.add_argument('--signups', type=int, default=5000)
+    sub.add_argument('--referrers', type=int, default=1000)
+    sub.add_argument('--threads', type=int, default=32)
+    sub.add_argument('--synchronous', default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    sub.set_defaults(func=bench_shard_scaling)
+    
+    sub = subparsers.add_parser('backup', help=bench_backup.__doc__)
+    sub.add_argument('--users', type=int, default=500000)
+    sub.add_argument('--hot-users', type=int, default=5000, help="users cached before the backup")
+    sub.add_argument('--writers', type=int, default=4, help="threads signing users up")
+    sub.add_argument('--seconds', type=float, default=3.0, help="length of the writes-alone run")
+    sub.add_argument('--retention', type=int, default=3)
+    sub.set_defaults(func=bench_backup)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""Shared fixtures for the EarnyHa test suite"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# EarnyHa opens its default database in the working directory on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_workdir = tempfile.mkdtemp(prefix="earnyha-tests-")
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.chdir(_workdir)
+
+import EarnyHa  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "earnyha.db")
+
+
+@pytest.fixture
+def db(db_path):
+    database = EarnyHa.DatabaseManager(db_path, pooled=True, user_cache=EarnyHa.UserCache())
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def sharded(db_path):
+    database = EarnyHa.DatabaseManager(
+        storage=EarnyHa.ShardedStorage(db_path, 4, pooled=True), user_cache=EarnyHa.UserCache()
+    )
+    yield database
+    database.close()
@@ -0,0 +1,61 @@
+"""Online backups, their retention and restoring from them"""
+import os
+import time
+
+import pytest
+
+import EarnyHa
+
+
+@pytest.fixture
+def backup_dir(tmp_path):
+    return str(tmp_path / "backups")
+
+
+def test_backup_restores_users_and_warms_the_cache(db, backup_dir):
+    db.add_user(1, None, "Referrer", None)
+    db.add_user(2, None, "Referred", None, 1)
+    db.get_user(1)
+    result = db.backup(backup_dir)
+
+    db.add_user(3, None, "After", None)
+    summary = db.restore(result['path'])
+
+    assert summary['users_warmed'] >= 1
+    assert db.get_user(3) is None
+    assert db.get_user(1)['balance_paise'] == EarnyHa.REFERRAL_BONUS_PAISE
+    assert db.verify_ledger()['mismatched'] == 0
+
+
+def test_retention_keeps_the_newest(db, backup_dir):
+    names = [db.backup(backup_dir, retention=2)['name'] for _ in range(4)]
+    assert [os.path.basename(path) for path, _ in EarnyHa.list_backups(backup_dir)] == names[:-3:-1]
+
+
+@pytest.mark.parametrize('retention', [0, -1])
+def test_retention_below_one_is_refused(db, backup_dir, retention):
+    db.backup(backup_dir)
+    with pytest.raises(ValueError):
+        db.backup(backup_dir, retention=retention)
+    with pytest.raises(ValueError):
+        EarnyHa.prune_backups(backup_dir, retention)
+    assert len(EarnyHa.list_backups(backup_dir)) == 1
+
+
+def test_one_backup_at_a_time(db, backup_dir):
+    with db._backup_lock:
+        with pytest.raises(EarnyHa.BackupInProgress):
+            db.backup(backup_dir)
+
+
+def test_only_abandoned_partial_backups_are_pruned(db, backup_dir):
+    db.backup(backup_dir)
+    young = os.path.join(backup_dir, f"{EarnyHa.BACKUP_PREFIX}young.partial")
+    old = os.path.join(backup_dir, f"{EarnyHa.BACKUP_PREFIX}old.partial")
+    os.makedirs(young)
+    os.makedirs(old)
+    stale = time.time() - EarnyHa.BACKUP_PARTIAL_MAX_AGE - 60
+    os.utime(old, (stale, stale))
+
+    assert EarnyHa.prune_backups(backup_dir, 1) == 1
+    assert os.path.isdir(young) and not os.path.exists(old)
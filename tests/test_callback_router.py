@@ -0,0 +1,96 @@
+"""Inline button callbacks dispatched by CallbackRouter"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import EarnyHa
+
+
+class FakeQuery:
+    def __init__(self, data, user_id=1):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, first_name="Asha")
+        self.message = None
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append((text, reply_markup))
+
+
+@pytest.fixture
+def users(db, monkeypatch):
+    """Route handlers' user lookups through a synchronous test database"""
+    async def get_user(user_id):
+        return db.get_user(user_id)
+
+    db.add_user(1, "asha", "Asha", None)
+    monkeypatch.setattr(EarnyHa, 'db', SimpleNamespace(get_user=get_user))
+    return db
+
+
+def test_dispatch_passes_args_and_user(users):
+    router = EarnyHa.CallbackRouter()
+    calls = []
+
+    @router.route('page')
+    async def page(query, user_data, args):
+        calls.append((user_data['user_id'], args))
+
+    asyncio.run(router.dispatch(FakeQuery("page|3")))
+    asyncio.run(router.dispatch(FakeQuery("page")))
+
+    assert calls == [(1, "3"), (1, "")]
+    assert router.stats()['page']['count'] == 2
+
+
+def test_route_without_user_skips_the_lookup(monkeypatch):
+    async def get_user(user_id):
+        raise AssertionError("looked up a user")
+
+    monkeypatch.setattr(EarnyHa, 'db', SimpleNamespace(get_user=get_user))
+    router = EarnyHa.CallbackRouter()
+    calls = []
+
+    @router.route('help', needs_user=False)
+    async def show_help(query, user_data, args):
+        calls.append(user_data)
+
+    asyncio.run(router.dispatch(FakeQuery("help")))
+    assert calls == [None]
+
+
+def test_unknown_route_is_ignored(users):
+    router = EarnyHa.CallbackRouter()
+    query = FakeQuery("nowhere|1")
+    asyncio.run(router.dispatch(query))
+    assert query.edits == []
+
+
+def test_missing_user_is_told_to_start(users):
+    router = EarnyHa.CallbackRouter()
+
+    @router.route('page')
+    async def page(query, user_data, args):
+        raise AssertionError("handler called without a user")
+
+    query = FakeQuery("page", user_id=2)
+    asyncio.run(router.dispatch(query))
+    assert query.edits == [(EarnyHa.USER_NOT_FOUND_MESSAGE, None)]
+
+
+@pytest.mark.parametrize('data', ['balance', 'balance|x'])
+def test_menu_screen_ignores_args(users, data):
+    query = FakeQuery(data)
+    asyncio.run(EarnyHa.callback_router.dispatch(query))
+
+    text, markup = EarnyHa.render('balance', **EarnyHa.screen_fields(users.get_user(1), "Asha"))
+    assert query.edits == [(text, markup)]
+
+
+def test_withdraw_screen_below_minimum(users):
+    query = FakeQuery("withdraw")
+    asyncio.run(EarnyHa.callback_router.dispatch(query))
+
+    text, _ = EarnyHa.render('withdraw_insufficient', **EarnyHa.screen_fields(users.get_user(1), "Asha"))
+    assert query.edits[0][0] == text
@@ -0,0 +1,61 @@
+"""Callback screens skip edits that would not change the message"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+import EarnyHa
+
+
+@pytest.fixture
+def render(db):
+    db.add_user(1, "asha", "Asha", None)
+    user = db.get_user(1)
+    return lambda screen: EarnyHa.render(screen, **EarnyHa.screen_fields(user, "Asha"))
+
+
+class FakeQuery:
+    def __init__(self, text=None, reply_markup=None, error=None):
+        self.message = SimpleNamespace(text=text, reply_markup=reply_markup)
+        self.error = error
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append((text, reply_markup))
+        if self.error:
+            raise self.error
+
+
+def test_unchanged_screen_is_not_edited(render):
+    text, markup = render('main_menu')
+    # The message's markup comes back from Telegram as a separate object
+    query = FakeQuery(text, InlineKeyboardMarkup.de_json(markup.to_dict(), None))
+    asyncio.run(EarnyHa.edit_screen(query, text, markup))
+    assert query.edits == []
+
+
+def test_changed_text_or_markup_is_edited(render):
+    text, markup = render('main_menu')
+    other_text, other_markup = render('stats')
+
+    query = FakeQuery("old text", markup)
+    asyncio.run(EarnyHa.edit_screen(query, text, markup))
+    assert query.edits == [(text, markup)]
+
+    query = FakeQuery(text, other_markup)
+    asyncio.run(EarnyHa.edit_screen(query, text, markup))
+    assert query.edits == [(text, markup)]
+
+
+def test_not_modified_error_is_ignored():
+    query = FakeQuery("old", error=BadRequest("Message is not modified: specified new message content ..."))
+    asyncio.run(EarnyHa.edit_screen(query, "new", None))
+    assert len(query.edits) == 1
+
+
+def test_other_bad_requests_propagate():
+    query = FakeQuery("old", error=BadRequest("Message to edit not found"))
+    with pytest.raises(BadRequest):
+        asyncio.run(EarnyHa.edit_screen(query, "new", None))
@@ -0,0 +1,66 @@
+"""Group commit: one failing write never takes its batch down with it"""
+import asyncio
+
+import pytest
+
+import EarnyHa
+
+
+@pytest.fixture
+def grouped(db_path):
+    # A long interval so the writes below land in one batch
+    database = EarnyHa.DatabaseManager(db_path, pooled=True, group_commit=True, flush_interval=0.2, batch_size=3)
+    yield database
+    database.close()
+
+
+def insert_user(cursor, user_id):
+    cursor.execute(
+        'INSERT INTO users (user_id, first_name, referral_code) VALUES (?, ?, ?)',
+        (user_id, "Grouped", EarnyHa.make_referral_code(user_id))
+    )
+    return user_id
+
+
+def insert_then_fail(cursor, user_id):
+    insert_user(cursor, user_id)
+    raise ValueError("rejected")
+
+
+def test_failed_write_rolls_back_alone(grouped):
+    writer = grouped.storage.writers[0]
+    batches = writer.stats()['batches']
+    # Keep the writer idle until all three are queued, so they share a batch
+    writer._last_batch = 2
+    futures = [
+        writer.submit(insert_user, 1), writer.submit(insert_then_fail, 2), writer.submit(insert_user, 3)
+    ]
+
+    assert futures[0].result(timeout=5) == 1
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == 3
+
+    assert writer.stats()['batches'] == batches + 1
+    assert [grouped.get_user(user_id) is not None for user_id in (1, 2, 3)] == [True, False, True]
+
+
+def test_awaited_writes_skip_the_thread_lane(grouped):
+    adb = EarnyHa.AsyncDatabaseManager(grouped)
+    assert adb.write_workers == len(grouped.storage.writers)
+
+    async def run():
+        await adb.add_user(1, None, "Referrer", None)
+        users = await asyncio.gather(*(adb.add_user(n, None, "Referred", None, 1) for n in range(2, 12)))
+        duplicate = await adb.add_user(2, None, "Referred", None, 1)
+        with pytest.raises(EarnyHa.InsufficientBalance):
+            await adb.create_withdrawal_request(2, EarnyHa.MIN_WITHDRAWAL, "UPI", "x@upi")
+        # Every call above was a write plan: none of them needed a DB thread
+        assert not adb._threads
+        return users, duplicate
+
+    users, duplicate = asyncio.run(run())
+    adb.shutdown()
+
+    assert all(users) and duplicate is None
+    assert grouped.get_user(1)['total_referrals'] == 10
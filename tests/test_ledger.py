@@ -0,0 +1,62 @@
+"""Balance snapshots checked against a replay of the ledger"""
+import EarnyHa
+
+
+def seed(database):
+    database.add_user(1, None, "Referrer", None)
+    for user_id in range(2, 8):
+        database.add_user(user_id, None, "Referred", None, 1)
+    database.settle_referral_credits()
+    database.create_withdrawal_request(1, 20.0, "UPI", "referrer@upi")
+
+
+def corrupt(database, user_id, paise):
+    with database._connection(database._shard(user_id)) as conn:
+        conn.execute(
+            'UPDATE users SET balance_paise = balance_paise + ?, balance = (balance_paise + ?) / 100.0 WHERE user_id = ?',
+            (paise, paise, user_id)
+        )
+        conn.commit()
+    database._invalidate(user_id)
+
+
+def test_consistent_ledger_passes(db):
+    seed(db)
+    result = db.verify_ledger()
+    assert result['users'] == 7
+    assert result['mismatched'] == result['orphaned'] == 0
+    assert result['entries'] > 0
+
+
+def test_corrupted_balance_is_reported_not_changed(db):
+    seed(db)
+    corrupt(db, 1, 1234)
+
+    result = db.verify_ledger()
+    assert result['mismatched'] == 1
+    user_id, balance, replayed, _, _ = result['reported'][0]
+    assert (user_id, balance - replayed) == (1, 1234)
+    assert db.get_user(1)['balance_paise'] == replayed + 1234
+
+
+def test_repair_restores_the_replayed_balance_and_stats(db):
+    seed(db)
+    corrupt(db, 1, -500)
+    db.reconcile_stats()
+    expected = 6 * EarnyHa.REFERRAL_BONUS_PAISE - 2000
+
+    result = db.verify_ledger(repair=True)
+    assert result['repaired'] == 1
+    assert db.get_user(1)['balance_paise'] == expected
+    assert db.get_user(1)['balance'] == expected / 100
+    assert db.verify_ledger()['mismatched'] == 0
+    assert db.reconcile_stats(repair=False) == {}
+
+
+def test_sharded_ledger_is_checked_per_shard(sharded):
+    seed(sharded)
+    corrupt(sharded, 3, 100)
+
+    result = sharded.verify_ledger(repair=True)
+    assert (result['users'], result['mismatched'], result['repaired']) == (7, 1, 1)
+    assert sharded.verify_ledger()['mismatched'] == 0
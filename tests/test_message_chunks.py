@@ -0,0 +1,74 @@
+"""Admin listings split into messages by Telegram's UTF-16 length"""
+import asyncio
+
+import EarnyHa
+
+
+async def aiter(items):
+    for item in items:
+        yield item
+
+
+def chunks_of(header, entries, limit):
+    async def collect():
+        return [chunk async for chunk in EarnyHa.iter_message_chunks(header, aiter(entries), limit)]
+    return asyncio.run(collect())
+
+
+def test_message_length_counts_utf16_units():
+    assert EarnyHa.message_length("abc") == 3
+    assert EarnyHa.message_length("₹") == 1
+    assert EarnyHa.message_length("😀") == 2
+
+
+def test_truncate_never_splits_a_surrogate_pair():
+    text = "😀" * 10
+    for limit in range(2, 20):
+        cut = EarnyHa.truncate_message(text, limit)
+        assert EarnyHa.message_length(cut) <= limit
+        assert cut.endswith('…')
+        assert cut[:-1] == "😀" * len(cut[:-1])
+    assert EarnyHa.truncate_message(text, 20) == text
+
+
+def test_chunks_stay_within_the_limit_and_keep_every_entry():
+    entries = [f"#{n} {'😀' * (n % 7)} ₹{n}.00\n" for n in range(500)]
+    chunks = chunks_of("**Header:**\n", entries, 100)
+
+    assert len(chunks) > 1
+    assert all(EarnyHa.message_length(chunk) <= 100 for chunk in chunks)
+    assert ''.join(chunks) == "**Header:**\n" + ''.join(entries)
+
+
+def test_overlong_emoji_entry_is_truncated_to_the_limit():
+    # 60 code points, but 120 UTF-16 units
+    chunks = chunks_of("H\n", ["😀" * 60, "next\n"], 50)
+
+    assert all(EarnyHa.message_length(chunk) <= 50 for chunk in chunks)
+    assert chunks[1].endswith('…')
+    assert chunks[-1] == "next\n"
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+        self.documents = []
+
+    async def reply_text(self, text):
+        self.texts.append(text)
+
+    async def reply_document(self, fileobj, filename, caption):
+        self.documents.append((filename, fileobj.read().decode('utf-8'), caption))
+
+
+def test_long_listing_is_sent_as_a_file():
+    entries = [f"entry {n} {'😀' * 100}\n" for n in range(400)]
+    short, long = FakeMessage(), FakeMessage()
+    asyncio.run(EarnyHa.send_listing(short, "**List:**\n", aiter(entries[:5]), "list.txt"))
+    asyncio.run(EarnyHa.send_listing(long, "**List:**\n", aiter(entries), "list.txt", max_messages=3))
+
+    assert len(short.texts) == 1 and not short.documents
+    assert not long.texts
+    filename, content, caption = long.documents[0]
+    assert filename == "list.txt" and caption == "**List:**"
+    assert content == "**List:**\n" + ''.join(entries)
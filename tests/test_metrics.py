@@ -0,0 +1,43 @@
+"""The metrics endpoint never keeps the bot from starting"""
+import asyncio
+import socket
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+
+import EarnyHa
+
+
+@pytest.fixture
+def started(monkeypatch):
+    """Run post_init against a stand-in database, returning the metrics server it used"""
+    servers = []
+
+    def run(server):
+        servers.append(server)
+        monkeypatch.setattr(EarnyHa, 'metrics_server', server)
+        monkeypatch.setattr(EarnyHa, 'database', SimpleNamespace(warm_cache_snapshot=lambda: None))
+        asyncio.run(EarnyHa.post_init(None))
+        return server
+
+    yield run
+    for server in servers:
+        server.stop()
+
+
+def test_metrics_are_served(started):
+    server = started(EarnyHa.MetricsServer('127.0.0.1', 0))
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+        assert response.status == 200
+
+
+def test_port_in_use_leaves_metrics_off(started, caplog):
+    with socket.socket() as taken:
+        taken.bind(('127.0.0.1', 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+        server = started(EarnyHa.MetricsServer('127.0.0.1', port))
+
+    assert server._server is None
+    assert "Metrics endpoint disabled" in caplog.text
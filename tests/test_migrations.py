@@ -0,0 +1,78 @@
+"""Schema migrations and the indexes the hot queries rely on"""
+import sqlite3
+
+import pytest
+
+import EarnyHa
+
+LATEST = max(version for version, _, _ in EarnyHa.MIGRATIONS)
+
+
+def applied_versions(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute('SELECT version FROM schema_version ORDER BY version')]
+    finally:
+        conn.close()
+
+
+def test_fresh_database_gets_every_migration_once(db_path):
+    EarnyHa.DatabaseManager(db_path).close()
+    EarnyHa.DatabaseManager(db_path).close()
+
+    assert applied_versions(db_path) == sorted(version for version, _, _ in EarnyHa.MIGRATIONS)
+
+
+def test_older_database_is_upgraded(db_path, monkeypatch):
+    monkeypatch.setattr(EarnyHa, 'MIGRATIONS', EarnyHa.MIGRATIONS[:3])
+    EarnyHa.DatabaseManager(db_path).close()
+    assert applied_versions(db_path) == [1, 2, 3]
+
+    monkeypatch.undo()
+    database = EarnyHa.DatabaseManager(db_path)
+    assert database.get_schema_version() == LATEST
+    database.close()
+
+
+def test_migrations_apply_in_version_order(db_path, monkeypatch):
+    # Listed out of order; the column can only be added after its table exists
+    monkeypatch.setattr(EarnyHa, 'MIGRATIONS', EarnyHa.MIGRATIONS + [
+        (LATEST + 2, "add a column", ('ALTER TABLE probe ADD COLUMN note TEXT',)),
+        (LATEST + 1, "add a table", ('CREATE TABLE probe (id INTEGER PRIMARY KEY)',)),
+    ])
+    database = EarnyHa.DatabaseManager(db_path)
+    assert database.get_schema_version() == LATEST + 2
+    database.close()
+
+
+def test_failed_migration_leaves_no_trace(db_path, monkeypatch):
+    monkeypatch.setattr(EarnyHa, 'MIGRATIONS', EarnyHa.MIGRATIONS + [
+        (LATEST + 1, "broken", ('CREATE TABLE probe (id INTEGER PRIMARY KEY)', 'SELECT * FROM missing_table')),
+    ])
+    with pytest.raises(sqlite3.OperationalError):
+        EarnyHa.DatabaseManager(db_path)
+
+    assert applied_versions(db_path)[-1] == LATEST
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'probe'").fetchone()[0] == 0
+    conn.close()
+
+
+@pytest.mark.parametrize('name', sorted(EarnyHa.HOT_QUERIES))
+def test_hot_query_uses_its_index(db, name):
+    sql, index = EarnyHa.HOT_QUERIES[name]
+    plan = db.explain_query_plan(sql, (None,) * sql.count('?'))
+
+    assert any(index in line for line in plan), plan
+    assert not any('TEMP B-TREE' in line for line in plan), plan
+
+
+def test_history_is_newest_first(db):
+    db.add_user(1, None, "Referrer", None)
+    for user_id in range(2, 10):
+        db.add_user(user_id, None, "Referred", None, referred_by=1)
+    db.create_withdrawal_request(1, EarnyHa.MIN_WITHDRAWAL, "UPI", "first@upi")
+    db.create_withdrawal_request(1, EarnyHa.REFERRAL_BONUS, "UPI", "second@upi")
+
+    assert [row[0] for row in db.get_referral_history(1, 3)] == [9, 8, 7]
+    assert [row[1] for row in db.get_withdrawal_history(1, 5)] == [EarnyHa.REFERRAL_BONUS, EarnyHa.MIN_WITHDRAWAL]
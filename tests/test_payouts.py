@@ -0,0 +1,65 @@
+"""Bulk payout CSV: exported cells are inert in a spreadsheet, decisions round-trip"""
+import csv
+import io
+
+import pytest
+
+import EarnyHa
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('=HYPERLINK("http://evil","x")', '\'=HYPERLINK("http://evil","x")'),
+    ('+1234', "'+1234"),
+    ('-2+3', "'-2+3"),
+    ('@SUM(A1)', "'@SUM(A1)"),
+    ('\tcmd', "'\tcmd"),
+    ('\rcmd', "'\rcmd"),
+    ('user@upi', 'user@upi'),
+    ('', ''),
+    (-5, -5),
+    (None, None),
+])
+def test_spreadsheet_safe(value, expected):
+    assert EarnyHa.spreadsheet_safe(value) == expected
+
+
+def test_export_neutralizes_user_controlled_cells(db):
+    db.add_user(1, "=cmd|' /C calc'!A0", "@evil", None)
+    for user_id in range(2, 7):
+        db.add_user(user_id, None, "Referred", None, referred_by=1)
+    assert db.create_withdrawal_request(1, EarnyHa.MIN_WITHDRAWAL, "UPI", '=HYPERLINK("http://evil","x")')
+
+    out = io.StringIO()
+    assert db.export_pending_withdrawals_csv(out) == 1
+    row = next(csv.DictReader(io.StringIO(out.getvalue())))
+
+    assert row['payment_details'] == '\'=HYPERLINK("http://evil","x")'
+    assert row['username'] == "'=cmd|' /C calc'!A0"
+    assert row['first_name'] == "'@evil"
+    assert row['payment_method'] == "UPI"
+    assert float(row['amount']) == EarnyHa.MIN_WITHDRAWAL
+
+
+def test_decisions_round_trip_through_the_export(db):
+    for user_id in range(1, 4):
+        db.add_user(user_id, None, "Payee", None)
+    # Five referrals each, just enough for the minimum withdrawal
+    for user_id in range(4, 19):
+        db.add_user(user_id, None, "Referred", None, referred_by=(user_id % 3) + 1)
+    for user_id in range(1, 4):
+        assert db.create_withdrawal_request(user_id, EarnyHa.MIN_WITHDRAWAL, "UPI", f"payee{user_id}@upi")
+
+    out = io.StringIO()
+    db.export_pending_withdrawals_csv(out)
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    for row, decision in zip(rows, ('approve', 'reject', '')):
+        row['decision'] = decision
+    decided = io.StringIO()
+    writer = csv.DictWriter(decided, EarnyHa.PAYOUT_CSV_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+    summary = db.import_withdrawal_decisions_csv(io.StringIO(decided.getvalue()))
+    assert (summary['approved'], summary['rejected'], summary['ignored']) == (1, 1, 1)
+    assert len(db.get_pending_withdrawals()) == 1
+    assert db.get_user(int(rows[1]['user_id']))['balance'] == 5 * EarnyHa.REFERRAL_BONUS
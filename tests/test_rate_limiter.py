@@ -0,0 +1,94 @@
+"""TokenBucket and OutboundRateLimiter pacing and flood-control retries"""
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import EarnyHa
+
+
+def timed(coroutine_factory):
+    async def run():
+        started = time.monotonic()
+        await coroutine_factory()
+        return time.monotonic() - started
+    return asyncio.run(run())
+
+
+def test_bucket_serves_its_burst_then_paces_at_its_rate():
+    bucket = EarnyHa.TokenBucket(rate=50, burst=2)
+
+    async def take(count):
+        for _ in range(count):
+            await bucket.acquire()
+
+    assert timed(lambda: take(2)) < 0.02
+    # Empty now: four more tokens take 4 / 50 s
+    assert timed(lambda: take(4)) == pytest.approx(0.08, abs=0.04)
+
+
+def test_blocked_bucket_waits_out_the_block():
+    bucket = EarnyHa.TokenBucket(rate=1000, burst=5)
+    bucket.block(0.05)
+
+    assert timed(bucket.acquire) >= 0.045
+
+
+def limited_calls(limiter, calls):
+    async def run():
+        await limiter.initialize()
+        results = []
+        for endpoint, data, callback in calls:
+            results.append(await limiter.process_request(callback, (), {}, endpoint, data, None))
+        await limiter.shutdown()
+        return results
+    return asyncio.run(run())
+
+
+def test_flood_control_is_retried_then_raised():
+    limiter = EarnyHa.OutboundRateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10, max_retries=2)
+    attempts = []
+
+    async def flooded():
+        attempts.append(time.monotonic())
+        raise RetryAfter(0)
+
+    with pytest.raises(RetryAfter):
+        limited_calls(limiter, [('sendMessage', {'chat_id': 7}, flooded)])
+    assert len(attempts) == 3
+    assert limiter.stats()['retries'] == 2
+    assert limiter.stats()['failed'] == 1
+
+
+def test_retry_succeeds_after_one_flood_error():
+    limiter = EarnyHa.OutboundRateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10)
+    attempts = []
+
+    async def flooded_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return 'sent'
+
+    assert limited_calls(limiter, [('sendMessage', {'chat_id': 7}, flooded_once)]) == ['sent']
+    assert limiter.stats()['sent'] == 1 and limiter.stats()['retries'] == 1
+
+
+def test_calls_without_a_chat_bypass_the_buckets():
+    limiter = EarnyHa.OutboundRateLimiter(global_rate=1000)
+
+    async def answered():
+        return True
+
+    assert limited_calls(limiter, [('answerCallbackQuery', {'callback_query_id': '1'}, answered)]) == [True]
+    assert limiter.stats()['sent'] == 0 and limiter.stats()['chats'] == 0
+
+
+def test_groups_get_the_stricter_bucket():
+    limiter = EarnyHa.OutboundRateLimiter(chat_rate=30, chat_burst=3, group_rate=0.5)
+
+    assert limiter._chat_bucket(-100123).rate == 0.5
+    assert limiter._chat_bucket(-100123).burst == 1
+    assert limiter._chat_bucket(42).rate == 30
+    assert limiter._chat_bucket(42).burst == 3
@@ -0,0 +1,56 @@
+"""Referral codes derived from user ids"""
+import random
+import string
+
+import pytest
+
+import EarnyHa
+
+BOUNDARIES = [0, 1, 2, (1 << 39) - 1, 1 << 39, (1 << 52) - 1, (1 << 54) - 1]
+
+
+def sample_ids(count=20000, seed=20):
+    rng = random.Random(seed)
+    return BOUNDARIES + [rng.randrange(1 << 39) for _ in range(count)] + [rng.randrange(1 << 54) for _ in range(count)]
+
+
+def test_codes_round_trip():
+    for user_id in sample_ids():
+        code = EarnyHa.make_referral_code(user_id)
+        assert EarnyHa.referral_code_user_id(code) == user_id
+
+
+def test_codes_have_the_documented_shape():
+    for user_id in sample_ids(2000):
+        code = EarnyHa.make_referral_code(user_id)
+        assert len(code) == (8 if user_id < 1 << 39 else 11)
+        assert code[0] in EarnyHa.REFERRAL_CODE_LEADS
+        assert set(code) <= set(EarnyHa.REFERRAL_CODE_ALPHABET)
+
+
+def test_consecutive_ids_never_collide():
+    codes = {EarnyHa.make_referral_code(user_id) for user_id in range(100000)}
+    assert len(codes) == 100000
+
+
+@pytest.mark.parametrize('user_id', [-1, 1 << 54])
+def test_out_of_range_ids_are_refused(user_id):
+    with pytest.raises(ValueError):
+        EarnyHa.make_referral_code(user_id)
+
+
+def test_old_hex_codes_are_not_mistaken_for_new_ones():
+    rng = random.Random(7)
+    for _ in range(1000):
+        code = ''.join(rng.choice('0123456789ABCDEF') for _ in range(8))
+        assert EarnyHa.referral_code_user_id(code) is None
+    for code in ('', 'G', 'GGGGGGGGGGGG', 'GGGGGGGI', 'ggggggggg', string.punctuation[:8]):
+        assert EarnyHa.referral_code_user_id(code) is None
+
+
+def test_signups_store_their_derived_code(db):
+    for user_id in (1, 12345, 7_000_000_000):
+        db.add_user(user_id, None, "User", None)
+        code = db.get_user(user_id)['referral_code']
+        assert code == EarnyHa.make_referral_code(user_id)
+        assert db.get_user_by_referral_code(code) == user_id
@@ -0,0 +1,79 @@
+"""Referral bonuses owed across shards, settled from the referral_credits outbox"""
+import EarnyHa
+
+BONUS = EarnyHa.REFERRAL_BONUS_PAISE
+
+
+def queued(database):
+    total = 0
+    for shard in database.storage.shards:
+        with database._connection(shard) as conn:
+            total += conn.execute('SELECT COUNT(*) FROM referral_credits').fetchone()[0]
+    return total
+
+
+def balance(database, user_id):
+    return database.get_user(user_id)['balance_paise']
+
+
+def sign_up_referrals(database, referrer_id, user_ids):
+    database.add_user(referrer_id, None, "Referrer", None)
+    for user_id in user_ids:
+        database.add_user(user_id, None, "Referred", None, referrer_id)
+
+
+def test_cross_shard_bonus_waits_for_settlement(sharded):
+    # User 4 shares user 8's shard; 5, 6 and 7 do not
+    sign_up_referrals(sharded, 8, [4, 5, 6, 7])
+    assert balance(sharded, 8) == BONUS
+    assert queued(sharded) == 3
+
+    assert sharded.settle_referral_credits() == 3
+    assert balance(sharded, 8) == 4 * BONUS
+    assert sharded.get_user(8)['total_referrals'] == 4
+    assert queued(sharded) == 0
+    assert sharded.settle_referral_credits() == 0
+
+
+def test_settles_in_batches(sharded):
+    sign_up_referrals(sharded, 1, range(2, 40))
+    owed = queued(sharded)
+    assert owed > 3
+
+    assert sharded.settle_referral_credits(batch_size=3) == owed
+    assert balance(sharded, 1) == 38 * BONUS
+    assert queued(sharded) == 0
+
+
+def test_failed_credit_is_retried(sharded, monkeypatch):
+    sign_up_referrals(sharded, 8, [5, 6])
+
+    def unavailable(cursor, referrals):
+        raise EarnyHa.sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(sharded, '_credit_referrals_once', unavailable)
+    assert sharded.settle_referral_credits() == 0
+    assert queued(sharded) == 2
+    assert balance(sharded, 8) == 0
+
+    monkeypatch.undo()
+    assert sharded.settle_referral_credits() == 2
+    assert balance(sharded, 8) == 2 * BONUS
+
+
+def test_failed_clear_does_not_credit_twice(sharded, monkeypatch):
+    sign_up_referrals(sharded, 8, [5, 6])
+
+    def unavailable(cursor, referred_ids):
+        raise EarnyHa.sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(sharded, '_clear_referral_credits', unavailable)
+    assert sharded.settle_referral_credits() == 2
+    assert queued(sharded) == 2
+
+    monkeypatch.undo()
+    assert sharded.settle_referral_credits() == 0
+    assert queued(sharded) == 0
+    assert balance(sharded, 8) == 2 * BONUS
+    assert sharded.verify_ledger()['mismatched'] == 0
+    assert sharded.reconcile_stats(repair=False) == {}
@@ -0,0 +1,27 @@
+"""Reads that look up many users at once on sharded storage"""
+import EarnyHa
+
+
+def test_lookups_split_long_in_lists(sharded, monkeypatch):
+    sharded.add_user(1, None, "Root", None)
+    for user_id in range(2, 40):
+        sharded.add_user(user_id, None, "Member", None, 1)
+    for user_id in range(40, 100):
+        sharded.add_user(user_id, None, "Member", None, user_id - 38)
+    # Cross-shard referrals reach their referrer's shard through the outbox
+    sharded.settle_referral_credits()
+
+    statements = []
+    monkeypatch.setattr(EarnyHa, 'SQL_MAX_VARIABLES', 3)
+    for shard in sharded.storage.shards:
+        with sharded._connection(shard) as conn:
+            conn.set_trace_callback(statements.append)
+
+    assert sharded.get_downline(1) == (98, 3)
+    sharded.user_cache.clear()
+    assert sharded.warm_user_cache(range(1, 100)) == 99
+    assert sharded.user_cache.get(57)['first_name'] == "Member"
+
+    in_lists = [sql for sql in statements if ' IN (' in sql]
+    assert in_lists
+    assert all(sql.split(' IN (')[1].count(',') <= 2 for sql in in_lists)
@@ -0,0 +1,40 @@
+"""Signups and referral credits commit together or not at all"""
+import pytest
+
+import EarnyHa
+
+
+def test_referral_signup_credits_the_referrer(db):
+    db.add_user(1, "referrer", "Referrer", None)
+    user = db.add_user(2, "referred", "Referred", None, referred_by=1)
+
+    assert user['referred_by'] == 1
+    referrer = db.get_user(1)
+    assert referrer['total_referrals'] == 1
+    assert referrer['balance'] == EarnyHa.REFERRAL_BONUS
+    assert db.get_bot_stats()['total_referrals'] == 1
+    assert db.reconcile_stats(repair=False) == {}
+
+
+def test_duplicate_signup_is_ignored_and_credits_once(db):
+    db.add_user(1, None, "Referrer", None)
+    assert db.add_user(2, None, "Referred", None, referred_by=1) is not None
+    assert db.add_user(2, None, "Referred", None, referred_by=1) is None
+
+    assert db.get_user(1)['total_referrals'] == 1
+    assert db.get_user_stats()['total_users'] == 2
+
+
+def test_failed_credit_rolls_back_the_signup(db, monkeypatch):
+    db.add_user(1, None, "Referrer", None)
+
+    def broken_credit(cursor, referrer_id, referred_id):
+        raise RuntimeError("credit failed")
+
+    monkeypatch.setattr(db, '_credit_referral', broken_credit)
+    with pytest.raises(RuntimeError):
+        db.add_user(2, None, "Referred", None, referred_by=1)
+
+    assert db.get_user(2) is None
+    assert db.get_user(1)['total_referrals'] == 0
+    assert db.reconcile_stats(repair=False) == {}
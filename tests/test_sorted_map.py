@@ -0,0 +1,32 @@
+"""PackedSortedMap shared by the referral code index and the referral graph"""
+import random
+from array import array
+
+import EarnyHa
+
+
+def test_matches_a_dict_across_merges():
+    packed = EarnyHa.PackedSortedMap('i')
+    expected = {}
+    rng = random.Random(7)
+    for value in range(5000):
+        key = rng.randrange(1 << 64)
+        packed.add(key, value)
+        expected[key] = value
+
+    assert packed.merges >= 1
+    assert len(packed) == len(expected)
+    assert list(packed.keys) == sorted(packed.keys)
+    assert all(packed.get(key) == value for key, value in expected.items())
+    assert packed.get(1 << 63 | 12345) is None
+
+
+def test_readded_key_replaces_the_merged_entry():
+    packed = EarnyHa.PackedSortedMap()
+    packed.load(array('Q', [1, 5, 9]), array('Q', [10, 50, 90]))
+    packed.add(5, 55)
+    packed.merge()
+
+    assert list(packed.keys) == [1, 5, 9]
+    assert [packed.get(key) for key in (1, 5, 9)] == [10, 55, 90]
+    assert not packed.recent
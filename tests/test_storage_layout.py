@@ -0,0 +1,59 @@
+"""Database files refuse to open under a storage layout they were not made for"""
+import sqlite3
+
+import pytest
+
+import EarnyHa
+
+
+def open_db(db_path, mode, shards=1):
+    storage = EarnyHa.ShardedStorage(db_path, shards) if mode == 'sharded' else EarnyHa.SingleFileStorage(db_path)
+    return EarnyHa.DatabaseManager(storage=storage)
+
+
+def seed(db_path, mode, shards=1):
+    database = open_db(db_path, mode, shards)
+    database.add_user(5, None, "Five", None)
+    database.close()
+
+
+def test_same_layout_reopens(db_path):
+    seed(db_path, 'sharded', 4)
+    database = open_db(db_path, 'sharded', 4)
+    assert database.get_user(5)['first_name'] == "Five"
+    database.close()
+
+
+@pytest.mark.parametrize('before, after', [(4, 8), (8, 4), (4, 1)])
+def test_changed_shard_count_is_refused(db_path, before, after):
+    seed(db_path, 'sharded', before)
+    with pytest.raises(EarnyHa.StorageLayoutMismatch):
+        open_db(db_path, 'sharded', after)
+
+
+def test_sharded_files_next_to_a_single_file_are_refused(db_path):
+    seed(db_path, 'file')
+    with pytest.raises(EarnyHa.StorageLayoutMismatch, match="earnyha.db"):
+        open_db(db_path, 'sharded', 4)
+
+
+def test_single_file_next_to_shards_is_refused(db_path):
+    seed(db_path, 'sharded', 2)
+    with pytest.raises(EarnyHa.StorageLayoutMismatch, match=r"shard0\.db"):
+        open_db(db_path, 'file')
+    # Still refused once the empty file exists
+    with pytest.raises(EarnyHa.StorageLayoutMismatch):
+        open_db(db_path, 'file')
+
+
+def test_database_from_before_the_check_is_adopted(db_path):
+    seed(db_path, 'file')
+    conn = sqlite3.connect(db_path)
+    conn.execute('DELETE FROM storage_layout')
+    conn.commit()
+    conn.close()
+
+    open_db(db_path, 'file').close()
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT mode, shard, shard_count FROM storage_layout').fetchone() == ('file', 0, 1)
+    conn.close()
@@ -0,0 +1,71 @@
+"""PerUserUpdateProcessor: one user's updates in order, other users never starved"""
+import asyncio
+from types import SimpleNamespace
+
+import EarnyHa
+
+
+def update_from(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id) if user_id is not None else None)
+
+
+def test_one_users_updates_run_in_order_without_overlap():
+    processor = EarnyHa.PerUserUpdateProcessor(8)
+    events = []
+
+    async def handle(n):
+        events.append(('start', n))
+        await asyncio.sleep(0.001 * (5 - n))
+        events.append(('end', n))
+
+    async def run():
+        await asyncio.gather(*(processor.process_update(update_from(1), handle(n)) for n in range(5)))
+
+    asyncio.run(run())
+    assert events == [(kind, n) for n in range(5) for kind in ('start', 'end')]
+    assert processor._user_locks == {}
+
+
+def test_queued_updates_of_one_user_do_not_hold_slots():
+    processor = EarnyHa.PerUserUpdateProcessor(2)
+    release = None
+    served = []
+
+    async def slow(n):
+        await release.wait()
+        served.append((1, n))
+
+    async def quick():
+        served.append((2, 0))
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        slow_updates = [asyncio.create_task(processor.process_update(update_from(1), slow(n))) for n in range(5)]
+        await asyncio.sleep(0)
+        # Five updates of user 1 are waiting, but only one of them holds a slot
+        await asyncio.wait_for(processor.process_update(update_from(2), quick()), timeout=1)
+        release.set()
+        await asyncio.gather(*slow_updates)
+
+    asyncio.run(run())
+    assert served[0] == (2, 0)
+    assert served[1:] == [(1, n) for n in range(5)]
+
+
+def test_updates_without_a_user_run_concurrently():
+    processor = EarnyHa.PerUserUpdateProcessor(4)
+    running = peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        await asyncio.gather(*(processor.process_update(update_from(None), handle()) for _ in range(4)))
+
+    asyncio.run(run())
+    assert peak == 4
@@ -0,0 +1,121 @@
+"""Withdrawal requests and the balance checks in front of them"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import EarnyHa
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeQuery:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, first_name="Asha")
+        self.message = None
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append(text)
+
+
+@pytest.fixture
+def adb(db, monkeypatch):
+    """The async facade the handlers use, over a user with exactly the minimum balance"""
+    db.add_user(1, "asha", "Asha", None)
+    for user_id in range(2, 2 + int(EarnyHa.MIN_WITHDRAWAL // EarnyHa.REFERRAL_BONUS)):
+        db.add_user(user_id, None, "Referred", None, 1)
+    assert db.get_user(1)['balance_paise'] == EarnyHa.MIN_WITHDRAWAL_PAISE
+
+    facade = EarnyHa.AsyncDatabaseManager(db, max_workers=1)
+    monkeypatch.setattr(EarnyHa, 'db', facade)
+    yield facade
+    facade.shutdown()
+
+
+def withdraw(user_id, *args):
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=FakeMessage())
+    context = SimpleNamespace(args=list(args))
+    return update, EarnyHa.withdraw_command(update, context)
+
+
+def test_withdraw_screen_at_exactly_the_minimum(adb):
+    query = FakeQuery("withdraw", 1)
+    asyncio.run(EarnyHa.callback_router.dispatch(query))
+    insufficient, _ = EarnyHa.render('withdraw_insufficient', **EarnyHa.screen_fields(adb.database.get_user(1), "Asha"))
+    assert query.edits and query.edits[0] != insufficient
+
+
+def test_withdraw_screen_reports_the_shortfall(adb):
+    adb.database.add_user(50, None, "New", None)
+    query = FakeQuery("withdraw", 50)
+    asyncio.run(EarnyHa.callback_router.dispatch(query))
+    assert f"₹{EarnyHa.MIN_WITHDRAWAL:.2f} more" in query.edits[0]
+
+
+def test_withdraw_command_compares_whole_paise(adb):
+    async def run():
+        over, over_call = withdraw(1, "50.01", "UPI", "asha@upi")
+        await over_call
+        exact, exact_call = withdraw(1, "50", "UPI", "asha@upi")
+        await exact_call
+        return over.message.replies, exact.message.replies
+
+    over, exact = asyncio.run(run())
+    assert over[0].startswith("❌ Insufficient balance")
+    assert exact[0].startswith("✅")
+    assert adb.database.get_user(1)['balance_paise'] == 0
+
+
+def test_below_minimum_is_refused(adb):
+    update, call = withdraw(1, "49.99", "UPI", "asha@upi")
+    asyncio.run(call)
+    assert update.message.replies[0].startswith("❌ Minimum withdrawal")
+
+
+@pytest.mark.parametrize('group_commit', [False, True])
+def test_concurrent_withdrawals_never_overdraw(db_path, group_commit):
+    database = EarnyHa.DatabaseManager(db_path, pooled=True, group_commit=group_commit, flush_interval=0.001)
+    database.add_user(1, None, "Referrer", None)
+    for user_id in range(2, 12):
+        database.add_user(user_id, None, "Referred", None, 1)
+    start = threading.Barrier(16)
+
+    def attempt(_):
+        start.wait()
+        try:
+            return database.create_withdrawal_request(1, 30.0, "UPI", "referrer@upi")
+        except EarnyHa.InsufficientBalance:
+            return None
+
+    with ThreadPoolExecutor(16) as pool:
+        outcomes = list(pool.map(attempt, range(16)))
+    try:
+        # 100.00 covers three withdrawals of 30.00
+        assert outcomes.count(True) == 3 and outcomes.count(None) == 13
+        assert database.get_user(1)['balance_paise'] == 1000
+        assert database.get_bot_stats()['pending_withdrawals'] == 3
+        assert database.verify_ledger()['mismatched'] == 0
+    finally:
+        database.close()
+
+
+def test_insufficient_balance_writes_nothing(db):
+    db.add_user(1, None, "Asha", None)
+    with pytest.raises(EarnyHa.InsufficientBalance) as raised:
+        db.create_withdrawal_request(1, 0.01, "UPI", "asha@upi")
+
+    assert raised.value.balance == 0
+    assert db.get_bot_stats()['pending_withdrawals'] == 0
+    with db._connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM withdrawals').fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM ledger WHERE entry = 'withdrawal_hold'").fetchone()[0] == 0